@@ -0,0 +1,69 @@
+#Expected counts cubes straight from the exposure cube, without a BinnedAnalysis
+#counts[i, p] = template[i, p] * integral over bin i of dN/dE(E)*exposure(E, p) dE
+import numpy as np
+
+from cube_reader import open_cube, normalize_planes
+
+#Exposure cube [cm^2 s] and the energies [MeV] of its planes, e.g. 6gev_exposure.fits
+#The cube is a memory-mapped view (see cube_reader.py); planes selects a subset of planes
+def read_exposure(filename, planes=None):
+    reader = open_cube(filename)
+    exposure_energies = reader.exposure_energies()
+    if planes is not None:
+        exposure_energies = exposure_energies[planes]
+    return reader.cube(0, planes), exposure_energies
+
+#Quadrature weights W of shape (n_bins, n_nodes) with the spectrum folded in:
+#(W @ exposure)[i, p] is the integral of dN/dE*exposure over bin i at pixel p.
+#Exposure is interpolated linearly in log-energy between planes, the bin integral uses
+#n_sub log-spaced midpoints per bin
+def exposure_weights(spectrum, bin_edges, exposure_energies, n_sub=8):
+    bin_edges = np.asarray(bin_edges, dtype=float)
+    log_nodes = np.log(np.asarray(exposure_energies, dtype=float))
+    log_edges = np.log(bin_edges)
+    dlog = np.diff(log_edges)/n_sub
+    log_e = log_edges[:-1, None]+(np.arange(n_sub)[None, :]+0.5)*dlog[:, None]
+    e_sub = np.exp(log_e)
+
+    #dE = E dlnE
+    values = np.asarray(spectrum(e_sub), dtype=float)*e_sub*dlog[:, None]
+
+    k = np.clip(np.searchsorted(log_nodes, log_e)-1, 0, len(log_nodes)-2)
+    t = np.clip((log_e-log_nodes[k])/(log_nodes[k+1]-log_nodes[k]), 0.0, 1.0)
+    rows = np.repeat(np.arange(len(bin_edges)-1), n_sub)
+    weights = np.zeros((len(bin_edges)-1, len(log_nodes)))
+    np.add.at(weights, (rows, k.ravel()), (values*(1.0-t)).ravel())
+    np.add.at(weights, (rows, k.ravel()+1), (values*t).ravel())
+    return weights
+
+#Expected counts cube (n_bins, ...pixel shape) for a spectrum and a spatial template
+#spectrum: callable returning dN/dE [ph cm^-2 s^-1 MeV^-1] for an array of energies [MeV]
+#exposure: (n_nodes, ny, nx) cube with planes at exposure_energies
+#template: spatial distribution normalized to 1 in each bin, shape (n_bins, ny, nx) or (ny, nx)
+#edisp: optional (n_bins, n_true) dispersion matrix from irfs.edisp_matrix, with its
+#true-energy binning true_edges; the spectrum is then integrated on true_edges and folded
+def expected_counts(spectrum, bin_edges, exposure, exposure_energies, template, edisp=None, true_edges=None, n_sub=8):
+    exposure = np.asarray(exposure, dtype=float)
+    pixel_shape = exposure.shape[1:]
+    flat_exposure = exposure.reshape(exposure.shape[0], -1)
+
+    if edisp is None:
+        integrated = np.dot(exposure_weights(spectrum, bin_edges, exposure_energies, n_sub), flat_exposure)
+    else:
+        if true_edges is None:
+            true_edges = bin_edges
+        integrated = np.asarray(edisp.dot(np.dot(exposure_weights(spectrum, true_edges, exposure_energies, n_sub), flat_exposure)))
+
+    template = np.asarray(template, dtype=float)
+    return integrated.reshape((len(bin_edges)-1,)+pixel_shape)*template
+
+#Normalize a srcmap-style template (n_nodes, ny, nx) to unit sum in each energy bin
+#Uses the lower plane of each bin, as the model reconstruction in analysis.py does
+def normalized_template(cube):
+    return normalize_planes(cube[:-1])
+
+#Expected counts per energy bin from the flux in each bin and the exposure at the
+#bin-edge planes (e.g. the sums of a source's srcmap planes), averaged over each bin
+def binned_counts(binned_flux, plane_exposure):
+    plane_exposure = np.asarray(plane_exposure, dtype=float)
+    return np.asarray(binned_flux, dtype=float)*0.5*(plane_exposure[:-1]+plane_exposure[1:])
@@ -0,0 +1,85 @@
+#Lazy, memory-mapped access to srcmap, counts and exposure cubes
+#The FITS file is memory-mapped and only the HDU headers are read up front, to
+#build a name -> HDU index. Data are materialized on request, and only the
+#requested source / energy-bin planes: slices of the memory map are views, so
+#nothing is copied until the values are actually used.
+#Memory mapping needs unscaled image data (no BSCALE/BZERO), which is what
+#gtsrcmaps and gtexpcube2 write; scaled images fall back to a full read by astropy
+import os
+import numpy as np
+from astropy.io import fits
+
+#Planes (n, ny, nx) scaled to unit sum each (empty planes are left at zero)
+def normalize_planes(planes):
+    planes = np.asarray(planes, dtype=float)
+    norm = np.sum(planes.reshape(planes.shape[0], -1), axis=1)
+    norm[norm==0.0] = 1.0
+    return planes/norm[:, None, None]
+
+class CubeReader:
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.hdus = fits.open(filename, memmap=True)
+        self.index = {}
+        for i, hdu in enumerate(self.hdus):
+            name = hdu.name.upper()
+            if name not in self.index:
+                self.index[name] = i
+
+    #HDU index of an extension name (srcmap sources are stored under their source name)
+    def index_of(self, name):
+        key = name.upper()
+        if key not in self.index:
+            raise KeyError("No HDU named " + str(name) + " in " + str(self.filename))
+        return self.index[key]
+
+    def __contains__(self, name):
+        return name.upper() in self.index
+
+    #Image HDUs after the primary, counts and energy tables, i.e. the srcmap sources
+    def source_names(self):
+        return [hdu.name for hdu in self.hdus[3:] if hdu.is_image]
+
+    #Planes of an image HDU (by name or index) as a view of the memory map
+    #planes: a slice or index array over the energy planes, all planes if None
+    def cube(self, hdu, planes=None):
+        if not isinstance(hdu, int):
+            hdu = self.index_of(hdu)
+        data = self.hdus[hdu].data
+        if planes is None:
+            return data
+        return data[planes]
+
+    #Counts cube (the primary HDU)
+    def counts(self, planes=None):
+        return self.cube(0, planes)
+
+    #Source template for energy bins bins (a slice, all bins if None), normalized to unit sum
+    #per bin. As in counts.normalized_template, the lower plane of each bin is used.
+    #Only the requested planes are read
+    def template(self, source, bins=None):
+        data = self.cube(source)
+        if bins is None:
+            bins = slice(0, data.shape[0]-1)
+        return normalize_planes(data[bins])
+
+    #Energies [MeV] of the planes of an exposure cube (first column of the ENERGIES table)
+    def exposure_energies(self):
+        return np.array([float(entry[0]) for entry in self.hdus[1].data])
+
+    def close(self):
+        self.hdus.close()
+
+_readers = {}
+
+#Shared reader per file, so the header index is built once per session
+#A file rewritten since it was opened (e.g. box_srcmap_poisson.fits) is reopened, and
+#the stale reader closed so its memory map and file handle are released
+def open_cube(filename):
+    mtime = os.path.getmtime(filename)
+    if filename not in _readers or _readers[filename][0] != mtime:
+        if filename in _readers:
+            _readers[filename][1].close()
+        _readers[filename] = (mtime, CubeReader(filename))
+    return _readers[filename][1]
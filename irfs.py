@@ -0,0 +1,130 @@
+#Instrument response tables shared by the analysis and the scripts
+#The tables are loaded once; lookups interpolate linearly in log-energy and
+#accept whole arrays of energies at a time
+import hashlib
+import numpy as np
+from scipy import sparse
+from scipy.special import erf
+
+#Energy resolution (E Disp class 1- pretty close to the total)
+#Energy [MeV], fractional resolution sigma_E/E
+e_res_energy = np.array([31.718504,54.31288,95.86265,171.82704,307.93054,535.1251,944.0604,1716.8848,3074.5315,5339.1763,9559.056,17111.936,29704.664,53986.227,93706.14,167702.28,300152.7,520977.8,931974.8,1690808.0,2974747.2])
+e_res_values = np.array([0.2942218,0.25078142,0.21741302,0.1813951,0.15067752,0.12313887,0.10302135,0.090325624,0.08080946,0.07341215,0.07025641,0.070810914,0.07454435,0.080399856,0.08678346,0.094758466,0.10061333,0.10752697,0.25969607,0.18390165,0.24169934])
+
+#PSF containment radius [degrees] vs energy [MeV]
+psf_energy = np.array([9.91152,17.36871,31.150045,54.59528,96.42895,171.62605,303.14316,539.58026,967.85913,1709.5619,3066.256,5374.1895,9712.058,17151.041,29366.348,52649.074,92947.98,167911.25,298723.0,527422.3,952855.0,1682382.6,2993103.8])
+psf_values = np.array([22.122343,17.216175,11.960119,8.108732,5.279108,3.5216076,2.2375877,1.3988715,0.8535155,0.53358656,0.347393,0.23173566,0.17039458,0.12837319,0.112826064,0.10581638,0.10334797,0.10426899,0.10101496,0.09097172,0.08671612,0.07683781,0.073241934])
+
+#Two-column text table (energy [MeV], value), e.g. for another event class
+def load_table(filename):
+    table = np.loadtxt(filename)
+    order = np.argsort(table[:,0])
+    return table[order,0], table[order,1]
+
+class InstrumentResponse:
+
+    def __init__(self, e_res_table=None, psf_table=None):
+        if e_res_table is None:
+            e_res_table = (e_res_energy, e_res_values)
+        if psf_table is None:
+            psf_table = (psf_energy, psf_values)
+        self.e_res_table = (np.asarray(e_res_table[0], dtype=float), np.asarray(e_res_table[1], dtype=float))
+        self.psf_table = (np.asarray(psf_table[0], dtype=float), np.asarray(psf_table[1], dtype=float))
+        self._log_e_res_energy = np.log(self.e_res_table[0])
+        self._log_psf_energy = np.log(self.psf_table[0])
+        self._edisp_cache = {}
+
+    #Replacement tables from files; either one may be left at the default
+    @classmethod
+    def from_files(cls, e_res_file=None, psf_file=None):
+        e_res_table = None
+        psf_table = None
+        if e_res_file is not None:
+            e_res_table = load_table(e_res_file)
+        if psf_file is not None:
+            psf_table = load_table(psf_file)
+        return cls(e_res_table, psf_table)
+
+    #Fractional energy resolution at E [MeV]. Scalars in, scalars out
+    def e_res(self, E):
+        return np.interp(np.log(E), self._log_e_res_energy, self.e_res_table[1])
+
+    #PSF containment radius [degrees] at E [MeV]
+    def psf(self, E):
+        return np.interp(np.log(E), self._log_psf_energy, self.psf_table[1])
+
+    #Sparse true-to-reconstructed energy dispersion matrix
+    #bin_edges: reconstructed-energy bin boundaries (the analysis binning)
+    #true_edges: true-energy bin boundaries, defaults to bin_edges. A finer true binning
+    #(see true_energy_edges) keeps features narrower than a bin, like a line, in place.
+    #Element [j, i] is the probability that a photon from true bin i is reconstructed in bin j,
+    #averaged over n_sub log-spaced energies in the true bin weighted by an E^-index spectrum.
+    #Photons smeared outside the binning are lost; entries below threshold are dropped.
+    #Matrices are cached per binning, so they are built once per session
+    def edisp_matrix(self, bin_edges, true_edges=None, n_sub=8, index=2.0, threshold=1e-7):
+        bin_edges = np.asarray(bin_edges, dtype=float)
+        if true_edges is None:
+            true_edges = bin_edges
+        true_edges = np.asarray(true_edges, dtype=float)
+        key = (bin_edges.tobytes(), true_edges.tobytes(), n_sub, index, threshold)
+        if key not in self._edisp_cache:
+            log_edges = np.log(true_edges)
+            t = (np.arange(n_sub)+0.5)/n_sub
+            #True energies (n_true, n_sub) and their spectral weights
+            e_true = np.exp(log_edges[:-1, None]+t[None, :]*np.diff(log_edges)[:, None])
+            weights = e_true**(1.0-index)
+            weights /= np.sum(weights, axis=1)[:, None]
+            sigma = self.e_res(e_true)*e_true
+
+            cdf = 0.5*(1.0+erf((bin_edges[:, None, None]-e_true[None, :, :])/(np.sqrt(2.0)*sigma[None, :, :])))
+            dense = np.sum(np.diff(cdf, axis=0)*weights[None, :, :], axis=2)
+            dense[dense<threshold] = 0.0
+            self._edisp_cache[key] = sparse.csr_matrix(dense)
+        return self._edisp_cache[key]
+
+    #Content hash of the energy resolution table, used to key cached templates
+    def e_res_hash(self):
+        h = hashlib.sha1()
+        for arr in self.e_res_table:
+            h.update(np.ascontiguousarray(arr, dtype=np.float64).tobytes())
+        return h.hexdigest()
+
+default_response = InstrumentResponse()
+
+#Swap the tables used by e_res() and psf() for the rest of the session
+def set_default_response(response):
+    global default_response
+    default_response = response
+
+def e_res(E):
+    return default_response.e_res(E)
+
+def edisp_matrix(bin_edges, true_edges=None):
+    return default_response.edisp_matrix(bin_edges, true_edges)
+
+#True-energy binning for edisp_matrix: each analysis bin split into n_fine log-spaced
+#bins, padded by n_pad bins on both sides so flux dispersed into the range is counted
+def true_energy_edges(bin_edges, n_fine=10, n_pad=5):
+    log_edges = np.log(np.asarray(bin_edges, dtype=float))
+    low = log_edges[0]-(log_edges[1]-log_edges[0])*np.arange(n_pad, 0, -1)
+    high = log_edges[-1]+(log_edges[-1]-log_edges[-2])*np.arange(1, n_pad+1)
+    coarse = np.concatenate([low, log_edges, high])
+    fine = np.interp(np.arange((len(coarse)-1)*n_fine+1)/float(n_fine), np.arange(len(coarse)), coarse)
+    return np.exp(fine)
+
+#Dispersion matrix for spectra written in reconstructed energy (box_spectrum.dat, the
+#template bank): the analysis binning refined by true_energy_edges on both axes
+#Returns (matrix, edges)
+def folding_matrix(bin_edges):
+    edges = true_energy_edges(bin_edges)
+    return edisp_matrix(edges, edges), edges
+
+def psf(E):
+    return default_response.psf(E)
+
+#Forward-fold binned true-energy spectra through a dispersion matrix
+#The last axis of binned holds the true-energy bins; any leading axes are folded in one product
+def fold(matrix, binned):
+    binned = np.asarray(binned, dtype=float)
+    flat = binned.reshape(-1, binned.shape[-1])
+    return np.asarray(matrix.dot(flat.T)).T.reshape(binned.shape[:-1]+(matrix.shape[0],))
@@ -0,0 +1,150 @@
+#Binned Poisson log-likelihood
+#   log L = sum_p [d_p log(m_p) - m_p - log(d_p!)]
+#The data-only log(d!) term is computed once per dataset with gammaln, and the rest
+#with xlogy, so empty pixels cost nothing and large counts cannot overflow (the old
+#m**d*exp(-m)/d! form overflows well below the counts of the low-energy bins)
+import numpy as np
+from scipy.special import gammaln, xlogy
+
+class PoissonLikelihood:
+
+    #data: observed counts cube, any shape
+    def __init__(self, data):
+        self.shape = np.shape(data)
+        self.data = np.asarray(data, dtype=float).ravel()
+        self.observed = np.nonzero(self.data>0.0)[0]
+        #Per energy bin (the first axis of data), for bin_loglike
+        self.bin_log_factorial = np.sum(gammaln(self.data+1.0).reshape(self.shape[0], -1), axis=1)
+        self.log_factorial = np.sum(self.bin_log_factorial)
+        self.total_counts = np.sum(self.data)
+
+    #log L of a model cube with the same number of pixels as the data
+    #A model that vanishes where photons were observed gives -inf
+    def loglike(self, model):
+        model = np.asarray(model, dtype=float).ravel()
+        with np.errstate(divide='ignore'):
+            return np.sum(xlogy(self.data, model))-np.sum(model)-self.log_factorial
+
+    #log L of every energy bin (first axis of the data); the bins sum to loglike(model)
+    def bin_loglike(self, model):
+        model = np.asarray(model, dtype=float).reshape(self.shape[0], -1)
+        data = self.data.reshape(self.shape[0], -1)
+        with np.errstate(divide='ignore'):
+            return np.sum(xlogy(data, model), axis=1)-np.sum(model, axis=1)-self.bin_log_factorial
+
+    #d log L / d model = d/m - 1 for every pixel
+    def model_gradient(self, model):
+        model = np.asarray(model, dtype=float).ravel()
+        gradient = -1.0*np.ones(len(model))
+        gradient[self.observed] += self.data[self.observed]/model[self.observed]
+        return gradient.reshape(self.shape)
+
+    #log L and its gradient with respect to the per-bin counts of every source of a
+    #ModelCube, shape (n_sources, n_ebins). Source counts proportional to a normalization
+    #N give d log L / d N = sum(counts_gradient[i]*counts[i])/N
+    def counts_gradient(self, model_cube, counts):
+        counts = model_cube.counts_array(counts)
+        model = model_cube.model(counts)
+        return self.loglike(model), model_cube.project(self.model_gradient(model))
+
+    #log L and its gradient with respect to a scale factor on each source's counts,
+    #evaluated at scale 1 (i.e. d log L / d log N for a normalization N)
+    def scale_gradient(self, model_cube, counts):
+        counts = model_cube.counts_array(counts)
+        loglike, gradient = self.counts_gradient(model_cube, counts)
+        return loglike, np.sum(gradient*counts, axis=1)
+
+    #Hessian of -log L (the observed Fisher information) with respect to parameters x_j
+    #that each act on the counts of one source of a ModelCube
+    #   H_jk = sum_p d_p/m_p**2 dm_p/dx_j dm_p/dx_k - sum_p (d_p/m_p-1) d2m_p/dx_j dx_k
+    #Every dm/dx is a template times a per-bin factor, so both sums reduce to per-bin
+    #template products and projections, and the pixels are visited once for all pairs
+    #derivatives: list of (source index, d counts/d x_j per bin), one per parameter
+    #second: {(j, k): d2 counts/dx_j dx_k per bin} with j <= k, for pairs acting on the
+    #same source; pairs left out are linear in the counts (e.g. normalizations)
+    def counts_hessian(self, model_cube, counts, derivatives, second=None):
+        model = model_cube.model(model_cube.counts_array(counts)).ravel()
+        weights = np.zeros(len(model))
+        weights[self.observed] = self.data[self.observed]/model[self.observed]**2
+        products = model_cube.weighted_products(weights)
+        if second:
+            projection = model_cube.project(self.model_gradient(model))
+        n = len(derivatives)
+        hessian = np.zeros((n, n))
+        for j, (i_j, d_j) in enumerate(derivatives):
+            for k in range(j, n):
+                i_k, d_k = derivatives[k]
+                hessian[j, k] = np.sum(d_j*d_k*products[i_j, i_k])
+                if second and (j, k) in second:
+                    hessian[j, k] -= np.sum(second[(j, k)]*projection[i_j])
+                hessian[k, j] = hessian[j, k]
+        return hessian
+
+#Correlation matrix of a covariance matrix. Parameters without variance get zero correlations
+def correlation_matrix(covariance):
+    covariance = np.atleast_2d(np.asarray(covariance, dtype=float))
+    sigma = np.sqrt(np.abs(np.diag(covariance)))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        correlation = covariance/np.outer(sigma, sigma)
+    correlation[~np.isfinite(correlation)] = 0.0
+    return correlation
+
+#Covariance and correlation matrices from a Fisher information matrix (the Hessian of -log L)
+#A singular matrix, e.g. with a parameter the data do not constrain, is pseudo-inverted
+def covariance_and_correlation(information):
+    information = np.atleast_2d(np.asarray(information, dtype=float))
+    try:
+        covariance = np.linalg.inv(information)
+    except np.linalg.LinAlgError:
+        covariance = np.linalg.pinv(information)
+    return covariance, correlation_matrix(covariance)
+
+#Cumulative sums of per-bin log-likelihoods (PoissonLikelihood.bin_loglike, or
+#spectral_loglike with per_bin=True). For fixed parameters the log L of any contiguous
+#window of bins [low, high), or of everything outside it, is then a lookup.
+#low and high may be arrays, e.g. index-6 and index+2 for every edge index at once;
+#they are clipped to the binning
+class WindowedLoglike:
+
+    def __init__(self, contributions):
+        self.contributions = np.asarray(contributions, dtype=float)
+        self.cumulative = np.concatenate([[0.0], np.cumsum(self.contributions)])
+        self.total = self.cumulative[-1]
+
+    def window(self, low, high):
+        n = len(self.contributions)
+        low = np.clip(low, 0, n)
+        high = np.clip(high, 0, n)
+        return np.where(high>low, self.cumulative[high]-self.cumulative[low], 0.0)
+
+    #The sidebands, i.e. all bins below low and from high up
+    def complement(self, low, high):
+        return self.total-self.window(low, high)
+
+#Poisson log L of binned spectra, counts (n_bins,) against models (..., n_bins)
+#per_bin=True keeps the bin axis instead of summing over it
+def spectral_loglike(counts, models, per_bin=False):
+    counts = np.asarray(counts, dtype=float)
+    with np.errstate(divide='ignore'):
+        contributions = xlogy(counts, models)-models-gammaln(counts+1.0)
+    if per_bin:
+        return contributions
+    return np.sum(contributions, axis=-1)
+
+#TS = 2*(log L(background+amplitude*box)-log L(background)) for many box hypotheses at once
+#boxes: (n_hyp, n_bins) expected counts of each hypothesis at unit amplitude, e.g. every
+#edge and zeta of a TemplateBank times the counts per unit flux in each bin
+#amplitudes: scalar or (n_hyp,) gives one TS per hypothesis, (n_hyp, n_amp) a grid of
+#amplitudes per hypothesis and a TS of the same shape
+def box_ts(counts, background, boxes, amplitudes=1.0):
+    boxes = np.atleast_2d(np.asarray(boxes, dtype=float))
+    background = np.asarray(background, dtype=float)
+    amplitudes = np.asarray(amplitudes, dtype=float)
+    grid = amplitudes.ndim == 2
+    if not grid:
+        amplitudes = np.broadcast_to(amplitudes, (len(boxes),))[:, None]
+    models = background+amplitudes[:, :, None]*boxes[:, None, :]
+    ts = 2.0*(spectral_loglike(counts, models)-spectral_loglike(counts, background))
+    if not grid:
+        return ts[:, 0]
+    return ts
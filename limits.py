@@ -0,0 +1,64 @@
+#Upper limits from a profile likelihood without grid scans
+#The minimum of the profile is bracketed by doubling steps and refined with Brent
+#minimization (bounded when it lies next to xmin); the upper limit is then bracketed above the minimum the same way
+#and solved with Brent's root finder. Evaluations are memoized, so every fit is run once
+import numpy as np
+from scipy.optimize import minimize_scalar, brentq
+
+#profile: function of the amplitude returning -logL, profiled over everything else
+#xmin: lower bound of the amplitude (0 for a non-negative box)
+#step: starting step, roughly the expected size of the upper limit minus xmin
+#delta: rise in -logL defining the limit; 2.71 is the criterion of the scans this replaces
+#from_null: measure the rise from -logL at xmin rather than from the minimum
+#rtol: tolerance on the upper limit relative to its bracket; the minimum is located to
+#10*rtol, which moves the limit only at second order
+#Returns a dict with best_fit, ts (2*(-logL(xmin)+logL(best_fit))), upper_limit,
+#the -logL values at xmin and at the best fit, the number of evaluations, a converged
+#flag and a message
+def profile_upper_limit(profile, xmin=0.0, step=1.0, delta=2.71, rtol=1e-3, max_evaluations=100, from_null=False):
+    cache = {}
+    def f(x):
+        x = float(x)
+        if x not in cache:
+            if len(cache)>=max_evaluations:
+                raise RuntimeError("profile_upper_limit: more than " + str(max_evaluations) + " evaluations")
+            cache[x] = float(profile(x))
+        return cache[x]
+
+    result = {'best_fit':xmin, 'ts':0.0, 'upper_limit':np.nan, 'null_value':np.nan, 'min_value':np.nan, 'evaluations':0, 'converged':False, 'message':''}
+    try:
+        null_value = f(xmin)
+
+        #Bracket the minimum: lo <= minimum <= hi. A profile rising from the bound (a probe
+        #just above it is higher) has its minimum on the bound, as for most box edges
+        lo, mid, hi = xmin, xmin, xmin+step
+        while f(hi)<f(mid):
+            lo, mid, hi = mid, hi, xmin+2.0*(hi-xmin)
+        if mid>lo and f(mid)<f(hi):
+            minimum = minimize_scalar(f, bracket=(lo, mid, hi), method='brent', tol=10.0*rtol)
+            best_fit, min_value = minimum.x, minimum.fun
+        elif mid>lo or f(xmin+10.0*rtol*step)<null_value:
+            minimum = minimize_scalar(f, bounds=(lo, hi), method='bounded', options={'xatol':10.0*rtol*(hi-lo)})
+            best_fit, min_value = minimum.x, minimum.fun
+        else:
+            best_fit, min_value = xmin, null_value
+        #The bounded search never lands exactly on the bound
+        if null_value<=min_value:
+            best_fit, min_value = xmin, null_value
+
+        #Bracket the limit above the minimum and solve f(x) = min + delta (or null + delta)
+        reference = null_value if from_null else min_value
+        g = lambda x: f(x)-reference-delta
+        #Start from the tightest bracket among the points already evaluated
+        lo = max([x for x in cache if x>=best_fit and g(x)<0.0]+[best_fit])
+        above = [x for x in cache if x>lo and g(x)>=0.0]
+        hi = min(above) if len(above)>0 else lo+step
+        while g(hi)<0.0:
+            lo, hi = hi, best_fit+2.0*(hi-best_fit)
+        upper_limit, root = brentq(g, lo, hi, xtol=rtol*(hi-lo), full_output=True)
+
+        result.update({'best_fit':best_fit, 'ts':2.0*(null_value-min_value), 'upper_limit':upper_limit, 'null_value':null_value, 'min_value':min_value, 'converged':root.converged, 'message':root.flag})
+    except (RuntimeError, ValueError) as error:
+        result['message'] = str(error)
+    result['evaluations'] = len(cache)
+    return result
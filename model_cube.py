@@ -0,0 +1,321 @@
+#Model counts cube assembled from the srcmap templates
+#Each source template is read and normalized once and kept in a compact form:
+#point-like templates, which are essentially zero beyond a few PSF radii, as
+#per-energy-bin sparse patches, and diffuse templates as dense float32 arrays.
+#Models are accumulated in float64 from the per-source counts in each energy bin
+#(like._srcCnts)
+import os
+import numpy as np
+
+from cube_reader import open_cube
+from likelihood import PoissonLikelihood
+
+class ModelCube:
+
+    #templates: sequence of (n_ebins, ny, nx) templates, normalized to unit sum per bin,
+    #one per source (a generator works, so all sources need not be in memory at once)
+    #Pixels below tolerance (a fraction of the source photons in that bin) are dropped
+    #from sparse templates; a template is stored sparse if the remaining pixels cover
+    #less than sparse_fraction of the cube
+    def __init__(self, source_names, templates, sparse_fraction=0.25, tolerance=1e-7):
+        self.source_names = list(source_names)
+        self.index = dict((name, i) for i, name in enumerate(self.source_names))
+        self.sparse_fraction = sparse_fraction
+        self.tolerance = tolerance
+        self.dense = {}
+        self.sparse = {}
+        for i, template in enumerate(templates):
+            template = np.asarray(template)
+            if i == 0:
+                self.shape = template.shape
+                self.n_ebins = template.shape[0]
+                self.n_pix = int(np.prod(template.shape[1:]))
+            self._store(i, template.reshape(self.n_ebins, self.n_pix))
+
+    #Sparse patches are (flat index into the (n_ebins*n_pix) cube, float32 value,
+    #number of stored pixels in each bin)
+    def _store(self, i, template):
+        keep = template>=self.tolerance
+        if np.count_nonzero(keep)<self.sparse_fraction*template.size:
+            flat = np.nonzero(keep.ravel())[0]
+            self.sparse[i] = (flat, template.ravel()[flat].astype(np.float32), np.sum(keep, axis=1))
+        else:
+            self.dense[i] = np.ascontiguousarray(template, dtype=np.float32)
+
+    #Templates from the source HDUs of a srcmap file. The srcmap planes sit on the
+    #energy bin edges; as before, the lower plane of each bin is used
+    @classmethod
+    def from_srcmap(cls, filename, source_names=None):
+        srcmap = open_cube(filename)
+        if source_names is None:
+            source_names = srcmap.source_names()
+        return cls(source_names, (srcmap.template(source) for source in source_names))
+
+    #Dense float64 template (n_ebins, n_pix) of one source
+    def template(self, source):
+        i = self.index[source]
+        if i in self.dense:
+            return self.dense[i].astype(float)
+        flat, values, per_bin = self.sparse[i]
+        template = np.zeros(self.n_ebins*self.n_pix)
+        template[flat] = values
+        return template.reshape(self.n_ebins, self.n_pix)
+
+    #Memory held by the templates [bytes]
+    def nbytes(self):
+        return sum(t.nbytes for t in self.dense.values())+sum(flat.nbytes+values.nbytes for flat, values, per_bin in self.sparse.values())
+
+    #Counts vector -> array of shape (n_sources, n_ebins)
+    #counts may be such an array already, or a {source: counts per bin} dict
+    def counts_array(self, counts):
+        if isinstance(counts, dict):
+            array = np.zeros((len(self.source_names), self.n_ebins))
+            for source in counts:
+                array[self.index[source]] = counts[source]
+            return array
+        return np.asarray(counts, dtype=float)
+
+    #Model counts cube (n_ebins, ny, nx)
+    def model(self, counts):
+        counts = self.counts_array(counts)
+        model = np.zeros((self.n_ebins, self.n_pix))
+        for i, template in self.dense.items():
+            model += counts[i][:, None]*template
+        flat_model = model.ravel()
+        for i, (flat, values, per_bin) in self.sparse.items():
+            #Each pixel appears once per source, so fancy-index accumulation is safe
+            flat_model[flat] += np.repeat(counts[i], per_bin)*values
+        return model.reshape(self.shape)
+
+    #Projection of a cube of per-pixel weights onto every template, shape (n_sources, n_ebins):
+    #result[i, e] = sum_p weights[e, p]*template_i[e, p]. With weights = d logL/d model this
+    #is the gradient of the likelihood with respect to the counts of each source in each bin
+    def project(self, weights):
+        weights = np.asarray(weights, dtype=float).reshape(self.n_ebins, self.n_pix)
+        projection = np.zeros((len(self.source_names), self.n_ebins))
+        for i, template in self.dense.items():
+            projection[i] = np.einsum('ep,ep->e', template, weights)
+        flat_weights = weights.ravel()
+        for i, (flat, values, per_bin) in self.sparse.items():
+            projection[i] = np.bincount(flat//self.n_pix, weights=values*flat_weights[flat], minlength=self.n_ebins)
+        return projection
+
+    #Template values of source index i at flat indices into the (n_ebins*n_pix) cube
+    def _values_at(self, i, flat):
+        if i in self.dense:
+            return self.dense[i].ravel()[flat].astype(float)
+        stored, values, per_bin = self.sparse[i]
+        if len(stored) == 0:
+            return np.zeros(len(flat))
+        position = np.clip(np.searchsorted(stored, flat), 0, len(stored)-1)
+        return np.where(stored[position] == flat, values[position], 0.0)
+
+    #Weighted products of every pair of templates, shape (n_sources, n_sources, n_ebins):
+    #result[i, k, e] = sum_p weights[e, p]*template_i[e, p]*template_k[e, p]. With
+    #weights = d/m**2 this is the curvature of the likelihood in the counts of each pair
+    #of sources in each bin. Pairs with a sparse template only visit its stored pixels
+    def weighted_products(self, weights):
+        weights = np.asarray(weights, dtype=float).reshape(self.n_ebins, self.n_pix)
+        flat_weights = weights.ravel()
+        n = len(self.source_names)
+        products = np.zeros((n, n, self.n_ebins))
+        for i in range(n):
+            for k in range(i, n):
+                if i in self.dense and k in self.dense:
+                    products[i, k] = np.einsum('ep,ep,ep->e', self.dense[i], self.dense[k], weights)
+                else:
+                    j, other = (i, k) if i in self.sparse else (k, i)
+                    flat, values, per_bin = self.sparse[j]
+                    products[i, k] = np.bincount(flat//self.n_pix, weights=values*self._values_at(other, flat)*flat_weights[flat], minlength=self.n_ebins)
+                products[k, i] = products[i, k]
+        return products
+
+    #Model for the current fit parameters of a (Binned/Analytic) analysis object
+    def model_from_like(self, like):
+        return self.model(np.array([like._srcCnts(source) for source in self.source_names]))
+
+    #Counts cube of a single source
+    def source_model(self, source, counts):
+        return (np.asarray(counts, dtype=float)[:, None]*self.template(source)).reshape(self.shape)
+
+_model_cubes = {}
+
+#ModelCube for a srcmap file, built on first use and shared afterwards
+#(rebuilt if the file has been rewritten since, replacing the stale cube)
+def load_model_cube(filename, source_names=None):
+    key = (filename, None if source_names is None else tuple(source_names))
+    mtime = os.path.getmtime(filename)
+    if key not in _model_cubes or _model_cubes[key][0] != mtime:
+        _model_cubes[key] = (mtime, ModelCube.from_srcmap(filename, source_names))
+    return _model_cubes[key][1]
+
+#Model with a few linearly varying components on top of a fixed background:
+#   model = background + sum_k amplitudes[k]*components[k]
+#The background, the unit components and their sums are computed once, so changing
+#e.g. the box normalization and disk prefactor costs one small matrix product rather
+#than a full model evaluation. Only pixels with data > 0 enter the log term of the
+#likelihood, the linear term is kept as precomputed sums, so the cubes themselves are
+#only held at those pixels: each component is its counts per bin times the source
+#template of the ModelCube, which stays in its compact form. Log-likelihoods include
+#the log(data!) term, so they agree with likelihood.PoissonLikelihood.
+#background_counts: per-source counts of every fixed source (array or dict, see counts_array)
+#components: list of (source, counts per bin for unit amplitude) of the varying sources
+#data: observed counts cube (n_ebins, ny, nx)
+class IncrementalModel:
+
+    def __init__(self, model_cube, background_counts, components, data):
+        self.model_cube = model_cube
+        self.names = [name for name, counts in components]
+        self.likelihood = PoissonLikelihood(data)
+        self.observed = self.likelihood.observed
+        self.observed_data = self.likelihood.data[self.observed]
+        self.observed_bins = self.observed//model_cube.n_pix
+
+        #Template values at the observed pixels and template sums per bin of each component
+        sources = [model_cube.index[name] for name in self.names]
+        self.observed_templates = np.array([model_cube._values_at(i, self.observed) for i in sources]).reshape(len(self.names), -1)
+        self.template_bin_sums = model_cube.project(np.ones((model_cube.n_ebins, model_cube.n_pix)))[sources].reshape(len(self.names), -1)
+        self.component_counts = np.zeros((len(self.names), model_cube.n_ebins))
+        self.component_bin_sums = np.zeros((len(self.names), model_cube.n_ebins))
+        self.component_sums = np.zeros(len(self.names))
+        self.observed_components = np.zeros((len(self.names), len(self.observed)))
+        for name, counts in components:
+            self.update_component(name, counts)
+        self.return_code = 0
+        self.update_background(background_counts)
+
+    #Replace the cached background, e.g. after the fixed sources were refit
+    def update_background(self, background_counts):
+        self.background_counts = self.model_cube.counts_array(background_counts)
+        background = self.model_cube.model(self.background_counts).ravel()
+        self.background_sum = np.sum(background)
+        self.observed_background = background[self.observed]
+
+    #Replace the unit-amplitude counts per bin of one component, e.g. the box for a new
+    #edge energy or zeta; the background and the other components are kept
+    def update_component(self, name, counts):
+        k = self.names.index(name)
+        self.component_counts[k] = counts
+        self.component_bin_sums[k] = self.component_counts[k]*self.template_bin_sums[k]
+        self.component_sums[k] = np.sum(self.component_bin_sums[k])
+        self.observed_components[k] = self.component_counts[k][self.observed_bins]*self.observed_templates[k]
+
+    #Model cube (n_ebins, ny, nx) for amplitudes, ordered as self.names
+    def model(self, amplitudes):
+        counts = self.background_counts.copy()
+        for name, amplitude, component in zip(self.names, np.asarray(amplitudes, dtype=float), self.component_counts):
+            counts[self.model_cube.index[name]] += amplitude*component
+        return self.model_cube.model(counts)
+
+    #Poisson log L of the model for amplitudes
+    def loglike(self, amplitudes):
+        return self.loglike_grid(np.atleast_2d(amplitudes))[0]
+
+    #Same for many amplitude vectors at once, amplitudes: (n_points, n_components)
+    #The points are evaluated in chunks to bound the size of the temporary arrays
+    def loglike_grid(self, amplitudes, chunk_size=2**22):
+        amplitudes = np.asarray(amplitudes, dtype=float).reshape(-1, len(self.names))
+        linear = self.background_sum+np.dot(amplitudes, self.component_sums)
+        log_term = np.zeros(len(amplitudes))
+        step = max(1, chunk_size//max(1, len(self.observed)))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for start in range(0, len(amplitudes), step):
+                m = self.observed_background[None, :]+np.dot(amplitudes[start:start+step], self.observed_components)
+                log_term[start:start+step] = np.sum(self.observed_data[None, :]*np.log(m), axis=1)
+        log_term[np.isnan(log_term)] = -np.inf
+        return log_term-linear-self.likelihood.log_factorial
+
+    #Same with amplitudes that differ between energy bins, amplitudes: (n_points,
+    #n_components, n_ebins). With components built from unit counts in every bin these are
+    #the bare templates and the amplitudes are the counts per bin of each source, so sources
+    #whose spectral shape changes (e.g. with an index) can be mapped as well
+    def loglike_bins_grid(self, amplitudes, chunk_size=2**22):
+        amplitudes = np.asarray(amplitudes, dtype=float).reshape(-1, len(self.names), self.model_cube.n_ebins)
+        linear = self.background_sum+np.einsum('pke,ke->p', amplitudes, self.component_bin_sums)
+        log_term = np.zeros(len(amplitudes))
+        step = max(1, chunk_size//max(1, len(self.observed)*len(self.names)))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for start in range(0, len(amplitudes), step):
+                m = self.observed_background[None, :]+np.einsum('pko,ko->po', amplitudes[start:start+step][:, :, self.observed_bins], self.observed_components)
+                log_term[start:start+step] = np.sum(self.observed_data[None, :]*np.log(m), axis=1)
+        log_term[np.isnan(log_term)] = -np.inf
+        return log_term-linear-self.likelihood.log_factorial
+
+    #Maximize log L over the amplitudes of the components listed in free (indices into
+    #self.names), keeping them non-negative, with the other amplitudes held at their
+    #values in amplitudes. Projected Newton iteration: components pinned at zero with a
+    #gradient pointing below zero stay there, and the step on the rest is halved until
+    #log L increases. Each iteration costs a few vector operations over the observed pixels.
+    #Returns (log L, amplitudes); return_code is then 0 for a converged solution, 1 if
+    #max_iter was reached and 2 if the line search failed
+    def profile(self, amplitudes, free, max_iter=100, tol=1e-10):
+        amplitudes = np.array(amplitudes, dtype=float)
+        free = np.atleast_1d(free)
+        held = amplitudes.copy()
+        held[free] = 0.0
+        fixed_model = self.observed_background+np.dot(held, self.observed_components)
+        fixed_sum = self.background_sum+np.dot(held, self.component_sums)
+        X = self.observed_components[free]
+        sums = self.component_sums[free]
+        d = self.observed_data
+
+        def evaluate(a):
+            m = fixed_model+np.dot(a, X)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                value = np.sum(d*np.log(m))-fixed_sum-np.dot(a, sums)
+            if np.isnan(value):
+                value = -np.inf
+            return m, value
+
+        a = np.maximum(amplitudes[free], 0.0)
+        m, value = evaluate(a)
+        self.return_code = 1
+        for iteration in range(max_iter):
+            gradient = np.dot(X, d/m)-sums
+            curvature = np.dot(X*(d/m**2), X.T)
+            moving = (a>0.0) | (gradient>0.0)
+            if not np.any(moving):
+                self.return_code = 0
+                break
+            step = np.zeros(len(a))
+            sub = curvature[np.ix_(moving, moving)]
+            try:
+                step[moving] = np.linalg.solve(sub, gradient[moving])
+            except np.linalg.LinAlgError:
+                step[moving] = np.linalg.lstsq(sub, gradient[moving], rcond=None)[0]
+            #Newton decrement: the expected gain in log L
+            if np.dot(gradient, step)<tol:
+                self.return_code = 0
+                break
+            t = 1.0
+            while t>1e-12:
+                trial = np.maximum(a+t*step, 0.0)
+                trial_m, trial_value = evaluate(trial)
+                if trial_value>=value:
+                    break
+                t *= 0.5
+            if t<=1e-12:
+                self.return_code = 2
+                break
+            a, m, value = trial, trial_m, trial_value
+
+        amplitudes[free] = a
+        return value-self.likelihood.log_factorial, amplitudes
+
+    #Profile log L along a grid of values for component index, e.g. the box normalization,
+    #refitting the components in free at every point. Each point starts from the previous
+    #solution. Returns the log L values, the amplitudes, shape (len(values), n_components),
+    #and the return_code of each point
+    def profile_scan(self, index, values, free, amplitudes=None):
+        if amplitudes is None:
+            amplitudes = np.zeros(len(self.names))
+        amplitudes = np.array(amplitudes, dtype=float)
+        loglikes = np.zeros(len(values))
+        fitted = np.zeros((len(values), len(self.names)))
+        status = np.zeros(len(values), dtype=int)
+        for j, value in enumerate(values):
+            amplitudes[index] = value
+            loglikes[j], amplitudes = self.profile(amplitudes, free)
+            fitted[j] = amplitudes
+            status[j] = self.return_code
+        return loglikes, fitted, status
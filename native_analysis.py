@@ -0,0 +1,403 @@
+#Binned likelihood fitter in plain NumPy/SciPy, standing in for the Science Tools
+#BinnedObs/BinnedAnalysis when those are not installed (e.g. on the batch nodes)
+#The spatial templates and per-plane exposure come from an existing srcmap (made once
+#by gtsrcmaps, or by templates.py), the spectral model from the usual XML model file.
+#The subset of the BinnedAnalysis interface used by AnalyticAnalysis, ExtendedAnalysis
+#and the drivers is provided: params, par_index, freeze/thaw, like[src]['Spectrum'][par],
+#fit (with covar), scan, _srcCnts, nobs, sourceNames, syncSrcParams, writeXml and binnedData.
+#Covariances come from the observed Fisher information at the fit, computed analytically
+#from the template derivatives (fisher_information, covariance_matrices).
+#
+#Predicted counts follow the Science Tools convention: the srcmap planes sit on the
+#energy bin edges, and the counts in a bin are the log-energy trapezoid of
+#E*dN/dE(E)*sum(srcmap plane) between its edges. Spatial distributions use the lower
+#plane of each bin, as ModelCube does. Sources are then forward-folded through the
+#energy dispersion matrix of irfs.py on the analysis binning, unless their spectrum has
+#apply_edisp="false" (the galactic diffuse model, and the box, whose spectrum is folded
+#when it is written).
+import xml.etree.ElementTree as ElementTree
+import numpy as np
+from scipy.optimize import minimize
+
+from cube_reader import open_cube
+from irfs import edisp_matrix
+from model_cube import load_model_cube
+from likelihood import PoissonLikelihood, covariance_and_correlation
+
+class Parameter:
+
+    def __init__(self, source, element):
+        self.source = source
+        self.element = element
+        self.name = element.get('name')
+        self.value = float(element.get('value'))
+        self.scale = float(element.get('scale', '1'))
+        self.bounds = (float(element.get('min', '-inf')), float(element.get('max', 'inf')))
+        self.free = element.get('free', '0') == '1'
+        #pyLikelihood wraps its parameters, and callers use like.params()[k].parameter
+        self.parameter = self
+
+    def getName(self):
+        return self.name
+
+    def getValue(self):
+        return self.value
+
+    def getTrueValue(self):
+        return self.value*self.scale
+
+    def getBounds(self):
+        return self.bounds
+
+    def isFree(self):
+        return self.free
+
+    #Values outside the bounds are rejected, as in pyLikelihood
+    def setValue(self, value):
+        value = float(value)
+        if value<self.bounds[0] or value>self.bounds[1]:
+            raise ValueError("Value " + str(value) + " of " + self.source + " " + self.name + " is outside its bounds " + str(self.bounds))
+        self.value = value
+
+    #As in pyLikelihood, the current value must lie within the new bounds
+    def setBounds(self, lower, upper):
+        if self.value<lower or self.value>upper:
+            raise ValueError("Value " + str(self.value) + " of " + self.source + " " + self.name + " is outside the new bounds " + str((lower, upper)))
+        self.bounds = (float(lower), float(upper))
+
+    def setFree(self, free):
+        self.free = bool(free)
+
+class PowerLaw:
+
+    def __init__(self, parameters):
+        self.parameters = parameters
+
+    #dN/dE at energies E [MeV]
+    def __call__(self, E):
+        p = self.parameters
+        return p['Prefactor'].getTrueValue()*(E/p['Scale'].getTrueValue())**p['Index'].getTrueValue()
+
+    #d(dN/dE)/d(parameter value)
+    def derivative(self, E, name):
+        p = self.parameters
+        if name == 'Prefactor':
+            return p['Prefactor'].scale*(E/p['Scale'].getTrueValue())**p['Index'].getTrueValue()
+        if name == 'Index':
+            return self(E)*np.log(E/p['Scale'].getTrueValue())*p['Index'].scale
+        if name == 'Scale':
+            return -1.0*self(E)*p['Index'].getTrueValue()/p['Scale'].getTrueValue()*p['Scale'].scale
+        raise KeyError(name)
+
+    #d2(dN/dE)/d(value a)d(value b)
+    def second_derivative(self, E, name_a, name_b):
+        p = self.parameters
+        index = p['Index'].getTrueValue()
+        scale = p['Scale'].getTrueValue()
+        shape = (E/scale)**index
+        log_e = np.log(E/scale)
+        f = p['Prefactor'].getTrueValue()*shape
+        terms = {
+            ('Prefactor', 'Prefactor'):0.0*shape,
+            ('Index', 'Prefactor'):shape*log_e,
+            ('Index', 'Index'):f*log_e**2,
+            ('Prefactor', 'Scale'):-1.0*shape*index/scale,
+            ('Index', 'Scale'):-1.0*f*(1.0+index*log_e)/scale,
+            ('Scale', 'Scale'):f*index*(index+1.0)/scale**2}
+        return terms[tuple(sorted((name_a, name_b)))]*p[name_a].scale*p[name_b].scale
+
+#Tabulated spectrum (energy [MeV], dN/dE), interpolated linearly in log-log like the
+#Science Tools FileFunction. Like the Science Tools, the file is read once, when the model
+#is built, so an analysis has to be rebuilt to pick up a new box spectrum
+class FileFunction:
+
+    def __init__(self, parameters, filename):
+        self.parameters = parameters
+        self.filename = filename
+        table = np.loadtxt(filename)
+        self._log_energy = np.log(table[:, 0])
+        self._log_values = np.log(table[:, 1])
+
+    def shape(self, E):
+        return np.exp(np.interp(np.log(E), self._log_energy, self._log_values, left=-np.inf, right=-np.inf))
+
+    def __call__(self, E):
+        return self.parameters['Normalization'].getTrueValue()*self.shape(E)
+
+    def derivative(self, E, name):
+        if name == 'Normalization':
+            return self.parameters['Normalization'].scale*self.shape(E)
+        raise KeyError(name)
+
+    def second_derivative(self, E, name_a, name_b):
+        if name_a == 'Normalization' and name_b == 'Normalization':
+            return np.zeros(np.shape(E))
+        raise KeyError((name_a, name_b))
+
+#like[source] in pyLikelihood; only the spectrum is exposed
+class Source:
+
+    def __init__(self, name, spectrum):
+        self.name = name
+        self.spectrum = spectrum
+
+    def __getitem__(self, key):
+        if key != 'Spectrum':
+            raise KeyError("Only the 'Spectrum' of a source is available, not " + str(key))
+        return SpectrumParameters(self.spectrum)
+
+class SpectrumParameters:
+
+    def __init__(self, spectrum):
+        self.spectrum = spectrum
+
+    def __getitem__(self, name):
+        return self.spectrum.parameters[name].getValue()
+
+    def __setitem__(self, name, value):
+        self.spectrum.parameters[name].setValue(value)
+
+class CountsMap:
+
+    def __init__(self, counts):
+        self.counts = counts
+
+    def data(self):
+        return self.counts.ravel()
+
+#Stand-in for BinnedObs: the counts cube, energy binning and per-plane exposure of
+#every source are all read from the srcmap. expCube, binnedExpMap and irfs are
+#accepted for compatibility; the srcmap already has them folded in
+class NativeObs:
+
+    def __init__(self, srcMaps, expCube=None, binnedExpMap=None, irfs=None):
+        self.srcMaps = srcMaps
+        self.expCube = expCube
+        self.binnedExpMap = binnedExpMap
+        self.irfs = irfs
+        srcmap = open_cube(srcMaps)
+        self.countsMap = CountsMap(np.asarray(srcmap.counts(), dtype=float))
+        #EBOUNDS energies are in keV
+        ebounds = srcmap.hdus[srcmap.index_of('EBOUNDS')].data
+        self.energies = np.append(np.asarray(ebounds.field('E_MIN'), dtype=float), float(ebounds.field('E_MAX')[-1]))/1000.0
+
+class NativeAnalysis:
+
+    def __init__(self, binnedData, srcModel, optimizer='MINUIT'):
+        self.binnedData = binnedData
+        self.srcModel = srcModel
+        self.optimizer = optimizer
+        self.tol = 1e-3
+        self.return_code = 0
+        #pyLike.Minuit(like.logLike) in the drivers
+        self.logLike = self
+
+        self.tree = ElementTree.parse(srcModel)
+        self.sources = []
+        self._source_lookup = {}
+        self._params = []
+        self._folded = set()
+        for element in self.tree.getroot().findall('source'):
+            name = element.get('name')
+            spectrum_element = element.find('spectrum')
+            parameters = dict((p.get('name'), Parameter(name, p)) for p in spectrum_element.findall('parameter'))
+            spectrum_type = spectrum_element.get('type')
+            if spectrum_type == 'PowerLaw':
+                spectrum = PowerLaw(parameters)
+            elif spectrum_type == 'FileFunction':
+                spectrum = FileFunction(parameters, spectrum_element.get('file'))
+            else:
+                raise NotImplementedError("Spectral model " + str(spectrum_type) + " of " + name + " is not supported")
+            self.sources.append(Source(name, spectrum))
+            self._source_lookup[name] = self.sources[-1]
+            if spectrum_element.get('apply_edisp', 'true').lower() != 'false':
+                self._folded.add(name)
+            for p in spectrum_element.findall('parameter'):
+                self._params.append(parameters[p.get('name')])
+
+        self.cube = load_model_cube(binnedData.srcMaps, self.sourceNames())
+        self.data_likelihood = PoissonLikelihood(binnedData.countsMap.counts)
+        self.nobs = np.sum(binnedData.countsMap.counts.reshape(self.cube.n_ebins, -1), axis=1)
+
+        #Trapezoid weights: counts[i, e] = lower[i, e]*dN/dE(E_e)+upper[i, e]*dN/dE(E_e+1)
+        energies = binnedData.energies
+        srcmap = open_cube(binnedData.srcMaps)
+        exposure = np.array([np.sum(np.asarray(srcmap.cube(name), dtype=float).reshape(len(energies), -1), axis=1) for name in self.sourceNames()])
+        half_width = 0.5*np.diff(np.log(energies))
+        self.energies = energies
+        self.lower = half_width*energies[:-1]*exposure[:, :-1]
+        self.upper = half_width*energies[1:]*exposure[:, 1:]
+        self.edisp = edisp_matrix(energies)
+
+    def sourceNames(self):
+        return tuple(source.name for source in self.sources)
+
+    def __getitem__(self, source):
+        return self._source_lookup[source]
+
+    def params(self):
+        return self._params
+
+    def par_index(self, srcName, parName):
+        for k, p in enumerate(self._params):
+            if p.source == srcName and p.name == parName:
+                return k
+        raise KeyError("No parameter " + str(parName) + " for source " + str(srcName))
+
+    def freeze(self, k):
+        self._params[k].free = False
+
+    def thaw(self, k):
+        self._params[k].free = True
+
+    #Parameters are read directly at every evaluation, so there is nothing to propagate
+    def syncSrcParams(self, src=None):
+        pass
+
+    #Counts per energy bin of one source for dN/dE (or a derivative of it) at self.energies
+    #Folding is linear, so derivatives are folded the same way as the counts
+    def _bin_counts(self, srcName, dnde):
+        i = self.cube.index[srcName]
+        counts = self.lower[i]*dnde[:-1]+self.upper[i]*dnde[1:]
+        if srcName in self._folded:
+            counts = self.edisp.dot(counts)
+        return counts
+
+    #d(counts per bin)/d(parameter value)
+    def _counts_derivative(self, p):
+        return self._bin_counts(p.source, self._source_lookup[p.source].spectrum.derivative(self.energies, p.name))
+
+    #Predicted counts per energy bin of one source
+    def _srcCnts(self, srcName):
+        return self._bin_counts(srcName, self._source_lookup[srcName].spectrum(self.energies))
+
+    def _counts(self):
+        return np.array([self._srcCnts(name) for name in self.cube.source_names])
+
+    #-logL in the Science Tools convention, i.e. without the data-only log(d!) term
+    def __call__(self):
+        return -1.0*(self.data_likelihood.loglike(self.cube.model(self._counts()))+self.data_likelihood.log_factorial)
+
+    def value(self):
+        return self()
+
+    #-logL and its gradient with respect to the values of the parameters in free
+    def _value_and_gradient(self, free):
+        loglike, counts_gradient = self.data_likelihood.counts_gradient(self.cube, self._counts())
+        gradient = np.zeros(len(free))
+        for j, p in enumerate(free):
+            gradient[j] = np.sum(counts_gradient[self.cube.index[p.source]]*self._counts_derivative(p))
+        return -1.0*(loglike+self.data_likelihood.log_factorial), -1.0*gradient
+
+    #Expected statistical error of each parameter in free on its own, 1/sqrt(F_jj) with
+    #F_jj = sum(dm/dp_j**2/m) the diagonal of the Fisher information
+    def _parameter_errors(self, free):
+        model = self.cube.model(self._counts()).ravel()
+        positive = model>0.0
+        errors = np.zeros(len(free))
+        for j, p in enumerate(free):
+            dm = self.cube.source_model(p.source, self._counts_derivative(p)).ravel()
+            information = np.sum(dm[positive]**2/model[positive])
+            errors[j] = 1.0/np.sqrt(information) if information>0.0 else np.inf
+        return errors
+
+    #Observed Fisher information, i.e. the Hessian of -logL, of the parameters in free (all
+    #free parameters if None) at their current values. The counts derivatives are analytic
+    #and all pairs come from one pass over the pixels (PoissonLikelihood.counts_hessian)
+    def fisher_information(self, free=None):
+        if free is None:
+            free = [p for p in self._params if p.free]
+        derivatives = []
+        second = {}
+        for j, p in enumerate(free):
+            derivatives.append((self.cube.index[p.source], self._counts_derivative(p)))
+            spectrum = self._source_lookup[p.source].spectrum
+            for k in range(j+1):
+                if free[k].source == p.source:
+                    second[(k, j)] = self._bin_counts(p.source, spectrum.second_derivative(self.energies, free[k].name, p.name))
+        return self.data_likelihood.counts_hessian(self.cube, self._counts(), derivatives, second)
+
+    #Covariance and correlation matrices of the parameters in free (all free parameters if
+    #None), from the inverse Fisher information at the current values, e.g. the best fit
+    def covariance_matrices(self, free=None):
+        return covariance_and_correlation(self.fisher_information(free))
+
+    #Maximize the likelihood over the free parameters with bounded L-BFGS, using
+    #analytic gradients. Each parameter is measured in units of its expected error, so
+    #the optimizer sees numbers of order one even for a box normalization starting at 0.
+    #Returns -logL at the optimum.
+    #covar=True leaves the covariance matrix of the free parameters, in the order of
+    #params(), in self.covariance as the Science Tools do
+    #optObject and optimizer are accepted for compatibility
+    def fit(self, verbosity=3, tol=None, optimizer=None, covar=False, optObject=None):
+        if tol is None:
+            tol = self.tol
+        free = [p for p in self._params if p.free]
+        if len(free)>0:
+            start = np.array([p.value for p in free])
+            scales = self._parameter_errors(free)
+            fallback = np.where(start != 0.0, np.abs(start), 1.0)
+            scales = np.where(np.isfinite(scales), scales, fallback)
+            bounds = [(p.bounds[0]/s, p.bounds[1]/s) for p, s in zip(free, scales)]
+
+            def objective(x):
+                for p, value in zip(free, x*scales):
+                    p.value = float(np.clip(value, p.bounds[0], p.bounds[1]))
+                value, gradient = self._value_and_gradient(free)
+                return value, gradient*scales
+
+            #tol is the estimated distance to the minimum in -logL, as for MINUIT. In units of
+            #the parameter errors that is about half the squared gradient; prefactors and
+            #indices are strongly correlated, so the gradient is pushed well below that
+            result = minimize(objective, start/scales, jac=True, method='L-BFGS-B', bounds=bounds, options={'ftol':1e-15, 'gtol':1e-3*np.sqrt(2.0*tol), 'maxiter':10000})
+            objective(result.x)
+            self.return_code = 0 if result.success else int(result.status)
+            if verbosity>0:
+                print(result.message)
+            if covar:
+                self.covariance = self.covariance_matrices(free)[0].tolist()
+        if optObject is not None:
+            optObject.return_code = self.return_code
+        return self()
+
+    def optimize(self, verbosity=3, tol=None, optimizer=None):
+        return self.fit(verbosity=verbosity, tol=tol, optimizer=optimizer)
+
+    #Profile -logL over npts values of one parameter, refitting the other free
+    #parameters at each value. The parameter's value and free flag are restored
+    def scan(self, srcName, parName, xmin, xmax, npts=20, tol=None, verbosity=0):
+        k = self.par_index(srcName, parName)
+        p = self._params[k]
+        saved = (p.value, p.free)
+        saved_values = [q.value for q in self._params]
+        p.free = False
+        xvals = np.linspace(xmin, xmax, npts)
+        values = np.zeros(npts)
+        for j, x in enumerate(xvals):
+            p.setValue(x)
+            values[j] = self.fit(verbosity=verbosity, tol=tol)
+        for q, value in zip(self._params, saved_values):
+            q.value = value
+        p.value, p.free = saved
+        return xvals, values
+
+    #Model file with the current values, bounds and free flags
+    def writeXml(self, xmlFile=None):
+        if xmlFile is None:
+            xmlFile = self.srcModel
+        for p in self._params:
+            p.element.set('value', repr(p.value))
+            p.element.set('min', repr(p.bounds[0]))
+            p.element.set('max', repr(p.bounds[1]))
+            p.element.set('free', '1' if p.free else '0')
+        self.tree.write(xmlFile)
+
+#pyLike.Minuit(like.logLike) stand-in; the native fitter does its own minimization
+class Minuit:
+
+    def __init__(self, logLike):
+        self.logLike = logLike
+        self.return_code = 0
+
+    def getRetCode(self):
+        return self.return_code
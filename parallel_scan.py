@@ -0,0 +1,83 @@
+#Parallel scans over box edge energies
+#The fits at different edge indices are independent, so they are spread over a process
+#pool. Every worker builds its own analysis state once and works in a private scratch
+#directory: box_spectrum.dat, rewritten XML models and the other scratch files of one
+#worker never clobber another's. Results are returned in the order of the indices,
+#whatever order the workers finish in, so the arrays filled from them are the same as
+#for a serial loop.
+#setup and evaluate must be module-level functions, so the pool can send them to workers
+import os
+import shutil
+import tempfile
+import numpy as np
+from multiprocessing import Pool, cpu_count
+
+#State of the current worker process
+_worker = {}
+
+#Place a relative path from the parent's working directory into the scratch directory
+#(absolute paths resolve the same from anywhere and are left alone)
+def _place(filename, scratch, link):
+    if os.path.isabs(filename):
+        return
+    target = os.path.join(scratch, filename)
+    if not os.path.isdir(os.path.dirname(target)):
+        os.makedirs(os.path.dirname(target))
+    if link:
+        os.symlink(os.path.abspath(filename), target)
+    else:
+        shutil.copy2(filename, target)
+
+#Runs once in each worker: make the scratch directory, copy the files the scan rewrites
+#(copies), link the read-only inputs (links), move there and build the state
+#Without a root the worker stays in the parent's working directory
+def _initialize(root, files, links, setup, setup_args):
+    if root is not None:
+        scratch = tempfile.mkdtemp(dir=root)
+        for filename in files:
+            _place(filename, scratch, False)
+        for filename in links:
+            _place(filename, scratch, True)
+        os.chdir(scratch)
+    #Forked workers inherit the parent's random state; reseed so that fluctuations drawn
+    #in different workers (MC studies) are independent
+    np.random.seed()
+    _worker['state'] = setup(*setup_args)
+
+def _evaluate(task):
+    evaluate, index = task
+    return index, evaluate(_worker['state'], index)
+
+#Evaluate evaluate(state, index) for every index, with state = setup(*setup_args) built
+#once per worker
+#files: paths (relative to the working directory) the scan writes to, e.g. xmlmodel.xml
+#and box_spectrum.dat; every worker gets its own copy
+#links: large read-only inputs (srcmaps, exposure and livetime cubes), linked not copied
+#processes: number of workers, all cores if None; 1 runs serially in this process
+#scratch=False keeps the workers in the working directory, for scans that write nothing
+#indices may be any hashable tasks, e.g. (zeta, edge index) pairs
+#Where workers are forked (Linux) setup_args reach them without pickling, so they may hold
+#analysis objects
+#Returns the list of results in the order of indices
+def edge_scan(setup, evaluate, indices, setup_args=(), files=(), links=(), processes=None, scratch=True):
+    indices = list(indices)
+    if processes is None:
+        processes = cpu_count()
+    processes = max(1, min(processes, len(indices)))
+    if processes == 1:
+        state = setup(*setup_args)
+        return [evaluate(state, index) for index in indices]
+
+    root = tempfile.mkdtemp(prefix='edge_scan_', dir=os.getcwd()) if scratch else None
+    pool = Pool(processes, _initialize, (root, list(files), list(links), setup, setup_args))
+    try:
+        results = dict(pool.imap_unordered(_evaluate, [(evaluate, index) for index in indices]))
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        if root is not None:
+            shutil.rmtree(root, ignore_errors=True)
+    return [results[index] for index in indices]
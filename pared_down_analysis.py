@@ -4,7 +4,12 @@ import warnings
 warnings.filterwarnings("ignore")
 import math
 import numpy as np
-from BinnedAnalysis import *
+try:
+    from BinnedAnalysis import *
+except ImportError:
+    #No Science Tools: fall back on the NumPy fitter (see native_analysis.py)
+    from native_analysis import NativeObs as BinnedObs, NativeAnalysis as BinnedAnalysis
+    import native_analysis as pyLike
 
 #pfrom scipy.special import gammainc, erf, gamma
 from math import sin, cos, asin, acos, radians
@@ -15,6 +20,16 @@ from scipy.signal import savgol_filter
 from operator import add
 import pickle
 
+from irfs import e_res, psf, folding_matrix, edisp_matrix
+from spectra import box_width, folded_box_spectra, binned_box_spectra, write_spectrum
+from counts import binned_counts
+from cube_reader import open_cube
+from template_bank import TemplateBank, build_template_bank
+from model_cube import load_model_cube, IncrementalModel
+from likelihood import correlation_matrix
+from parallel_scan import edge_scan
+from profile_store import ProfileStore
+
 #Fermi Science Tools
 #from SummedLikelihood import *
 
@@ -56,43 +71,38 @@ class ExtendedAnalysis(BinnedAnalysis):
         self[source_name]['Spectrum'][parameter_name] = new_value
         #self.fit(verbosity=0)
 
+    #Correlations of the free parameters from the covariance left by fit(covar=True)
     def calculateCorrelationMatrix(self):
-        correlation = np.zeros((np.array(self.covariance).shape))
-        for a in np.array(self.covariance).shape[0]:
-            for b in np.array(self.covariance).shape[1]:
-                correlation[a,b] = self.covariance[a][b]/np.sqrt(float(self.covariance[a][a])*float(self.covariance[b][b]))
-        self.correlation = correlation
+        self.correlation = correlation_matrix(self.covariance)
+        return self.correlation
 
     def getCorrelationMatrix(self):
         return self.correlation
 
+    #Fixed background plus linear components, for fast scans of normalization-like parameters
+    #varying: (source, parameter) pairs the source counts are proportional to, e.g.
+    #[('Box_Component', 'Normalization'), ('Disk Component', 'Prefactor')]
+    #The amplitudes of the returned IncrementalModel are values of those parameters
+    def incrementalModel(self, varying):
+        cube = load_model_cube(self.binnedData.srcMaps, self.sourceNames())
+        background = dict((source, self._srcCnts(source)) for source in self.sourceNames())
+        components = []
+        for source, parameter in varying:
+            current_value = self[source]['Spectrum'][parameter]
+            reference = current_value if current_value != 0.0 else 1.0
+            self.edit_parameter(source, parameter, reference)
+            components.append((source, self._srcCnts(source)/reference))
+            self.edit_parameter(source, parameter, current_value)
+            background[source] = np.zeros(len(background[source]))
+        actual_data = np.array(self.binnedData.countsMap.data()).reshape(cube.shape)
+        return IncrementalModel(cube, background, components, actual_data)
+
     def getSpectrum(self):
         spectrum = np.zeros((num_ebins-1))
         for source in self.sourceNames():
             spectrum += self._srcCnts(source)
         return spectrum
 
-#Energy resolution (E Disp class 1- pretty close to the total)
-def e_res(E):
-    energy = np.array([31.718504,54.31288,95.86265,171.82704,307.93054,535.1251,944.0604,1716.8848,3074.5315,5339.1763,9559.056,17111.936,29704.664,53986.227,93706.14,167702.28,300152.7,520977.8,931974.8,1690808.0,2974747.2])
-    res = np.array([0.2942218,0.25078142,0.21741302,0.1813951,0.15067752,0.12313887,0.10302135,0.090325624,0.08080946,0.07341215,0.07025641,0.070810914,0.07454435,0.080399856,0.08678346,0.094758466,0.10061333,0.10752697,0.25969607,0.18390165,0.24169934])
-    closest = np.argmin(np.abs(E-energy))
-    if E-energy[closest]>0.:
-        frac = (E-energy[closest])/(energy[closest+1]-energy[closest])
-        return res[closest]+frac*(res[closest+1]-res[closest])
-    else:
-        frac = (E-energy[closest-1])/(energy[closest]-energy[closest-1])
-        return res[closest-1]+frac*(res[closest]-res[closest-1])
-def psf(E):
-    energy = np.array([9.91152,17.36871,31.150045,54.59528,96.42895,171.62605,303.14316,539.58026,967.85913,1709.5619,3066.256,5374.1895,9712.058,17151.041,29366.348,52649.074,92947.98,167911.25,298723.0,527422.3,952855.0,1682382.6,2993103.8])
-    psf = np.array([22.122343,17.216175,11.960119,8.108732,5.279108,3.5216076,2.2375877,1.3988715,0.8535155,0.53358656,0.347393,0.23173566,0.17039458,0.12837319,0.112826064,0.10581638,0.10334797,0.10426899,0.10101496,0.09097172,0.08671612,0.07683781,0.073241934])
-    closest = np.argmin(np.abs(E-energy))
-    if E-energy[closest]>0.:
-        frac = (E-energy[closest])/(energy[closest+1]-energy[closest])
-        return psf[closest]+frac*(psf[closest+1]-psf[closest])
-    else:
-        frac = (E-energy[closest-1])/(energy[closest]-energy[closest-1])
-        return psf[closest-1]+frac*(psf[closest]-psf[closest-1])
 #Just a gaussian function, representing the energy dispersion of the detector
 def blur(x,offset,sigma):
     return np.exp(-1.0*(x-offset)**2/(2*sigma**2))/np.sqrt(2*np.pi*sigma**2)
@@ -103,47 +113,46 @@ def get_integral(x,g):
         print("Length of x is " + str(len(x)) + " Length of g is " + str(len(g)))
     return sum(np.diff(x)*0.5*(g[0:len(g)-1]+g[1:len(g)]))
 
-def update_box_spectrum(energy, zeta):
-    box_width = energy*2.0*np.sqrt(1.0-zeta)/(1+np.sqrt(1.0-zeta))
-    box_beginning = energy-box_width
-    #Edit box_spectrum.dat
-    spectrum_file = open('box_spectrum.dat','w')
-    #What's the normalization constant here?
-    #Total flux is E_edge*function value
-    #Function_value = total_flux/E_edge
-    x_fine_grid = np.linspace(0.0, 800000, 10000)
-    n_leading_zeros = int(np.argmin(np.abs(x_fine_grid-box_beginning)))
-    n_trailing_zeros = 10000-int(np.argmin(np.abs(x_fine_grid-energy)))
-    n_box_width = int(10000-n_leading_zeros-n_trailing_zeros)
-    pure_box = np.concatenate([np.zeros((n_leading_zeros)),np.concatenate([1.0+np.zeros((n_box_width)),np.zeros((n_trailing_zeros))])])
-
-    #Sigma here is the absolute energy resolution as a function of energy
-    sigma = e_res(energy)*energy*10000./800000.0
-
-    dispersion = blur(np.linspace(0,6*sigma,6*sigma),3*sigma,sigma)
-    convolved_pure_box = np.convolve(pure_box, dispersion,'same')
-    integrated_box_flux = get_integral(x_fine_grid, convolved_pure_box)
-    for i in range(len(x_fine_grid)):
-        spectrum_file.write(str(x_fine_grid[i])+" " + str(max(convolved_pure_box[i]/integrated_box_flux, 10.**-35))+"\n")
-    spectrum_file.close()
-
-    return box_width, integrated_box_flux
+def update_box_spectrum(energy, zeta, bank=None):
+    #Precomputed templates are used when a bank is given (see template_bank.py)
+    if bank is not None:
+        z, e = bank.locate_energy(energy, zeta)
+        bank.link_spectrum('box_spectrum.dat', bank.edge_indices[e], zeta)
+        return box_width(energy, zeta), float(bank.flux[z, e])
+
+    #Unsmeared box forward-folded through the energy dispersion matrix (see spectra.py)
+    matrix, fold_edges = folding_matrix(energies)
+    spectrum, grid, integrated_box_flux = folded_box_spectra(matrix, fold_edges, fold_edges, energy, zeta)
+    write_spectrum('box_spectrum.dat', grid, spectrum[0, 0])
+
+    return box_width(energy, zeta), integrated_box_flux[0, 0]
+
+#Expected counts per energy bin of the box with upper edge energies[index] for unit flux in
+#its folded spectrum, from the box exposure at each energy plane (the sums of its srcmap
+#planes). Computed from the spectrum rather than an analysis, so no model has to be rebuilt
+def box_counts(index, zeta, box_exposure, bank=None):
+    if bank is not None:
+        return bank.binned_counts(index, zeta, box_exposure)
+    matrix, fold_edges = folding_matrix(energies)
+    binned = binned_box_spectra(edisp_matrix(energies, fold_edges), matrix, fold_edges, energies[index], zeta)
+    return binned_counts(binned[0, 0], box_exposure)
 
 num_ebins = 51 #1 more than the number of bins due to the fencepost problem
 energies = 10**np.linspace(np.log10(6000),np.log10(800000),num_ebins)
 ebin_widths = np.diff(energies)
 
-def likelihood_upper_limit3(zeta, sourcemap):
-    scale_factor = 1e-15
-    min_box_flux = 0.0
-    max_box_flux = 10**-9/scale_factor
-
-    crit_chi2 = 2.71 #For 95% confidence one-sided upper limit with 1 degree of freedom
-    scan_resolution = 200
+#Precompute the box templates for every edge energy and zeta of the scans
+#Load the result with load_box_bank(path) and pass it to likelihood_upper_limit3
+def make_box_bank(path='dataFiles/box_bank', zetas=[0.0, 0.44, 0.85, 0.99, 0.9999]):
+    return build_template_bank(path, np.arange(6,48), zetas, energies)
 
-    #Arrays to store results in
-    box_flux = np.zeros((num_ebins-1, scan_resolution))
+#Raises ValueError if the bank was built for another binning or e_res table
+def load_box_bank(path='dataFiles/box_bank'):
+    return TemplateBank(path, energies)
 
+#Analysis state of an edge scan, built once per worker (see parallel_scan.py): the data,
+#the background fit without a box and the cached templates the profiles are solved on
+def scan_setup(zeta, sourcemap, bank=None):
     #Instantiate the analysis objects
     print("Loading data...")
     obs_complete = BinnedObs(srcMaps=sourcemap, expCube='GC_binned_ltcube.fits', binnedExpMap='GC_binned_expcube.fits', irfs='P8R2_SOURCE_V6')
@@ -156,20 +165,45 @@ def likelihood_upper_limit3(zeta, sourcemap):
     loglike = like.fit(verbosity=0, optObject=likeobj, covar=False)
     like.freeze_all_sources()
     print('LogLike = ' + str(loglike))
+    #Allow the GC Center to float along with the box. Both enter the model linearly and
+    #everything else is frozen, so the profile is solved on the cached templates
+    #(see IncrementalModel.profile) instead of refitting at every point
+    box_model = like.incrementalModel([('Box_Component', 'Normalization'), ('Disk Component', 'Prefactor')])
+    #Box exposure at each energy plane, for the box counts of each edge (see box_counts)
+    planes = np.asarray(open_cube(sourcemap).cube('Box_Component'), dtype=float)
+    box_exposure = np.sum(planes.reshape(len(planes), -1), axis=1)
+    return {'box_model':box_model, 'box_exposure':box_exposure, 'prefactor':like['Disk Component']['Spectrum']['Prefactor'], 'zeta':zeta, 'bank':bank}
+
+#-logL profile along the box flux grid for the box with upper edge energies[index]
+#Returns the grid, the profile, the fitted GC prefactor and the fit status at each point
+def scan_edge(state, index, min_box_flux=0.0, max_box_flux=10**-9/1e-15, scan_resolution=200):
+    box_model = state['box_model']
+    print("Evaluating box with upper edge " + str(energies[index]) + " MeV in bin " + str(index))
+    #The analysis of scan_setup keeps the box spectrum it was built with, so only the box
+    #counts of the model change, computed from the folded spectrum
+    box_model.update_component('Box_Component', 1e-15*box_counts(index, state['zeta'], state['box_exposure'], state['bank']))
+
+    print("Scanning likelihood...")
+    #Scan the likelihood profile to find best-fit value and upper limit
+    x_range = np.linspace(min_box_flux, max_box_flux, scan_resolution)
+    loglikes, amplitudes, status = box_model.profile_scan(0, x_range, [1], [0.0, state['prefactor']])
+    #-logL without the data-only log(d!) term, as like.scan returned it
+    return x_range, -1.0*(loglikes+box_model.likelihood.log_factorial), amplitudes[:, 1:], status
+
+#processes: number of worker processes for the edges, all cores if None
+#store: ProfileStore the full profiles are appended to, with the flux grid (in units of
+#the scale factor), fitted GC prefactor and fit status, for limits derived later
+def likelihood_upper_limit3(zeta, sourcemap, bank=None, processes=1, store=None):
     #Loop through upper edge of box
-    for index in range(6,48):
-        print("Evaluating box with upper edge " + str(energies[index]) + " MeV in bin " + str(index))
-        #Update the box spectrum
-        box_width, integrated_box_flux = update_box_spectrum(energies[index], zeta)
-
-        #Allow the GC Center to float along with the box
-        like.thaw(like.par_index('Disk Component','Prefactor'))
-        print("Scanning likelihood...")
-        #Scan the likelihood profile to find best-fit value and upper limit
-        x_range, l_range = like.scan('Box_Component', 'Normalization', min_box_flux, max_box_flux, scan_resolution)
-
-        #Results
+    indices = range(6,48)
+    profiles = edge_scan(scan_setup, scan_edge, indices, (zeta, sourcemap, bank), files=['xmlmodel.xml', 'box_spectrum.dat'], links=[sourcemap, 'GC_binned_ltcube.fits', 'GC_binned_expcube.fits'], processes=processes)
+
+    #Arrays to store results in
+    box_flux = np.zeros((num_ebins-1, len(profiles[0][0])))
+    for index, (x_range, l_range, prefactor, status) in zip(indices, profiles):
         box_flux[index, :] = l_range #Flux upper limit
+        if store is not None:
+            store.append(zeta, index, x_range, l_range, prefactor, status)
     return box_flux
 
 def consolidate_brazil_lines(filename):
@@ -184,19 +218,17 @@ def consolidate_brazil_lines(filename):
     print(str(i) + " MC events")
     return brazil_dict
 
-def UL_from_TS(ts):
-    crit_chi2 = 5.0
-    ul = np.zeros((ts.shape[0]))
-    for i in range(len(ts)):
-        ul[i] = np.argmin(ts[i,:]-crit_chi2)
-    return ul
-
+#Profile store of the scans, created on first use
+def open_profile_store(path='profiles', scan_resolution=200):
+    return ProfileStore(path, scan_resolution, ['Disk Component Prefactor'])
 
 def main():
     sourcemap = 'GC_binned_srcmap.fits'
-    z99 = likelihood_upper_limit3(0.9999, sourcemap)
+    store = open_profile_store()
+    z99 = likelihood_upper_limit3(0.9999, sourcemap, processes=None, store=store)
     print(z99[20,:])
-    plt.plot(energies[:-1], UL_from_TS(z99))
+    #Limits are interpolated from the stored profiles; other confidence levels need no refit
+    plt.plot(energies[:-1], store.upper_limits(0.9999, num_ebins-1)*1e-15)
     plt.xscale('log')
     plt.yscale('log')
     plt.show()
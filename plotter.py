@@ -23,6 +23,9 @@ from astropy.coordinates import SkyCoord
 from astropy.table import Table
 from scipy.signal import convolve2d
 
+from model_cube import load_model_cube
+from profile_store import load_limits
+
 #from upper_limit import AnalyticAnalysis
 
 gc_l = 359.94425518526566
@@ -190,32 +193,30 @@ def spectralPlot():
     #plt.show()
     plt.savefig('plots/good_box_fit.pdf', bbox_inches='tight')
 
-def correlationPlot():
-    fig = plt.figure(figsize=[7,7])
-    ax = fig.add_subplot(111)
-
-    file = open('plotsData/wideBoxCorrelations.npy','rb')
-    correlation1 = np.load(file, encoding='latin1')
-    file.close()
-
-    file = open('plotsData/narrowBoxCorrelations.npy','rb')
-    correlation2 = np.load(file, encoding='latin1')
-    file.close()
+#Correlation coefficients of the box with the GC (Disk Component) prefactor and index and
+#with the diffuse emission prefactor, against the box upper edge, for every zeta saved
+#in path by the edge scans (see profile_store.save_limits)
+def correlationPlot(path='plotsData/limits'):
+    limits = load_limits(path)
     num_ebins = 51
     energies = 10**np.linspace(np.log10(6000),np.log10(800000),num_ebins)
-
-    plt.plot(energies[6:48], correlation1[:,0][6:48], linewidth=2.0, color='blue', label='$\zeta=0.44$')
-    plt.plot(energies[6:48], correlation2[:,0][6:48], linewidth=2.0, color='red', label='$\zeta=0.9999$')
-    plt.axhline(0.0, color='black', linestyle='--', linewidth=0.5)
-    plt.xscale('log')
-    plt.ylim([-1.0, 0.1])
-    plt.xlim([energies[6], energies[47]])
-    plt.ylabel('Correlation Coefficient')
-    plt.xlabel('Box Upper Edge [MeV]')
+    panels = [(('Disk Component', 'Prefactor'), 'GC Prefactor'), (('Disk Component', 'Index'), 'GC Index'), (('gll_iem_v05', 'Prefactor'), 'Diffuse Prefactor')]
+
+    fig, axes = plt.subplots(len(panels), 1, sharex=True, figsize=[7,14])
+    for ax, (key, title) in zip(axes, panels):
+        for zeta in sorted(limits):
+            column = limits[zeta]['names'].index(key)
+            ax.plot(energies[6:48], limits[zeta]['correlations'][:,column][6:48], linewidth=2.0, color=plt.cm.rainbow(zeta**2), label='$\zeta='+str(zeta)+'$')
+        ax.axhline(0.0, color='black', linestyle='--', linewidth=0.5)
+        ax.set_xscale('log')
+        ax.set_ylim([-1.0, 1.0])
+        ax.set_xlim([energies[6], energies[47]])
+        ax.set_ylabel('Box vs ' + title)
+        ax.grid(True)
+    axes[-1].set_xlabel('Box Upper Edge [MeV]')
     rcParams['legend.fontsize'] = 16
 
-    plt.legend()
-    plt.grid(True)
+    axes[0].legend()
     plt.savefig('plots/correlation_coefficients.pdf',bbox_inches='tight')
     #plt.show()
 
@@ -223,18 +224,11 @@ def residmapComparison():
     """
     Making Figure 2 in the paper (comparing the residuals between the GC point source model and GC extended source model)
     """
-    srcmap001 = fits.open('dataFiles/6gev_srcmap_001.fits')
-    srcmap03 = fits.open('dataFiles/6gev_srcmap_03.fits')
-
     image_data = fits.getdata('dataFiles/6gev_image.fits')
     filename = get_pkg_data_filename('dataFiles/6gev_image.fits')
     hdu = fits.open(filename)[0]
     wcs = WCS(hdu.header)
 
-    #Given the results of the fit, calculate the model
-    modelData001 = np.zeros(srcmap001[0].shape)
-    modelData03 = np.zeros(srcmap03[0].shape)
-
     file = open('plotsData/fitResults001.pk1','rb')
     fit001 = pickle.load(file)
     fit001 = listToArray(fit001)
@@ -245,14 +239,9 @@ def residmapComparison():
     fit03 = listToArray(fit03)
     file.close()
 
-
-    for source in fit001:
-        the_index = srcmap001.index_of(source)
-
-        modelData001 += fit001[source][:, None, None]*srcmap001[the_index].data[:-1, :, :]/np.sum(np.sum(srcmap001[the_index].data, axis=2), axis=1)[:-1, None, None]
-    for source in fit03:
-        the_index = srcmap03.index_of(source)
-        modelData03 += fit03[source][:, None, None]*srcmap03[the_index].data[:-1, :, :]/np.sum(np.sum(srcmap03[the_index].data, axis=2), axis=1)[:-1, None, None]
+    #Given the results of the fit, calculate the model
+    modelData001 = load_model_cube('dataFiles/6gev_srcmap_001.fits', list(fit001.keys())).model(fit001)
+    modelData03 = load_model_cube('dataFiles/6gev_srcmap_03.fits', list(fit03.keys())).model(fit03)
 
     fig = plt.figure(figsize=[12, 4.5])
 
@@ -291,18 +280,11 @@ def dataModel():
     """
     Making Figure 1 in the paper (Data versus model)
     """
-    srcmap001 = fits.open('dataFiles/6gev_srcmap_001.fits')
-    srcmap03 = fits.open('dataFiles/6gev_srcmap_03.fits')
-
     image_data = fits.getdata('dataFiles/6gev_image.fits')
     filename = get_pkg_data_filename('dataFiles/6gev_image.fits')
     hdu = fits.open(filename)[0]
     wcs = WCS(hdu.header)
 
-    #Given the results of the fit, calculate the model
-    modelData001 = np.zeros(srcmap001[0].shape)
-    modelData03 = np.zeros(srcmap03[0].shape)
-
     file = open('plotsData/fitResults001.pk1','rb')
     fit001 = pickle.load(file)
     fit001 = listToArray(fit001)
@@ -313,14 +295,9 @@ def dataModel():
     fit03 = listToArray(fit03)
     file.close()
 
-
-    for source in fit001:
-        the_index = srcmap001.index_of(source)
-
-        modelData001 += fit001[source][:, None, None]*srcmap001[the_index].data[:-1, :, :]/np.sum(np.sum(srcmap001[the_index].data, axis=2), axis=1)[:-1, None, None]
-    for source in fit03:
-        the_index = srcmap03.index_of(source)
-        modelData03 += fit03[source][:, None, None]*srcmap03[the_index].data[:-1, :, :]/np.sum(np.sum(srcmap03[the_index].data, axis=2), axis=1)[:-1, None, None]
+    #Given the results of the fit, calculate the model
+    modelData001 = load_model_cube('dataFiles/6gev_srcmap_001.fits', list(fit001.keys())).model(fit001)
+    modelData03 = load_model_cube('dataFiles/6gev_srcmap_03.fits', list(fit03.keys())).model(fit03)
 
     fig = plt.figure(figsize=[12, 4.5])
 
@@ -0,0 +1,176 @@
+#Appendable, columnar store of likelihood profiles
+#Every scan of the box flux at one (zeta, edge) is a row. Each column is a flat binary file
+#that rows are appended to, so a long MC run can add its scans as it goes and readers
+#memory-map only the columns they need. Limits at any confidence level, best fits and TS
+#are re-derived from the stored profiles by interpolation, without refitting.
+#Layout of a store directory:
+#   columns.json   dtype and per-row shape of every column, and the nuisance parameter names
+#   zeta.bin       (n_rows,) zeta of the box
+#   edge.bin       (n_rows,) edge index into the energy binning
+#   flux.bin       (n_rows, n_points) box flux grid of the scan, starting at the null value
+#   loglike.bin    (n_rows, n_points) -logL along the grid
+#   nuisance.bin   (n_rows, n_points, n_nuisance) fitted nuisance parameters at each point
+#   status.bin     (n_rows, n_points) fit status at each point, 0 for a converged fit
+#The limits found directly by an edge scan, with the correlations of the box with the
+#nuisance parameters from the same fits, are kept per zeta by save_limits/load_limits.
+import os
+import json
+import numpy as np
+from scipy.stats import chi2
+
+class ProfileStore:
+
+    #n_points and nuisance_names are needed only to create a new store
+    def __init__(self, path, n_points=None, nuisance_names=()):
+        self.path = path
+        meta_file = os.path.join(path, 'columns.json')
+        if os.path.exists(meta_file):
+            file = open(meta_file, 'r')
+            meta = json.load(file)
+            file.close()
+        else:
+            if n_points is None:
+                raise ValueError("n_points is needed to create the profile store " + str(path))
+            n_nuisance = len(nuisance_names)
+            meta = {
+                'nuisance_names':list(nuisance_names),
+                'columns':{
+                    'zeta':['float64', []],
+                    'edge':['int64', []],
+                    'flux':['float64', [n_points]],
+                    'loglike':['float64', [n_points]],
+                    'nuisance':['float64', [n_points, n_nuisance]],
+                    'status':['int32', [n_points]]}}
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            file = open(meta_file, 'w')
+            json.dump(meta, file)
+            file.close()
+        self.nuisance_names = meta['nuisance_names']
+        self.columns = dict((name, (np.dtype(str(dtype)), tuple(shape))) for name, (dtype, shape) in meta['columns'].items())
+        self.n_points = self.columns['flux'][1][0]
+
+    def _filename(self, column):
+        return os.path.join(self.path, column + '.bin')
+
+    def __len__(self):
+        dtype, shape = self.columns['zeta']
+        filename = self._filename('zeta')
+        if not os.path.exists(filename):
+            return 0
+        return os.path.getsize(filename)//dtype.itemsize
+
+    #Add one scan. nuisance: (n_points, n_nuisance) fitted values, status: (n_points,)
+    #Columns are written one after the other, the row count comes from the zeta column,
+    #written last, so readers never see a partial row
+    def append(self, zeta, edge, flux, loglike, nuisance=None, status=None):
+        values = {'zeta':zeta, 'edge':edge, 'flux':flux, 'loglike':loglike,
+                  'nuisance':np.zeros(self.columns['nuisance'][1]) if nuisance is None else nuisance,
+                  'status':np.zeros(self.n_points) if status is None else status}
+        for name in ['edge', 'flux', 'loglike', 'nuisance', 'status', 'zeta']:
+            dtype, shape = self.columns[name]
+            value = np.asarray(values[name], dtype=dtype)
+            if value.shape != shape:
+                raise ValueError("Column " + name + " expects shape " + str(shape) + ", not " + str(value.shape))
+            file = open(self._filename(name), 'ab')
+            file.write(value.tobytes())
+            file.close()
+
+    #Memory-mapped column, shape (n_rows,)+row shape
+    def column(self, name):
+        dtype, shape = self.columns[name]
+        n_rows = len(self)
+        if n_rows == 0:
+            return np.zeros((0,)+shape, dtype=dtype)
+        return np.memmap(self._filename(name), dtype=dtype, mode='r', shape=(n_rows,)+shape)
+
+    #Indices of the rows for zeta and/or edge (all rows if both are None)
+    #If a scan was stored more than once, the last one is kept
+    def select(self, zeta=None, edge=None):
+        keep = np.ones(len(self), dtype=bool)
+        if zeta is not None:
+            keep &= np.isclose(self.column('zeta'), zeta, rtol=0.0, atol=1e-12)
+        if edge is not None:
+            keep &= np.asarray(self.column('edge')) == edge
+        rows = np.nonzero(keep)[0]
+        keys = np.array([self.column('zeta')[rows], self.column('edge')[rows]]).T
+        last = {}
+        for row, key in zip(rows, map(tuple, keys)):
+            last[key] = row
+        return np.array(sorted(last.values()), dtype=int)
+
+    #Best fit, minimum -logL, TS and upper limit of every row in rows (all rows if None)
+    #cl: one-sided confidence level of the limit (0.95 gives 2 delta logL = 2.71)
+    #The minimum is refined with a parabola through the lowest grid point and its
+    #neighbours, the limit by linear interpolation of the crossing above it (nan if the
+    #profile never rises that far on the grid). TS is measured against the first grid point
+    #Returns a dict of arrays
+    def limits(self, rows=None, cl=0.95):
+        if rows is None:
+            rows = self.select()
+        flux = np.asarray(self.column('flux'))[rows]
+        loglike = np.asarray(self.column('loglike'))[rows]
+        n_rows, n_points = loglike.shape
+        r = np.arange(n_rows)
+
+        #Parabolic minimum, y = y0+d1*(x-x0)+a*(x-x0)*(x-x1) through the lowest point and
+        #its neighbours
+        i = np.argmin(loglike, axis=1)
+        j = np.clip(i, 1, n_points-2)
+        x0, x1, x2 = flux[r, j-1], flux[r, j], flux[r, j+1]
+        y0, y1, y2 = loglike[r, j-1], loglike[r, j], loglike[r, j+1]
+        d1 = (y1-y0)/(x1-x0)
+        a = ((y2-y1)/(x2-x1)-d1)/(x2-x0)
+        interior = (i == j) & (a>0.0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            vertex = np.clip(0.5*(x0+x1)-0.5*d1/a, x0, x2)
+        best_fit = np.where(interior, vertex, flux[r, i])
+        min_loglike = np.where(interior, y0+d1*(best_fit-x0)+a*(best_fit-x0)*(best_fit-x1), loglike[r, i])
+        min_loglike = np.minimum(min_loglike, loglike[r, i])
+
+        #First crossing of min + delta above the best fit
+        delta = 0.5*chi2.ppf(2.0*cl-1.0, 1)
+        above = (loglike-min_loglike[:, None]>=delta) & (np.arange(n_points)[None, :]>i[:, None])
+        found = np.any(above, axis=1)
+        k = np.where(found, np.argmax(above, axis=1), 1)
+        xa, xb = flux[r, k-1], flux[r, k]
+        ya, yb = loglike[r, k-1]-min_loglike, loglike[r, k]-min_loglike
+        with np.errstate(divide='ignore', invalid='ignore'):
+            upper_limit = np.where(found, xa+(delta-ya)*(xb-xa)/(yb-ya), np.nan)
+
+        return {'zeta':np.asarray(self.column('zeta'))[rows], 'edge':np.asarray(self.column('edge'))[rows],
+                'best_fit':best_fit, 'min_loglike':min_loglike,
+                'ts':2.0*(loglike[:, 0]-min_loglike), 'upper_limit':upper_limit}
+
+    #Upper limits of one zeta laid out by edge index, shape (n_edges,), nan where not scanned
+    def upper_limits(self, zeta, n_edges, cl=0.95):
+        result = self.limits(self.select(zeta=zeta), cl)
+        limits = np.nan*np.ones(n_edges)
+        limits[result['edge']] = result['upper_limit']
+        return limits
+
+#Limits and box correlations of an edge scan at one zeta, saved together in
+#path/zeta_<zeta>.npz:
+#   box_flux      (n_edges, 3) upper limit, best fit and delta log like at each edge index
+#   correlations  (n_edges+1, n_nuisance) correlation of the box with each nuisance parameter
+#   names         (n_nuisance, 2) source and parameter name of each nuisance parameter
+#   method        'profile' for limits profiled over the nuisance parameters, or
+#                 'fixed_background' for the approximation with the background at the null fit
+def save_limits(path, zeta, box_flux, correlations, names, method='profile'):
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    np.savez(os.path.join(path, 'zeta_' + repr(float(zeta)) + '.npz'), zeta=float(zeta), box_flux=box_flux,
+             correlations=correlations, names=np.array(names, dtype=str).reshape(-1, 2), method=method)
+
+#{zeta: {'box_flux', 'correlations', 'names', 'method'}} of every scan saved in path, with
+#names a list of (source, parameter) tuples labelling the columns of correlations
+def load_limits(path):
+    limits = {}
+    for filename in sorted(os.listdir(path)):
+        if filename.startswith('zeta_') and filename.endswith('.npz'):
+            data = np.load(os.path.join(path, filename))
+            limits[float(data['zeta'])] = {'box_flux':data['box_flux'], 'correlations':data['correlations'],
+                                           'names':[tuple(str(part) for part in name) for name in data['names']],
+                                           'method':str(data['method']) if 'method' in data else 'profile'}
+            data.close()
+    return limits
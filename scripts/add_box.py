@@ -5,26 +5,14 @@
 import numpy as np
 import matplotlib.pyplot as plt
 import pyfits
+import sys
+import os
 
-#Energy resolution (E Disp class 1- pretty close to the total)
-def e_res(E):
-    energy = np.array([31.718504,54.31288,95.86265,171.82704,307.93054,535.1251,944.0604,1716.8848,3074.5315,5339.1763,9559.056,17111.936,29704.664,53986.227,93706.14,167702.28,300152.7,520977.8,931974.8,1690808.0,2974747.2])
-    res = np.array([0.2942218,0.25078142,0.21741302,0.1813951,0.15067752,0.12313887,0.10302135,0.090325624,0.08080946,0.07341215,0.07025641,0.070810914,0.07454435,0.080399856,0.08678346,0.094758466,0.10061333,0.10752697,0.25969607,0.18390165,0.24169934])
-    closest = np.argmin(np.abs(E-energy))
-    if E-energy[closest]>0.:
-        frac = (E-energy[closest])/(energy[closest+1]-energy[closest])
-        return res[closest]+frac*(res[closest+1]-res[closest])
-    else:
-        frac = (E-energy[closest-1])/(energy[closest]-energy[closest-1])
-        return res[closest-1]+frac*(res[closest]-res[closest-1])
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from irfs import edisp_matrix, true_energy_edges
+from spectra import true_box_dnde
+from counts import read_exposure, expected_counts, normalized_template
 
-#Just a gaussian function, representing the energy dispersion of the detector
-def blur(x,offset,sigma):
-    return np.exp(-1.0*(x-offset)**2/(2*sigma**2))/np.sqrt(2*np.pi*sigma**2)
-
-def make_random(x,g):
-    cdf = np.cumsum(g)/np.sum(g)
-    return x[np.argmin(np.abs(cdf-np.random.rand(1)[0]))]
 
 #looking at TS distribution
 """
@@ -60,12 +48,8 @@ energies = 10**np.linspace(np.log10(6000),np.log10(800000),num_ebins)
 ebin_widths = np.diff(energies)
 box_flux = 3.0*10**-10#total flux
 endpoint_e = 100000#MeV, aka 100 GeV
-dnde = box_flux/endpoint_e #flux per MeV
 zeta = 0.44 #determines width of box
 
-box_counts = np.zeros((num_ebins-1))
-exposures = np.zeros((num_ebins-1))
-
 #Time to figure out the ideal window size!
 #To the right: we know the energy resolution- we just need enough bins to make sure 95% of the signal is captured
 #To the left: we want the counts fraction to be less than 5%?
@@ -74,40 +58,22 @@ exposures = np.zeros((num_ebins-1))
 #Also, bin size increases as you go right - by a factor of 1.103
 #so for the bin immediately to the left, you have 1.103X fewer counts from the box, and
 
-exposurefile = pyfits.open('6gev_exposure.fits')
-for i in range(len(exposurefile[0].data)-1):
-    exposures[i] = exposurefile[0].data[i][25, 25]
-exposurefile.close()
-
+exposure, exposure_energies = read_exposure('6gev_exposure.fits')
 
-box_width = endpoint_e*2.0*np.sqrt(1.0-zeta)/(1+np.sqrt(1.0-zeta))
-box_beginning = endpoint_e-box_width
-#Edit box_spectrum.dat
-spectrum_file = open('box_spectrum.dat','w')
-#What's the normalization constant here?
-#Total flux is E_edge*function value
-#Function_value = total_flux/E_edge
-x_fine_grid = np.linspace(0.0, 800000, 10000)
-n_leading_zeros = int(np.argmin(np.abs(x_fine_grid-box_beginning)))
-n_trailing_zeros = 10000-int(np.argmin(np.abs(x_fine_grid-endpoint_e)))
-n_box_width = int(10000-n_leading_zeros-n_trailing_zeros)
-pure_box = np.concatenate([np.zeros((n_leading_zeros)),np.concatenate([1.0+np.zeros((n_box_width)),np.zeros((n_trailing_zeros))])])
-
-#Sigma here is the absolute energy resolution as a function of energy
-sigma = e_res(endpoint_e)*endpoint_e*10000./800000.0
-
-dispersion = blur(np.linspace(0,6*sigma,6*sigma),3*sigma,sigma)
-convolved_pure_box = np.convolve(pure_box, dispersion,'same')
+f = pyfits.open('6gev_srcmap_03.fits')
 
-convolution = np.zeros((num_ebins-1))
-for i in range(len(convolution)):
-    convolution[i] = convolved_pure_box[np.argmin(np.abs(x_fine_grid-energies[i]))]
+#Expected box counts in every pixel and bin: exposure of each pixel times the box template
+#(HDU 6) of the srcmap. The unsmeared box is integrated on a fine true-energy binning and
+#forward-folded through the same dispersion matrix as the fitted templates
+true_edges = true_energy_edges(energies)
+box_dnde = lambda E: box_flux*true_box_dnde(E, endpoint_e, zeta)
+box_cube = expected_counts(box_dnde, energies, exposure, exposure_energies, normalized_template(f[6].data), edisp=edisp_matrix(energies, true_edges), true_edges=true_edges)
+box_counts = np.sum(np.sum(box_cube, axis=2), axis=1)
 
 """
 plt.yscale('log')
 plt.xscale('log')
-plt.plot(energies[:-1], dnde*ebin_widths*exposures*convolution, color='blue',linewidth=2.0, label='Convolved Box')
-plt.plot(energies[:-1], dnde*ebin_widths*exposures, color='red',linewidth=2.0, label='Flat Spectrum')
+plt.plot(energies[:-1], box_counts, color='blue',linewidth=2.0, label='Convolved Box')
 plt.axvline(endpoint_e, color='black', linestyle='--', linewidth=0.5,label='Box Edge')
 plt.legend(loc=4)
 plt.xlim([10000, 800000])
@@ -117,31 +83,18 @@ plt.savefig('plots/Box_convolution.png',bbox_inches='tight')
 plt.show()
 """
 
-print "OG counts: " + str(np.sum(dnde*ebin_widths*exposures))
-box_counts = dnde*ebin_widths*exposures*convolution
 print "post-convolution counts: " + str(np.sum(box_counts))
 print "Total flux: " + str(np.sum(box_counts)/(4.5*10**11))
-the_index = np.argmax(box_counts)
 print box_counts
-print "Other way of calculating: " + str(box_counts[the_index]*energies[the_index]/ebin_widths[the_index]/exposures[the_index])
-
-
-f = pyfits.open('6gev_srcmap_03.fits')
-q = 0
-
 
+#Poisson draws per pixel are equivalent to drawing the number of photons per bin
+#and distributing them over the template
+injected = np.random.poisson(box_cube)
 for i in range(num_ebins-1):
-    model_counts = np.zeros((1,len(f[6].data[i].ravel())))[0]
-    num_photons = np.random.poisson(box_counts[i])
+    num_photons = np.sum(injected[i])
     print "num photons = " + str(num_photons) + " or " + str(100.*num_photons/np.sum(np.sum(f[0].data[i]))) + "% of total counts in bin " + str(i)
     print "sqrt(num photons) = " + str(np.sqrt(num_photons))
     print "flux ul 95% = " + str(2*np.sqrt(num_photons)/num_photons)
-    for photon in range(num_photons):
-        phot_loc = int(make_random(np.arange(0,len(model_counts), 1), f[6].data[i].ravel()))
-        model_counts[phot_loc] += 1
-
-
-    model_counts = model_counts.reshape(50, 50)
-    f[0].data[i] += model_counts
+f[0].data[:num_ebins-1] += injected
 f.writeto('box_srcmap_artificial_box.fits')
 f.close()
@@ -1,10 +1,18 @@
 import numpy as np
+import sys
+import os
 
-sigma = 0.001
-r = 10**np.linspace(-3.0, np.log10(180.0),200)
-g = np.exp(-1.0*r**2/(2.0*sigma**2))/np.sqrt(2.0*np.pi*sigma**2)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from templates import radial_grid, radial_profiles, write_radial_profile
 
-file= open('gauss_01_degree.dat','wb')
-for i in range(len(r)):
-    file.write(str(r[i])+" " + str(g[i])+"\n")
-file.close()
+r = radial_grid
+
+#Profile of the Disk Component in xmlmodel.xml, sigma = 0.001 degrees
+write_radial_profile('gauss_01_degree.dat', r, radial_profiles(r, 0.001)[0])
+
+#Gaussian widths [degrees] of the Disk Component profiles to compare
+sigmas = [0.01, 0.03, 0.3, 1.0]
+
+profiles = radial_profiles(r, sigmas)
+for sigma, profile in zip(sigmas, profiles):
+    write_radial_profile('gauss_'+str(sigma)+'_degree.dat', r, profile)
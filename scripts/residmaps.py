@@ -20,6 +20,12 @@ from astropy import units as u
 from astropy.coordinates import SkyCoord
 from astropy.table import Table
 from scipy.signal import convolve2d
+import sys
+import os
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from model_cube import load_model_cube
+from cube_reader import open_cube
 
 #from upper_limit import AnalyticAnalysis
 
@@ -147,7 +153,7 @@ def l_b_to_ra_dec(l_input, b_input):
 
 def make_model_cubes():
     models = ['few_src']#, '3fgl_disk', '1fig', '3fgl']
-    fs_srcmap = pyfits.open('few_sources_srcmap.fits')
+    fs_srcmap = open_cube('few_sources_srcmap.fits')
     file = open('models/high_tol_results.pk1','rb')
     g = pickle.load(file)
     file.close()
@@ -160,12 +166,12 @@ def make_model_cubes():
         sources = g[model]
         for source in sources:
             results[model][source] = np.zeros((28, 50, 50))
-            i = 3
-            while fs_srcmap[i].header['EXTNAME'] != source[:-1] and fs_srcmap[i].header['EXTNAME'] != source:
-                i += 1
-            for e_bin in np.arange(0, 25):
-                if g[model][source][e_bin]>0.0:
-                    results[model][source][e_bin,:,:] = fs_srcmap[i].data[e_bin]*g[model][source][e_bin]/sum(sum(fs_srcmap[i].data[e_bin]))
+            #The fit results may carry one extra trailing character on the source name
+            if source in fs_srcmap:
+                templates = fs_srcmap.template(source, slice(0, 25))
+            else:
+                templates = fs_srcmap.template(source[:-1], slice(0, 25))
+            results[model][source][:25] = np.asarray(g[model][source][:25])[:, None, None]*templates
 
         for source in results[model].keys():
             my_arr[model] += results[model][source]
@@ -181,7 +187,6 @@ def make_ROI_map(type):
 
     like = BinnedAnalysis(obs_complete, 'xmlmodel.xml', optimizer='NEWMINUIT')
     sourcemap = like.binnedData.srcMaps
-    f = pyfits.open(sourcemap)
 
     image_data = fits.getdata('6gev_image.fits')
     filename = get_pkg_data_filename('6gev_image.fits')
@@ -189,11 +194,8 @@ def make_ROI_map(type):
     wcs = WCS(hdu.header)
 
     #Given the results of the fit, calculate the model
-    model_data = np.zeros(f[0].shape)
-    for source in like.sourceNames():
-        the_index = f.index_of(source)
-        model_data += like._srcCnts(source)[:, None, None]*f[the_index].data[:-1, :, :]/np.sum(np.sum(f[the_index].data, axis=2), axis=1)[:-1, None, None]
-    actual_data = np.array(like.binnedData.countsMap.data()).reshape(f[0].shape)
+    model_data = load_model_cube(sourcemap, like.sourceNames()).model_from_like(like)
+    actual_data = np.array(like.binnedData.countsMap.data()).reshape(model_data.shape)
 
     fig = plt.figure(figsize=[14,6])
 
@@ -528,18 +530,11 @@ def residmapComparison():
     """
     Making Figure 2 in the paper (comparing the residuals between the GC point source model and GC extended source model)
     """
-    srcmap001 = fits.open('dataFiles/6gev_srcmap_001.fits')
-    srcmap03 = fits.open('dataFiles/6gev_srcmap_03.fits')
-
     image_data = fits.getdata('dataFiles/6gev_image.fits')
     filename = get_pkg_data_filename('dataFiles/6gev_image.fits')
     hdu = fits.open(filename)[0]
     wcs = WCS(hdu.header)
 
-    #Given the results of the fit, calculate the model
-    modelData001 = np.zeros(srcmap001[0].shape)
-    modelData03 = np.zeros(srcmap03[0].shape)
-
     file = open('plotsData/fitResults001.pk1','rb')
     fit001 = pickle.load(file)
     file.close()
@@ -548,14 +543,9 @@ def residmapComparison():
     fit03 = pickle.load(file)
     file.close()
 
-
-    for source in fit001:
-        the_index = srcmap001.index_of(source)
-
-        modelData001 += fit001[source][:, None, None]*srcmap001[the_index].data[:-1, :, :]/np.sum(np.sum(srcmap001[the_index].data, axis=2), axis=1)[:-1, None, None]
-    for source in fit03:
-        the_index = srcmap03.index_of(source)
-        modelData03 += fit03[source][:, None, None]*srcmap03[the_index].data[:-1, :, :]/np.sum(np.sum(srcmap03[the_index].data, axis=2), axis=1)[:-1, None, None]
+    #Given the results of the fit, calculate the model
+    modelData001 = load_model_cube('dataFiles/6gev_srcmap_001.fits', list(fit001.keys())).model(fit001)
+    modelData03 = load_model_cube('dataFiles/6gev_srcmap_03.fits', list(fit03.keys())).model(fit03)
 
     fig = plt.figure(figsize=[12, 4.5])
 
@@ -594,18 +584,11 @@ def dataModel():
     """
     Making Figure 1 in the paper (Data versus model)
     """
-    srcmap001 = fits.open('dataFiles/6gev_srcmap_001.fits')
-    srcmap03 = fits.open('dataFiles/6gev_srcmap_03.fits')
-
     image_data = fits.getdata('6gev_image.fits')
     filename = get_pkg_data_filename('6gev_image.fits')
     hdu = fits.open(filename)[0]
     wcs = WCS(hdu.header)
 
-    #Given the results of the fit, calculate the model
-    modelData001 = np.zeros(srcmap001[0].shape)
-    modelData03 = np.zeros(srcmap03[0].shape)
-
     file = open('plotsData/fitResults001.pk1','rb')
     fit001 = pickle.load(file)
     file.close()
@@ -614,14 +597,9 @@ def dataModel():
     fit03 = pickle.load(file)
     file.close()
 
-
-    for source in fit001:
-        the_index = srcmap001.index_of(source)
-
-        modelData001 += fit001[source][:, None, None]*srcmap001[the_index].data[:-1, :, :]/np.sum(np.sum(srcmap001[the_index].data, axis=2), axis=1)[:-1, None, None]
-    for source in fit03:
-        the_index = srcmap03.index_of(source)
-        modelData03 += fit03[source][:, None, None]*srcmap03[the_index].data[:-1, :, :]/np.sum(np.sum(srcmap03[the_index].data, axis=2), axis=1)[:-1, None, None]
+    #Given the results of the fit, calculate the model
+    modelData001 = load_model_cube('dataFiles/6gev_srcmap_001.fits', list(fit001.keys())).model(fit001)
+    modelData03 = load_model_cube('dataFiles/6gev_srcmap_03.fits', list(fit03.keys())).model(fit03)
 
     fig = plt.figure(figsize=[12, 4.5])
 
@@ -16,6 +16,14 @@ from SummedLikelihood import *
 import pyLikelihood as pyLike
 from gt_apps import evtbin, srcMaps, gtexpcube2
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from irfs import e_res, folding_matrix
+from spectra import folded_box_spectra, write_spectrum
+from cube_reader import open_cube
+from limits import profile_upper_limit
+from parallel_scan import edge_scan
+from snapshots import snapshot, restore
+
 print "Done!"
 
 
@@ -72,17 +80,6 @@ def pvalue_given_chi2(x, k):
     return get_integral(y[initial_pos:], g[initial_pos:])
 
 
-#Energy resolution (E Disp class 1- pretty close to the total)
-def e_res(E):
-    energy = np.array([31.718504,54.31288,95.86265,171.82704,307.93054,535.1251,944.0604,1716.8848,3074.5315,5339.1763,9559.056,17111.936,29704.664,53986.227,93706.14,167702.28,300152.7,520977.8,931974.8,1690808.0,2974747.2])
-    res = np.array([0.2942218,0.25078142,0.21741302,0.1813951,0.15067752,0.12313887,0.10302135,0.090325624,0.08080946,0.07341215,0.07025641,0.070810914,0.07454435,0.080399856,0.08678346,0.094758466,0.10061333,0.10752697,0.25969607,0.18390165,0.24169934])
-    closest = np.argmin(np.abs(E-energy))
-    if E-energy[closest]>0.:
-        frac = (E-energy[closest])/(energy[closest+1]-energy[closest])
-        return res[closest]+frac*(res[closest+1]-res[closest])
-    else:
-        frac = (E-energy[closest-1])/(energy[closest]-energy[closest-1])
-        return res[closest-1]+frac*(res[closest]-res[closest-1])
 #Just a gaussian function, representing the energy dispersion of the detector
 def blur(x,offset,sigma):
     return np.exp(-1.0*(x-offset)**2/(2*sigma**2))/np.sqrt(2*np.pi*sigma**2)
@@ -104,32 +101,23 @@ def make_random(x,g):
 
 
 
-def edit_box_xml(energy, box_flux, z):
+#Analysis binning the box spectrum is folded on (as in likelihood_upper_limit3)
+box_energies = 10**np.linspace(np.log10(6000),np.log10(800000),51)
+
+#base_xml: model of everything but the box and pedestal
+def edit_box_xml(energy, box_flux, z, base_xml='xmlmodel_fixed.xml'):
     #Choose between a wide and narrow box
     #z=0: wide box
     #z=1: line
     
     box_width = energy*2.0*np.sqrt(1.0-z)/(1+np.sqrt(1.0-z))
-    box_beginning = energy-box_width
     #Edit box_spectrum.dat
-    spectrum_file = open('box_spectrum.dat','w')
-    #What's the normalization constant here?
-    #Total flux is E_edge*function value
-    #Function_value = total_flux/E_edge
-    x_fine_grid = np.linspace(0.0, 800000, 10000)
-    n_leading_zeros = int(np.argmin(np.abs(x_fine_grid-box_beginning)))
-    n_trailing_zeros = 10000-int(np.argmin(np.abs(x_fine_grid-energy)))
-    n_box_width = int(10000-n_leading_zeros-n_trailing_zeros)
-    pure_box = np.concatenate([np.zeros((n_leading_zeros)),np.concatenate([1.0+np.zeros((n_box_width)),np.zeros((n_trailing_zeros))])])
-
-    #Sigma here is the absolute energy resolution as a function of energy
-    sigma = e_res(energy)*energy*10000./800000.0
-
-    dispersion = blur(np.linspace(0,6*sigma,6*sigma),3*sigma,sigma)
-    convolved_pure_box = np.convolve(pure_box, dispersion,'same')
-    for i in range(len(x_fine_grid)):
-        spectrum_file.write(str(x_fine_grid[i])+" " + str(max(convolved_pure_box[i], 10.**-35))+"\n")
-    spectrum_file.close()
+    #The FileFunction normalization is box_flux/box_width, so the box is written with unit height
+    #Unsmeared box forward-folded through the energy dispersion matrix, so the Science Tools
+    #must not disperse it again (apply_edisp="false" below)
+    matrix, fold_edges = folding_matrix(box_energies)
+    spectrum, grid, integrated_box_flux = folded_box_spectra(matrix, fold_edges, fold_edges, energy, z)
+    write_spectrum('box_spectrum.dat', grid, spectrum[0, 0]*integrated_box_flux[0, 0])
     """
     plt.plot(x_fine_grid, convolved_pure_box)
     plt.axvline(energy, linestyle='--',linewidth=0.5, color='black')
@@ -141,7 +129,7 @@ def edit_box_xml(energy, box_flux, z):
     plt.plot(x_fine_grid, 10**4*blur(x_fine_grid,energy,e_res(energy)*energy), color='yellow',linestyle='-.')
     plt.show()
     """
-    fixed_xml_file = open('xmlmodel_fixed.xml','r')
+    fixed_xml_file = open(base_xml,'r')
     non_box_string = []
     for line in fixed_xml_file:
         non_box_string.append(line)
@@ -153,7 +141,7 @@ def edit_box_xml(energy, box_flux, z):
     
     box_string = []
     box_string.append(' <source name="Box Component" type="PointSource">\n')
-    box_string.append('   <spectrum file="box_spectrum.dat" type="FileFunction">\n')
+    box_string.append('   <spectrum apply_edisp="false" file="box_spectrum.dat" type="FileFunction">\n')
     box_string.append('     <parameter free="0" max="'+str(box_maximum*scale_factor**-1/box_width)+'" min="'+str(box_minimum*scale_factor**-1/box_width)+'" name="Normalization" scale="'+str(scale_factor)+'" value="'+str(box_flux*scale_factor**-1/box_width)+'"/>\n')
     box_string.append('   </spectrum>\n')
     box_string.append('  <spatialModel type="SkyDirFunction">\n')
@@ -166,7 +154,7 @@ def edit_box_xml(energy, box_flux, z):
     pedestal_minimum = 0
     
     box_string.append(' <source name="Pedestal" type="PointSource">\n')
-    box_string.append('   <spectrum file="box_spectrum.dat" type="FileFunction">\n')
+    box_string.append('   <spectrum apply_edisp="false" file="box_spectrum.dat" type="FileFunction">\n')
     box_string.append('     <parameter free="0" max="'+str(pedestal_maximum*scale_factor**-1/box_width)+'" min="'+str(pedestal_minimum*scale_factor**-1/box_width)+'" name="Normalization" scale="'+str(-1*scale_factor)+'" value="'+str(pedestal_minimum*scale_factor**-1/box_width)+'"/>\n')
     box_string.append('   </spectrum>\n')
     box_string.append('  <spatialModel type="SkyDirFunction">\n')
@@ -211,7 +199,250 @@ def loglikelihood3(energy, box_flux, obs, z, get_like=False, covar=False):
         else:
             return q
         
-def likelihood_upper_limit3(z):
+#-logL as a function of the box flux from a single analysis object, kept alive for the
+#whole search: only the box normalization is changed, in memory, and each flux is fit
+#once. like must have been built from xmlmodel_fixed_box.xml for the current edge
+def box_flux_profile(like, box_width, scale_factor=1e-15):
+    norm_index = like.par_index('Box Component', 'Normalization')
+    like_obj = pyLike.Minuit(like.logLike)
+    cache = {}
+    def profile(flux):
+        if flux not in cache:
+            like[norm_index] = flux/scale_factor/box_width
+            cache[flux] = like.fit(verbosity=0, tol=1e10, optObject=like_obj, covar=False, optimizer='DRMNFB')
+        return cache[flux]
+    return profile
+
+#Upper limit of the box with upper edge energies[index], and with calc_cov its correlations
+#with the GC prefactor and index. Runs in its own scratch directory when the scan is
+#parallel (see parallel_scan.py), so the srcmap/exposure cuts and XML files it writes
+#are private to the worker
+def edge_upper_limit(state, index):
+    z = state['z']
+    sourcemap = state['sourcemap']
+    energies = state['energies']
+    corr = 0.0
+    corr2 = 0.0
+    box_width = energies[index]*2.0*np.sqrt(1.0-z)/(1+np.sqrt(1.0-z))
+            
+    print "Calculating upper limit in bin " + str(index) + " at energy " + str(energies[index])
+    #print "bin " + str(np.argmin(np.abs(energies-energy)))
+    #window_low, window_high = window(energy, energies)
+    
+    window_low = index-6
+    window_high = index+2
+
+    #Generate two observations (one above the window and one below)
+    #Make two exposure maps
+    if index>6:
+        exposure_complete = pyfits.open('6gev_exposure.fits')
+        exposure_complete[0].data = exposure_complete[0].data[:window_low+1]
+        a = exposure_complete[0]
+        exposure_complete[1].data = exposure_complete[1].data[:window_low+1]
+        b = exposure_complete[1]
+        hdulist = pyfits.HDUList([a, b, exposure_complete[2]])
+        os.system('rm exposure_low.fits')
+        hdulist.writeto('exposure_low.fits')
+        exposure_complete.close()
+    if index<48:
+        exposure_complete = pyfits.open('6gev_exposure.fits')
+        exposure_complete[0].data = exposure_complete[0].data[window_high:]
+        a = exposure_complete[0]
+        exposure_complete[1].data = exposure_complete[1].data[window_high:]
+        b = exposure_complete[1]
+        hdulist = pyfits.HDUList([a, b, exposure_complete[2]])
+        os.system('rm exposure_high.fits')
+        hdulist.writeto('exposure_high.fits')
+        exposure_complete.close()
+    
+    
+    #Make two sourcemaps
+    if index>6:
+        srcmap_complete = pyfits.open(sourcemap)
+        srcmap_complete[0].data = srcmap_complete[0].data[:window_low]
+        a = srcmap_complete[0]
+        srcmap_complete[2].data = srcmap_complete[2].data[:window_low]
+        b = srcmap_complete[2]
+        srcmap_complete[3].data = srcmap_complete[3].data[:window_low+1]
+        c = srcmap_complete[3]
+        srcmap_complete[4].data = srcmap_complete[4].data[:window_low+1]
+        d = srcmap_complete[4]
+        srcmap_complete[5].data = srcmap_complete[5].data[:window_low+1]
+        e = srcmap_complete[5]
+        srcmap_complete[6].data = srcmap_complete[6].data[:window_low+1]
+        f = srcmap_complete[6]
+        srcmap_complete[7].data = srcmap_complete[7].data[:window_low+1]
+        g = srcmap_complete[7]
+        srcmap_complete[8].data = srcmap_complete[8].data[:window_low+1]
+        h = srcmap_complete[8]
+        srcmap_complete[9].data = srcmap_complete[9].data[:window_low+1]
+        m = srcmap_complete[9]
+
+        os.system('rm srcmap_low.fits')
+        b.header['DSVAL4'] = str()+':'+str()
+        hdulist = pyfits.HDUList([a, srcmap_complete[1], b, c, d, e, f, g, h, m])
+        hdulist.writeto('srcmap_low.fits')
+        srcmap_complete.close()
+    
+    if index<48:
+        srcmap_complete = pyfits.open(sourcemap)
+        srcmap_complete[0].data = srcmap_complete[0].data[window_high:]
+        a = srcmap_complete[0]
+        srcmap_complete[2].data = srcmap_complete[2].data[window_high:]
+        r = 0
+        for entry in srcmap_complete[2].data:
+            entry[0] = int(r)
+            r += 1
+        #srcmap_complete[2].data[:,0] = np.arange(0, len(srcmap_complete[2].data[:,0]))
+        b = srcmap_complete[2]
+        srcmap_complete[3].data = srcmap_complete[3].data[window_high:]
+        c = srcmap_complete[3]
+        srcmap_complete[4].data = srcmap_complete[4].data[window_high:]
+        d = srcmap_complete[4]
+        srcmap_complete[5].data = srcmap_complete[5].data[window_high:]
+        e = srcmap_complete[5]
+        srcmap_complete[6].data = srcmap_complete[6].data[window_high:]
+        f = srcmap_complete[6]
+        srcmap_complete[7].data = srcmap_complete[7].data[window_high:]
+        g = srcmap_complete[7]
+        srcmap_complete[8].data = srcmap_complete[8].data[window_high:]
+        h = srcmap_complete[8]
+        srcmap_complete[9].data = srcmap_complete[9].data[window_high:]
+        m = srcmap_complete[9]
+
+        os.system('rm srcmap_high.fits')
+        hdulist = pyfits.HDUList([a, srcmap_complete[1], b, c, d, e, f, g, h, m])
+        hdulist.writeto('srcmap_high.fits')
+        srcmap_complete.close()
+
+    summedLike = SummedLikelihood()
+
+    if index>6:
+        obs_low = BinnedObs(srcMaps='srcmap_low.fits', expCube='6gev_ltcube.fits', binnedExpMap='exposure_low.fits', irfs='CALDB')
+        like_low = BinnedAnalysis(obs_low, 'xmlmodel_free.xml', optimizer='NEWMINUIT')
+        #Warm start from the previous edge fit in this process
+        if 'free_fit' in state:
+            restore(like_low, state['free_fit'])
+        summedLike.addComponent(like_low)
+
+    if index<48:
+        obs_high = BinnedObs(srcMaps='srcmap_high.fits', expCube='6gev_ltcube.fits', binnedExpMap='exposure_high.fits', irfs='CALDB')
+        like_high = BinnedAnalysis(obs_high, 'xmlmodel_free.xml', optimizer='NEWMINUIT')
+        if 'free_fit' in state:
+            restore(like_high, state['free_fit'])
+        summedLike.addComponent(like_high)
+    
+    print "Fitting SummedLikelihood"
+    summedLike.ftol = 1e-8
+    summedLike.fit(verbosity=3)
+    #The sideband fit is kept in memory for the next edge and, frozen, as the background of
+    #the box analyses below (formerly xmlmodel_free.xml and xmlmodel_fixed.xml)
+    state['free_fit'] = snapshot(summedLike.components[0])
+    background = dict((key, (value, bounds, False)) for key, (value, bounds, free) in state['free_fit'].items())
+    
+    print "Fitting all data"
+    
+    calculation = 'poisson'
+    obs_complete = BinnedObs(srcMaps=sourcemap, expCube='6gev_ltcube.fits', binnedExpMap='6gev_exposure.fits', irfs='CALDB')
+    edit_box_xml(100000.0,1e-15,0.0,'xmlmodel_free.xml')
+    like = BinnedAnalysis(obs_complete, 'xmlmodel_fixed_box.xml', optimizer='MINUIT')
+    restore(like, background)
+    like.tol=1e-8
+    like_obj = pyLike.Minuit(like.logLike)
+    like.fit(verbosity=3,optObject=like_obj)
+    fixed_box = snapshot(like)
+    
+    #Flucuate the window data
+    #Only the window planes of each source are read from the memory-mapped srcmap
+    srcmap = open_cube(sourcemap)
+    window_bins = slice(max(window_low,0), min(window_high,49))
+    templates = dict((source, srcmap.template(source, window_bins)) for source in like.sourceNames())
+    poisson_data = np.zeros(srcmap.counts(window_bins).shape)
+    for q, bin in enumerate(range(window_bins.start, window_bins.stop)):
+        for source in like.sourceNames():
+            template = templates[source][q].ravel()
+            model_counts = np.zeros(len(template))
+            num_photons = int(np.round(np.random.poisson(like._srcCnts(source)[bin])))
+            for photon in range(int(num_photons)):
+                phot_loc = int(make_random(np.arange(0,len(model_counts), 1), template))
+                model_counts[phot_loc] += 1
+            poisson_data[q] += model_counts.reshape(poisson_data[q].shape)
+    f = pyfits.open(sourcemap)
+    f[0].data[window_bins] = poisson_data
+    os.system('rm box_srcmap_poisson.fits')
+    f.writeto('box_srcmap_poisson.fits')
+    f.close()
+    
+    obs_poisson = BinnedObs(srcMaps='box_srcmap_poisson.fits', expCube='6gev_ltcube.fits', binnedExpMap='6gev_exposure.fits', irfs='CALDB')
+    like = BinnedAnalysis(obs_poisson, 'xmlmodel_fixed_box.xml', optimizer='NEWMINUIT')
+    restore(like, fixed_box)
+    like.tol=1e-8
+    like_obj = pyLike.Minuit(like.logLike)
+    like.fit(verbosity=0,optObject=like_obj)
+        
+    if calculation == 'complete':
+         obs_calculation=obs_complete
+    else:
+        obs_calculation= obs_poisson
+    
+        
+    print "Finding Upper Limit..."
+    #One analysis object for the whole search; the spectrum file and XML are written once
+    edit_box_xml(energies[index], 1.0e-15, z, 'xmlmodel_free.xml')
+    like_box = BinnedAnalysis(obs_calculation, 'xmlmodel_fixed_box.xml', optimizer='DRMNFB')
+    restore(like_box, background)
+    like_box.tol = 1e-8
+    profile = box_flux_profile(like_box, box_width)
+
+    #Bracket and solve for the flux where 2 delta loglike, measured from the null flux
+    #of 1e-15 as before, reaches crit_chi2
+    crit_chi2 = 2.706
+    limit = profile_upper_limit(profile, 1.0e-15, 1.0e-12, crit_chi2/2.0, from_null=True)
+    box_flux = limit['upper_limit']
+    
+    print "flux = " + str(box_flux) + ", TS = " + str(limit['ts'])
+    print "evaluations = " + str(limit['evaluations']) + " (" + str(limit['message']) + ")"
+    
+
+    
+    calc_cov = state['calc_cov']
+    if calc_cov:
+        like1 = BinnedAnalysis(obs_calculation, 'xmlmodel_fixed_box.xml', optimizer='DRMNFB')
+        restore(like1, background)
+        
+        like1.thaw(like1.par_index('Disk Component','Index'))
+        like1.thaw(like1.par_index('Disk Component','Prefactor'))
+        like1.thaw(like1.par_index('Box Component','Normalization'))
+        like1.tol=1e-5
+        like1obj = pyLike.Minuit(like1.logLike)
+        like1.fit(verbosity=0,optObject=like1obj, covar=False)
+
+        like2 = BinnedAnalysis(obs_calculation, 'xmlmodel_fixed_box.xml', optimizer='NewMinuit')
+        restore(like2, snapshot(like1))
+        like2.tol=1e-8
+        like2obj = pyLike.Minuit(like1.logLike)
+        like2.fit(verbosity=3,optObject=like1obj, covar=True)
+        
+        
+        #ul = UpperLimit(like1,'Box Component')
+        #ul.compute(emin=100.0,emax=500000, delta=3.91)
+        
+        #box_flux_bayesian[index] = float(ul.bayesianUL()[0])
+        #box_flux_frequentist[index] = float(ul.results[0].value)            
+        print like2.covariance
+        print 'Return code: ' + str(like2obj.getRetCode())
+        cov = like2.covariance
+        corr = cov[0][1]/np.sqrt(cov[0][0]*cov[1][1])
+        corr2 = cov[0][2]/np.sqrt(cov[0][0]*cov[2][2])
+        print "Correlations:"
+        print corr
+        print corr2
+        #if like2obj.getRetCode()!=0:
+        plot_spectrum(like2, energies, index, window_low, window_high)
+    return box_flux, corr, corr2
+
+#processes: number of worker processes for the edges, all cores if None
+def likelihood_upper_limit3(z, processes=1):
     
     #Array to hold results of flux upper limit calculation
     num_ebins = 51 #1 more than the number of bins due to the fencepost problem
@@ -230,238 +461,16 @@ def likelihood_upper_limit3(z):
     gll_index = np.zeros((num_ebins-1))
     disk_index = np.zeros((num_ebins-1))
     #reconstructed_spectra = np.zeros((num_ebins-1, num_ebins-1))
+    calc_cov = False
     #Loop through upper edge of box
-    for index in range(6,48):
-        box_width = energies[index]*2.0*np.sqrt(1.0-z)/(1+np.sqrt(1.0-z))
-                
-        print "Calculating upper limit in bin " + str(index) + " at energy " + str(energies[index])
-        #print "bin " + str(np.argmin(np.abs(energies-energy)))
-        #window_low, window_high = window(energy, energies)
-        
-        window_low = index-6
-        window_high = index+2
-
-        #Generate two observations (one above the window and one below)
-        #Make two exposure maps
-        if index>6:
-            exposure_complete = pyfits.open('6gev_exposure.fits')
-            exposure_complete[0].data = exposure_complete[0].data[:window_low+1]
-            a = exposure_complete[0]
-            exposure_complete[1].data = exposure_complete[1].data[:window_low+1]
-            b = exposure_complete[1]
-            hdulist = pyfits.HDUList([a, b, exposure_complete[2]])
-            os.system('rm exposure_low.fits')
-            hdulist.writeto('exposure_low.fits')
-            exposure_complete.close()
-        if index<48:
-            exposure_complete = pyfits.open('6gev_exposure.fits')
-            exposure_complete[0].data = exposure_complete[0].data[window_high:]
-            a = exposure_complete[0]
-            exposure_complete[1].data = exposure_complete[1].data[window_high:]
-            b = exposure_complete[1]
-            hdulist = pyfits.HDUList([a, b, exposure_complete[2]])
-            os.system('rm exposure_high.fits')
-            hdulist.writeto('exposure_high.fits')
-            exposure_complete.close()
-        
-        
-        #Make two sourcemaps
-        if index>6:
-            srcmap_complete = pyfits.open(sourcemap)
-            srcmap_complete[0].data = srcmap_complete[0].data[:window_low]
-            a = srcmap_complete[0]
-            srcmap_complete[2].data = srcmap_complete[2].data[:window_low]
-            b = srcmap_complete[2]
-            srcmap_complete[3].data = srcmap_complete[3].data[:window_low+1]
-            c = srcmap_complete[3]
-            srcmap_complete[4].data = srcmap_complete[4].data[:window_low+1]
-            d = srcmap_complete[4]
-            srcmap_complete[5].data = srcmap_complete[5].data[:window_low+1]
-            e = srcmap_complete[5]
-            srcmap_complete[6].data = srcmap_complete[6].data[:window_low+1]
-            f = srcmap_complete[6]
-            srcmap_complete[7].data = srcmap_complete[7].data[:window_low+1]
-            g = srcmap_complete[7]
-            srcmap_complete[8].data = srcmap_complete[8].data[:window_low+1]
-            h = srcmap_complete[8]
-            srcmap_complete[9].data = srcmap_complete[9].data[:window_low+1]
-            m = srcmap_complete[9]
-
-            os.system('rm srcmap_low.fits')
-            b.header['DSVAL4'] = str()+':'+str()
-            hdulist = pyfits.HDUList([a, srcmap_complete[1], b, c, d, e, f, g, h, m])
-            hdulist.writeto('srcmap_low.fits')
-            srcmap_complete.close()
-        
-        if index<48:
-            srcmap_complete = pyfits.open(sourcemap)
-            srcmap_complete[0].data = srcmap_complete[0].data[window_high:]
-            a = srcmap_complete[0]
-            srcmap_complete[2].data = srcmap_complete[2].data[window_high:]
-            r = 0
-            for entry in srcmap_complete[2].data:
-                entry[0] = int(r)
-                r += 1
-            #srcmap_complete[2].data[:,0] = np.arange(0, len(srcmap_complete[2].data[:,0]))
-            b = srcmap_complete[2]
-            srcmap_complete[3].data = srcmap_complete[3].data[window_high:]
-            c = srcmap_complete[3]
-            srcmap_complete[4].data = srcmap_complete[4].data[window_high:]
-            d = srcmap_complete[4]
-            srcmap_complete[5].data = srcmap_complete[5].data[window_high:]
-            e = srcmap_complete[5]
-            srcmap_complete[6].data = srcmap_complete[6].data[window_high:]
-            f = srcmap_complete[6]
-            srcmap_complete[7].data = srcmap_complete[7].data[window_high:]
-            g = srcmap_complete[7]
-            srcmap_complete[8].data = srcmap_complete[8].data[window_high:]
-            h = srcmap_complete[8]
-            srcmap_complete[9].data = srcmap_complete[9].data[window_high:]
-            m = srcmap_complete[9]
-
-            os.system('rm srcmap_high.fits')
-            hdulist = pyfits.HDUList([a, srcmap_complete[1], b, c, d, e, f, g, h, m])
-            hdulist.writeto('srcmap_high.fits')
-            srcmap_complete.close()
-
-        summedLike = SummedLikelihood()
-
-        if index>6:
-            obs_low = BinnedObs(srcMaps='srcmap_low.fits', expCube='6gev_ltcube.fits', binnedExpMap='exposure_low.fits', irfs='CALDB')
-            like_low = BinnedAnalysis(obs_low, 'xmlmodel_free.xml', optimizer='NEWMINUIT')
-            summedLike.addComponent(like_low)
-
-        if index<48:
-            obs_high = BinnedObs(srcMaps='srcmap_high.fits', expCube='6gev_ltcube.fits', binnedExpMap='exposure_high.fits', irfs='CALDB')
-            like_high = BinnedAnalysis(obs_high, 'xmlmodel_free.xml', optimizer='NEWMINUIT')
-            summedLike.addComponent(like_high)
-        
-        print "Fitting SummedLikelihood"
-        summedLike.ftol = 1e-8
-        summedLike.fit(verbosity=3)
-        summedLike.writeXml('xmlmodel_free.xml')
-        for k in range(len(summedLike.params())):
-            summedLike.freeze(k)
-        summedLike.writeXml('xmlmodel_fixed.xml')
-        
-        print "Fitting all data"
-        
-        calculation = 'poisson'
-        obs_complete = BinnedObs(srcMaps=sourcemap, expCube='6gev_ltcube.fits', binnedExpMap='6gev_exposure.fits', irfs='CALDB')
-        edit_box_xml(100000.0,1e-15,0.0)
-        like = BinnedAnalysis(obs_complete, 'xmlmodel_fixed_box.xml', optimizer='MINUIT')
-        like.tol=1e-8
-        like_obj = pyLike.Minuit(like.logLike)
-        like.fit(verbosity=3,optObject=like_obj)
-        like.writeXml('xmlmodel_fixed_box.xml')
-        
-        #Flucuate the window data
-        f = pyfits.open(sourcemap)
-        poisson_data = np.zeros((len(range(max(window_low,0), min(window_high, 49))), 50, 50))
-        q = 0
-        for bin in range(max(window_low,0), min(window_high,49)):
-            for source in like.sourceNames():
-                for j in range(3,10):
-                    if source == f[j].header['EXTNAME']:
-                        the_index = j
-                    model_counts = np.zeros((1,len(f[the_index].data[bin].ravel())))[0]
-                    num_photons = int(np.round(np.random.poisson(like._srcCnts(source)[bin])))#
-                for photon in range(int(num_photons)):
-                    phot_loc = int(make_random(np.arange(0,len(model_counts), 1), f[the_index].data[bin].ravel()))
-                    model_counts[phot_loc] += 1
-                model_counts = model_counts.reshape(50, 50)
-                poisson_data[q] += model_counts
-            q += 1
-        f[0].data[max(window_low,0):min(window_high, 49)] = poisson_data
-        os.system('rm box_srcmap_poisson.fits')
-        f.writeto('box_srcmap_poisson.fits')
-        f.close()
-        
-        obs_poisson = BinnedObs(srcMaps='box_srcmap_poisson.fits', expCube='6gev_ltcube.fits', binnedExpMap='6gev_exposure.fits', irfs='CALDB')
-        like = BinnedAnalysis(obs_poisson, 'xmlmodel_fixed_box.xml', optimizer='NEWMINUIT')
-        like.tol=1e-8
-        like_obj = pyLike.Minuit(like.logLike)
-        like.fit(verbosity=0,optObject=like_obj)
-            
-        if calculation == 'complete':
-             obs_calculation=obs_complete
-        else:
-            obs_calculation= obs_poisson
-        
-            
-        print "Finding Upper Limit..."
-        null_likelihood = loglikelihood3(energies[index], 1.0e-15, obs_calculation, z)
-        delta_loglike = 0.0
-        
-        
-        #increase box flux until likelihood > 2sigma over null likelihood
-        box_flux[index] = 3.e-15
-        crit_chi2 = 2.706
-        while delta_loglike <crit_chi2:
-            print "delta loglike = " + str(delta_loglike)
-            print "flux = " + str(box_flux[index]) + " likelihood = " + str(loglikelihood3(energies[index], box_flux[index], obs_calculation, z))
-            box_flux[index]*=3.0                
-            delta_loglike = 2.0*(loglikelihood3(energies[index], box_flux[index], obs_calculation,z)-null_likelihood)
-            
-        box_flux[index]*=1.0/3.0
-        delta_loglike = 2.0*(loglikelihood3(energies[index], box_flux[index], obs_calculation,z)-null_likelihood)
-        print "Delta loglike = " + str(delta_loglike)
-        while delta_loglike <crit_chi2:
-            print "delta loglike = " + str(delta_loglike)
-            print "flux = " + str(box_flux[index]) + " likelihood = " + str(loglikelihood3(energies[index], box_flux[index], obs_calculation, z))
-            box_flux[index]*=1.5
-            delta_loglike = 2.0*(loglikelihood3(energies[index], box_flux[index], obs_calculation,z)-null_likelihood)
-            
-        box_flux[index]*=1.0/1.5
-        delta_loglike = 2.0*(loglikelihood3(energies[index], box_flux[index], obs_calculation,z)-null_likelihood)
-        
-        while delta_loglike <crit_chi2:
-            print "delta loglike = " + str(delta_loglike)
-            print "flux = " + str(box_flux[index]) + " likelihood = " + str(loglikelihood3(energies[index], box_flux[index], obs_calculation, z))
-            box_flux[index]*=1.03
-            delta_loglike = 2.0*(loglikelihood3(energies[index], box_flux[index], obs_calculation,z)-null_likelihood)
-            
-        box_flux[index]*= 1.0/1.03
-        delta_loglike = 2.0*(loglikelihood3(energies[index], box_flux[index], obs_calculation,z)-null_likelihood)
-        
-        print "delta log like = " + str(delta_loglike)
-        
-    
-        
-        calc_cov = False
-        if calc_cov:
-            like1 = BinnedAnalysis(obs_calculation, 'xmlmodel_fixed_box.xml', optimizer='DRMNFB')
-            
-            like1.thaw(like1.par_index('Disk Component','Index'))
-            like1.thaw(like1.par_index('Disk Component','Prefactor'))
-            like1.thaw(like1.par_index('Box Component','Normalization'))
-            like1.tol=1e-5
-            like1obj = pyLike.Minuit(like1.logLike)
-            like1.fit(verbosity=0,optObject=like1obj, covar=False)
-
-            like1.writeXml('xmlmodel_fixed_box.xml')
-            
-            like2 = BinnedAnalysis(obs_calculation, 'xmlmodel_fixed_box.xml', optimizer='NewMinuit')
-            like2.tol=1e-8
-            like2obj = pyLike.Minuit(like1.logLike)
-            like2.fit(verbosity=3,optObject=like1obj, covar=True)
-            
-            
-            #ul = UpperLimit(like1,'Box Component')
-            #ul.compute(emin=100.0,emax=500000, delta=3.91)
-            
-            #box_flux_bayesian[index] = float(ul.bayesianUL()[0])
-            #box_flux_frequentist[index] = float(ul.results[0].value)            
-            print like2.covariance
-            print 'Return code: ' + str(like2obj.getRetCode())
-            cov = like2.covariance
-            corr[index] = cov[0][1]/np.sqrt(cov[0][0]*cov[1][1])
-            corr2[index] = cov[0][2]/np.sqrt(cov[0][0]*cov[2][2])
-            print "Correlations:"
-            print corr[index]
-            print corr2[index]
-            #if like2obj.getRetCode()!=0:
-            plot_spectrum(like2, energies, index, window_low, window_high)
+    indices = range(6,48)
+    #Every edge builds its own analyses, so the per-worker state is just these settings
+    state = {'z':z, 'sourcemap':sourcemap, 'energies':energies, 'calc_cov':calc_cov}
+    results = edge_scan(dict, edge_upper_limit, indices, (state,), files=['xmlmodel_free.xml'], links=[sourcemap, '6gev_ltcube.fits', '6gev_exposure.fits'], processes=processes)
+    for index, (edge_flux, edge_corr, edge_corr2) in zip(indices, results):
+        box_flux[index] = edge_flux
+        corr[index] = edge_corr
+        corr2[index] = edge_corr2
     
     if calc_cov:
         file = open('correlation_results.pk1', 'wb')
@@ -482,7 +491,8 @@ def likelihood_upper_limit3(z):
     
     return box_flux
 
-mc_ul = likelihood_upper_limit3(z=0.44)
+#One worker per slot allocated to the job
+mc_ul = likelihood_upper_limit3(z=0.44, processes=int(os.environ.get('LSB_DJOB_NUMPROC', 1)))
 file = open('/nfs/farm/g/glast/u/johnsarc/p-wave_DM/6gev/wide_box/'+os.environ['LSB_JOBID']+'.pk1','wb')
 pickle.dump(mc_ul,file)
 file.close()
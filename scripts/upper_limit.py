@@ -11,6 +11,18 @@ import scipy
 from scipy.optimize import curve_fit
 from operator import add
 import pickle
+import sys
+import os
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from irfs import e_res, psf, folding_matrix
+from spectra import box_width, folded_box_spectra, write_spectrum
+from model_cube import load_model_cube, IncrementalModel
+from likelihood import PoissonLikelihood, WindowedLoglike, box_ts, covariance_and_correlation, correlation_matrix
+from limits import profile_upper_limit
+from parallel_scan import edge_scan
+from profile_store import save_limits, load_limits
+from snapshots import snapshot, restore, parameter_keys
 
 #Fermi Science Tools
 #from SummedLikelihood import *
@@ -86,105 +98,155 @@ class AnalyticAnalysis(BinnedAnalysis):
     #The fit & optimize methods of BinnedAnalysis already return the minus loglikelihood, but it's unclear exactly how it is calculated
     #Here it's just calculated from the definition
     def loglikelihood(self):
-        #The sourcemap file is needed to calculate the model.
-        sourcemap = self.binnedData.srcMaps
-        f = fits.open(sourcemap)
-
         #Given the results of the fit, calculate the model
-        model_data = np.zeros(f[0].shape)
-        for source in self.sourceNames():
-            the_index = f.index_of(source)
-            model_data += self._srcCnts(source)[:, None, None]*f[the_index].data[:-1, :, :]/np.sum(np.sum(f[the_index].data, axis=2), axis=1)[:-1, None, None]
-        actual_data = np.array(self.binnedData.countsMap.data()).reshape(f[0].shape)
+        model_data = self.getModel()
         #Likelihood value is a product of Poisson factors
-        likelihood = np.sum(np.sum(np.sum(np.log(model_data**actual_data*np.exp(-1.0*model_data)/factorial(actual_data)))))
+        likelihood = self.getPoissonLikelihood().loglike(model_data)
 
         #Return minus log-likelihood- a function to be minimized
         return -1.0*likelihood
 
-    #Calculate the covariance matrix between two sources with a simple difference method. Works on boundary values as well
-    def calculateCovarianceMatrix(self, source_A, parameter_A, source_B, parameter_B):
-        current_val_a = self[source_A]['Spectrum'][parameter_A]
-        current_val_b = self[source_B]['Spectrum'][parameter_B]
-
-        #First, calculate Hessian to a) confirm we are at a minimum and
-        #b) covariance matrix is the inverse of the hessian
-        num_parameters = 2
-        hessian = np.zeros((num_parameters, num_parameters))
-
-        dx_a = 100.0
-        dx_b = np.abs(0.1*current_val_b)
-
-        for a in range(num_parameters):
-            for b in range(num_parameters):
-                print(a, b)
-                if a == b:
-                    if a == 0:
-                        print(self[source_A]['Spectrum'][parameter_A])
-                        self.edit_parameter(source_A, parameter_A, current_val_a+2*dx_a)
-                        print(self[source_A]['Spectrum'][parameter_A])
-                        yiplus1 = self.loglikelihood()
-
-                        self.edit_parameter(source_A, parameter_A, current_val_a+dx_a)
-                        yi = self.loglikelihood()
-
-                        self.edit_parameter(source_A, parameter_A, current_val_a)
-                        yiminus1 = self.loglikelihood()
-                        print(y1plus1, yi, yiminus1)
-                        hessian[a,b] = (yiplus1-2.0*yi+yiminus1)/(dx_a**2)
-                    if a == 1:
-                        self.edit_parameter(source_B, parameter_B, current_val_b+dx_b)
-                        yiplus1 = self.loglikelihood()
-
-                        self.edit_parameter(source_B, parameter_B, current_val_b)
-                        yi = self.loglikelihood()
-
-                        self.edit_parameter(source_B, parameter_B, current_val_b-dx_b)
-                        yiminus1 = self.loglikelihood()
-
-                        hessian[a,b] = (yiplus1-2.0*yi+yiminus1)/(dx_b**2)
-
-                else:
-                    z = np.zeros((2,2))
-                    self.edit_parameter(source_A, parameter_A, current_val_a+2*dx_a)
-                    self.edit_parameter(source_B, parameter_B, current_val_b+dx_b)
-                    z[0,0] = self.loglikelihood()
-
-                    self.edit_parameter(source_A, parameter_A, current_val_a+2*dx_a)
-                    self.edit_parameter(source_B, parameter_B, current_val_b-dx_b)
-                    z[0,1] = self.loglikelihood()
-
-                    self.edit_parameter(source_A, parameter_A, current_val_a)
-                    self.edit_parameter(source_B, parameter_B, current_val_b+dx_b)
-                    z[1,0] = self.loglikelihood()
-
-                    self.edit_parameter(source_A, parameter_A, current_val_a)
-                    self.edit_parameter(source_B, parameter_B, current_val_b-dx_b)
-                    z[1,1] = self.loglikelihood()
-                    hessian[a,b] = (z[1,1]-z[0,1]-z[1,0]+z[0,0])/(4.0*dx_a*dx_b)
-
-        if np.sign(np.linalg.det(hessian)) == -1.0:
-            print("WARNING: Determinant of Hessian matrix is negative- you are probably not at an extremum of the function you are trying to optimize")
-            return 0
-        print("hessian = " + str(hessian))
-
-        #Covariance matrix is the inverse of the hessian
-        covariance = np.linalg.inv(hessian)
-        self.covariance = covariance
+    #Analytic gradient of the minus log-likelihood with respect to normalization-like parameters
+    #varying: (source, parameter) pairs the source counts are proportional to, as in incrementalModel
+    def loglikelihoodGradient(self, varying):
+        cube = load_model_cube(self.binnedData.srcMaps, self.sourceNames())
+        counts = np.array([self._srcCnts(source) for source in cube.source_names])
+        likelihood, gradient = self.getPoissonLikelihood().counts_gradient(cube, counts)
+        #d logL/dN = sum over bins of d logL/d counts * counts per unit N, taken at N=1 when N
+        #is 0 (the box of the null fit), as in incrementalModel
+        result = []
+        for source, parameter in varying:
+            current_value = self[source]['Spectrum'][parameter]
+            reference = current_value if current_value != 0.0 else 1.0
+            unit_counts = self._shiftedCounts(source, {parameter:reference-current_value})/reference
+            result.append(-1.0*np.sum(gradient[cube.index[source]]*unit_counts))
+        return np.array(result)
+
+    #The data-only terms of the likelihood are computed once per analysis object
+    def getPoissonLikelihood(self):
+        if getattr(self, '_poisson_likelihood', None) is None:
+            shape = load_model_cube(self.binnedData.srcMaps, self.sourceNames()).shape
+            self._poisson_likelihood = PoissonLikelihood(np.array(self.binnedData.countsMap.data()).reshape(shape))
+        return self._poisson_likelihood
+
+    #Log-likelihood of the current model split by energy bin, with cumulative sums so any
+    #energy window or its sidebands is a lookup, e.g. windows.window(index-6, index+2)
+    def windowedLoglikelihood(self):
+        return WindowedLoglike(self.getPoissonLikelihood().bin_loglike(self.getModel()))
+
+    #Counts per energy bin of one source with some of its spectral parameters moved,
+    #shifts = {parameter: offset}; the parameters are put back afterwards
+    def _shiftedCounts(self, source_name, shifts):
+        saved = dict((name, self[source_name]['Spectrum'][name]) for name in shifts)
+        for name in shifts:
+            self.edit_parameter(source_name, name, saved[name]+shifts[name])
+        counts = np.array(self._srcCnts(source_name), dtype=float)
+        for name in shifts:
+            self.edit_parameter(source_name, name, saved[name])
+        return counts
+
+    #Observed Fisher information (the Hessian of -logL) of the parameters with the given
+    #indices into params(), at their current values. All pairs come from one pass over the
+    #pixels (PoissonLikelihood.counts_hessian). The native engine has analytic spectral
+    #derivatives; otherwise the derivatives of the counts per bin are differences of
+    #_srcCnts, which only re-evaluates spectra. step is relative to each value, and the
+    #difference stencil is shifted inside the bounds for parameters sitting on a boundary
+    def fisherInformation(self, indices, step=1e-4):
+        if hasattr(BinnedAnalysis, 'fisher_information'):
+            return BinnedAnalysis.fisher_information(self, [self.params()[k].parameter for k in indices])
+        cube = load_model_cube(self.binnedData.srcMaps, self.sourceNames())
+        keys = parameter_keys(self)
+        keys = [keys[k] for k in indices]
+        steps = []
+        offsets = []
+        for k in indices:
+            value = self.params()[k].parameter.getValue()
+            lower, upper = self.params()[k].parameter.getBounds()
+            h = step*(abs(value) if value != 0.0 else 1.0)
+            steps.append(h)
+            offsets.append(0 if value-h>=lower and value+h<=upper else (1 if value-h<lower else -1))
+
+        derivatives = []
+        second = {}
+        for j, (source_name, name) in enumerate(keys):
+            h, a = steps[j], offsets[j]
+            plus = self._shiftedCounts(source_name, {name:(a+1)*h})
+            minus = self._shiftedCounts(source_name, {name:(a-1)*h})
+            derivatives.append((cube.index[source_name], (plus-minus)/(2.0*h)))
+            second[(j, j)] = (plus-2.0*self._shiftedCounts(source_name, {name:a*h})+minus)/h**2
+            for k in range(j):
+                if keys[k][0] != source_name:
+                    continue
+                other, h_k, a_k = keys[k][1], steps[k], offsets[k]
+                corners = [self._shiftedCounts(source_name, {name:(a+s)*h, other:(a_k+t)*h_k}) for s, t in [(1, 1), (1, -1), (-1, 1), (-1, -1)]]
+                second[(k, j)] = (corners[0]-corners[1]-corners[2]+corners[3])/(4.0*h*h_k)
+        counts = np.array([self._srcCnts(source_name) for source_name in cube.source_names])
+        return self.getPoissonLikelihood().counts_hessian(cube, counts, derivatives, second)
+
+    #Covariance matrix of the (source, parameter) pairs in parameters, all free parameters if
+    #None, as the inverse of the observed Fisher information at the current values (call
+    #it right after the fit). The correlation matrix is kept too, and covariance_keys gives
+    #the (source, parameter) of each row
+    def calculateCovarianceMatrix(self, parameters=None):
+        if parameters is None:
+            indices = [k for k, p in enumerate(self.params()) if p.parameter.isFree()]
+        else:
+            indices = [self.par_index(source_name, name) for source_name, name in parameters]
+        information = self.fisherInformation(indices)
+        if np.any(np.linalg.eigvalsh(information)<=0.0):
+            print("WARNING: Fisher information is not positive definite- you are probably not at a minimum of -logL, or a parameter is unconstrained")
+        self.covariance, self.correlation = covariance_and_correlation(information)
+        keys = parameter_keys(self)
+        self.covariance_keys = [keys[k] for k in indices]
+        return self.covariance
 
     def getCovarianceMatrix(self):
         return self.covariance
 
-    def calculateCorrelationMatrix(self, covariance):
-        correlation = np.zeros((covariance.shape))
-        for a in covariance.shape[0]:
-            for b in covariance.shape[1]:
-                correlation[a,b] = covariance[a][b]/np.sqrt(float(covariance[a][a])*float(covariance[b][b]))
-        self.correlation = correlation
+    def calculateCorrelationMatrix(self, covariance=None):
+        if covariance is None:
+            covariance = self.covariance
+        self.correlation = correlation_matrix(covariance)
+        return self.correlation
+
+    #Correlation coefficients of one parameter with others, a list of (source, parameter)
+    #pairs; by default every spectral parameter of the other sources that free_all_sources
+    #frees. They come from the Fisher information at the current values (one pass over the
+    #pixels, see fisherInformation), so right after a fit they cost next to nothing
+    #Returns the correlations and the (source, parameter) of each
+    def correlationsWith(self, source_name, parameter_name, others=None):
+        if others is None:
+            others = [key for key in parameter_keys(self) if key is not None and key[0] != source_name and key[1] not in ('Scale', 'Eb')]
+        indices = [self.par_index(source_name, parameter_name)]+[self.par_index(s, p) for s, p in others]
+        covariance, correlation = covariance_and_correlation(self.fisherInformation(indices))
+        return correlation[0, 1:], list(others)
 
     def getCorrelationMatrix(self):
         return self.correlation
 
+    #Model counts cube for the current parameters. The normalized srcmap templates
+    #are loaded once per srcmap and shared (see model_cube.py)
+    def getModel(self):
+        return load_model_cube(self.binnedData.srcMaps, self.sourceNames()).model_from_like(self)
+
+    #Fixed background plus linear components, for fast scans of normalization-like parameters
+    #varying: (source, parameter) pairs the source counts are proportional to, e.g.
+    #[('Box_Component', 'Normalization'), ('Disk Component', 'Prefactor')]
+    #The amplitudes of the returned IncrementalModel are values of those parameters
+    def incrementalModel(self, varying):
+        cube = load_model_cube(self.binnedData.srcMaps, self.sourceNames())
+        background = dict((source, self._srcCnts(source)) for source in self.sourceNames())
+        components = []
+        for source, parameter in varying:
+            current_value = self[source]['Spectrum'][parameter]
+            reference = current_value if current_value != 0.0 else 1.0
+            self.edit_parameter(source, parameter, reference)
+            components.append((source, self._srcCnts(source)/reference))
+            self.edit_parameter(source, parameter, current_value)
+            background[source] = np.zeros(len(background[source]))
+        actual_data = np.array(self.binnedData.countsMap.data()).reshape(cube.shape)
+        return IncrementalModel(cube, background, components, actual_data)
+
     def getSpectrum(self):
         spectrum = np.zeros((num_ebins-1))
         for source in self.sourceNames():
@@ -193,19 +255,13 @@ class AnalyticAnalysis(BinnedAnalysis):
 
     #Make a plot of the data/model/residuals
     def roiPlot(self):
-        sourcemap = self.binnedData.srcMaps
-        f = fits.open(sourcemap)
-
         image_data = fits.getdata('6gev_image.fits')
         filename = get_pkg_data_filename('6gev_image.fits')
         hdu = fits.open(filename)[0]
         wcs = WCS(hdu.header)
         #Given the results of the fit, calculate the model
-        model_data = np.zeros(f[0].shape)
-        for source in self.sourceNames():
-            the_index = f.index_of(source)
-            model_data += self._srcCnts(source)[:, None, None]*f[the_index].data[:-1, :, :]/np.sum(np.sum(f[the_index].data, axis=2), axis=1)[:-1, None, None]
-        actual_data = np.array(self.binnedData.countsMap.data()).reshape(f[0].shape)
+        model_data = self.getModel()
+        actual_data = np.array(self.binnedData.countsMap.data()).reshape(model_data.shape)
 
         fig = plt.figure(figsize=[14,6])
 
@@ -249,42 +305,109 @@ class AnalyticAnalysis(BinnedAnalysis):
 
         plt.show()
 
-    def likelihoodMap(self, source_A, parameter_A, source_B, parameter_B, res = 10, verbose=False, generate_plot=False):
+    #Whether the counts of a source are proportional to one of its parameters, i.e. the
+    #parameter is a normalization, checked at the current value and half of it
+    def _isLinear(self, source_name, parameter_name):
+        value = self[source_name]['Spectrum'][parameter_name]
+        reference = value if value != 0.0 else 1.0
+        full = self._shiftedCounts(source_name, {parameter_name:reference-value})
+        half = self._shiftedCounts(source_name, {parameter_name:0.5*reference-value})
+        return np.allclose(half, 0.5*full, rtol=1e-9, atol=0.0)
+
+    #Fixed background of every other source plus the bare templates (unit counts in every
+    #bin) of the sources varied by a map over keys, a list of (source, parameter) pairs
+    def mapModel(self, keys):
+        sources = map_sources(keys)
+        cube = load_model_cube(self.binnedData.srcMaps, self.sourceNames())
+        background = dict((s, self._srcCnts(s)) for s in self.sourceNames() if s not in sources)
+        return IncrementalModel(cube, background, [(s, np.ones(cube.n_ebins)) for s in sources], np.array(self.binnedData.countsMap.data()).reshape(cube.shape))
+
+    #Counts per bin of the sources varied by a map over keys at every point of one row,
+    #shape (len(spaces[1]), n_sources, n_ebins). keys[0] runs along the rows with values
+    #spaces[0]; along a row a linear (normalization-like) keys[1] only scales the counts,
+    #so the spectra are evaluated once, otherwise at every point
+    def mapRowCounts(self, keys, spaces, linear, row):
+        sources = map_sources(keys)
+        def counts_at(values):
+            return np.array([self._shiftedCounts(s, dict((p, value-self[t]['Spectrum'][p]) for (t, p), value in values.items() if t == s)) for s in sources])
+        u = spaces[0][row]
+        if linear:
+            reference = spaces[1][-1] if spaces[1][-1] != 0.0 else 1.0
+            scale = np.ones((len(spaces[1]), len(sources)))
+            scale[:, sources.index(keys[1][0])] = spaces[1]/reference
+            return scale[:, :, None]*counts_at({keys[0]:u, keys[1]:reference})[None]
+        return np.array([counts_at({keys[0]:u, keys[1]:v}) for v in spaces[1]])
+
+    #Map of -logL over two parameters, (source_A, parameter_A) along the rows (x) and
+    #(source_B, parameter_B) along the columns (y), everything else held at its current value
+    #Each axis spans cutoff_delta_loglike around the current value (the best fit), as given by
+    #the Fisher information of the pair, within the parameter bounds. The grid is evaluated a
+    #row at a time on the cached templates (IncrementalModel.loglike_bins_grid), with the
+    #counts per bin of the varying sources as amplitudes (see mapRowCounts). Rows run along
+    #the non-linear parameter, if there is one, and are spread over processes workers, which
+    #evaluate the spectra and the likelihood of their rows (see map_row)
+    #Returns a dict with the grid x, y, the -logL map (res, res) and the -logL levels of the
+    #68.3, 95.4 and 99.7% confidence regions for two parameters
+    def likelihoodMap(self, source_A, parameter_A, source_B, parameter_B, res=10, verbose=False, generate_plot=False, cutoff_delta_loglike=10.0, processes=1):
         print("Making likelihood map...")
-        like_mat = np.zeros((res,res))
-        l = 0
-        k = 0
-
-        #Find a good range of parameters from the Hessian
-        cutoff_delta_loglike = 10.0
-        xspace = np.linspace(max(0,current_val_a-np.sqrt(2*cutoff_delta_loglike/hessian[0,0])), current_val_a+np.sqrt(2*cutoff_delta_loglike/hessian[0,0]), res)
-        yspace = np.linspace(current_val_b-np.sqrt(2*cutoff_delta_loglike/hessian[1,1]), current_val_b+np.sqrt(2*cutoff_delta_loglike/hessian[1,1]), res)
-        for xval in xspace:
-            l = 0
-            for yval in yspace:
-                self.edit_parameter(source_A, parameter_A, xval)
-                self.edit_parameter(source_B, parameter_B, yval)
-
-                like_mat[k, l] = self.loglikelihood()
-                if verbose:
-                    print(source_B + " " + parameter_B + " = " + str(self[source_B]['Spectrum'][parameter_B]))
-                    print(source_A + " " + parameter_A + " = " + str(self[source_A]['Spectrum'][parameter_A]))
-                l += 1
-            k += 1
-
-        fig = plt.figure(figsize=[10,10])
-        ax = fig.add_subplot(111)
-        mappable = plt.imshow(like_mat, origin='lower', extent=[min(yspace), max(yspace), min(xspace), max(xspace)], aspect='auto')
-        plt.colorbar(mappable, label='LogLikelihood')
-        plt.xlabel(source_B + " " + parameter_B)
-        plt.ylabel(source_A + " " + parameter_A)
-
-        self.edit_parameter(source_A, parameter_A, current_val_a)
-        self.edit_parameter(source_B, parameter_B, current_val_b)
-
-        fig.tight_layout()
-        plt.show()
-
+        keys = [(source_A, parameter_A), (source_B, parameter_B)]
+
+        #Find a good range of parameters from the Fisher information
+        covariance, correlation = covariance_and_correlation(self.fisherInformation([self.par_index(s, p) for s, p in keys]))
+        spaces = []
+        for (s, p), variance in zip(keys, np.diag(covariance)):
+            current = self[s]['Spectrum'][p]
+            width = np.sqrt(2.0*cutoff_delta_loglike*abs(variance))
+            if not np.isfinite(width) or width == 0.0:
+                width = 0.1*abs(current) if current != 0.0 else 1.0
+            lower, upper = self.params()[self.par_index(s, p)].parameter.getBounds()
+            spaces.append(np.linspace(max(lower, current-width), min(upper, current+width), res))
+            if verbose:
+                print(s + " " + p + " from " + str(spaces[-1][0]) + " to " + str(spaces[-1][-1]))
+
+        linear = [self._isLinear(s, p) for s, p in keys]
+        order = [1, 0] if linear[0] and not linear[1] else [0, 1]
+        map_args = (self, [keys[k] for k in order], [spaces[k] for k in order], linear[order[1]])
+        #Nothing is written, so the workers need no scratch directories
+        like_mat = np.array(edge_scan(map_setup, map_row, range(res), map_args, processes=processes, scratch=False))
+        if order[0] == 1:
+            like_mat = like_mat.T
+        xspace, yspace = spaces
+
+        #For 2 degrees of freedom the chi2 quantile is -2 log(1-cl)
+        levels = np.min(like_mat)-np.log(1.0-np.array([0.6827, 0.9545, 0.9973]))
+
+        if generate_plot:
+            fig = plt.figure(figsize=[10,10])
+            ax = fig.add_subplot(111)
+            mappable = plt.imshow(like_mat, origin='lower', extent=[min(yspace), max(yspace), min(xspace), max(xspace)], aspect='auto')
+            plt.colorbar(mappable, label='-LogLikelihood')
+            plt.contour(yspace, xspace, like_mat, levels, colors='white', linewidths=1.5)
+            plt.xlabel(source_B + " " + parameter_B)
+            plt.ylabel(source_A + " " + parameter_A)
+            fig.tight_layout()
+            plt.show()
+
+        return {'x':xspace, 'y':yspace, 'loglike':like_mat, 'levels':levels}
+
+
+#Sources varied by a map over keys, a list of (source, parameter) pairs
+def map_sources(keys):
+    sources = []
+    for source_name, parameter_name in keys:
+        if source_name not in sources:
+            sources.append(source_name)
+    return sources
+
+#Worker state of AnalyticAnalysis.likelihoodMap (see parallel_scan.py): the model of the
+#varying sources over the fixed background is built once per worker
+def map_setup(like, keys, spaces, linear):
+    return {'like':like, 'keys':keys, 'spaces':spaces, 'linear':linear, 'model':like.mapModel(keys)}
+
+#-logL along one row of the map
+def map_row(state, row):
+    counts = state['like'].mapRowCounts(state['keys'], state['spaces'], state['linear'], row)
+    return -1.0*state['model'].loglike_bins_grid(counts)
 
 #Strictly finds the Poisson upper limit (problematic for large counts)
 def upper_limit(N,conf,b):
@@ -341,24 +464,9 @@ def chisquared(data,theory):
         if theory[i]>0.0:
             thesum += (theory[i]-data[i])**2/(float(theory[i]))
     return thesum
+#-TS of a box on top of model_counts, all binned spectra (see likelihood.box_ts)
 def loglikelihood(counts,model_counts,box):
-    f0 = 0.0
-    f1 = 0.0
-    for i in range(len(counts)):
-        #m = number of counts
-        m = counts[i]
-        #null hypothesis counts:
-        mu0 = model_counts[i]
-        #background+signal counts
-        mu1 = model_counts[i]+box[i]
-        #Do we need stirling's approximation?
-        if m>20:
-            f0 += m-mu0+m*np.log(mu0/m)-0.5*np.log(m)-np.log(np.sqrt(2*np.pi))
-            f1 += m-mu1+m*np.log(mu1/m)-0.5*np.log(m)-np.log(np.sqrt(2*np.pi))
-        else:
-            f0 += np.log((mu0**m)*np.exp(-1.0*mu0)/factorial(m))
-            f1 += np.log((mu1**m)*np.exp(-1.0*mu1)/factorial(m))
-    return 2*(f0-f1)
+    return -1.0*box_ts(counts, model_counts, box)[0]
 
 def sigma_given_p(p):
     x = np.linspace(-200, 200, 50000)
@@ -377,27 +485,6 @@ def multiply_multidimensional_array(vec,cube):
     for i in range(len(vec)):
         result[i,:,:] = vec[i]*cube[i,:,:]
     return result
-#Energy resolution (E Disp class 1- pretty close to the total)
-def e_res(E):
-    energy = np.array([31.718504,54.31288,95.86265,171.82704,307.93054,535.1251,944.0604,1716.8848,3074.5315,5339.1763,9559.056,17111.936,29704.664,53986.227,93706.14,167702.28,300152.7,520977.8,931974.8,1690808.0,2974747.2])
-    res = np.array([0.2942218,0.25078142,0.21741302,0.1813951,0.15067752,0.12313887,0.10302135,0.090325624,0.08080946,0.07341215,0.07025641,0.070810914,0.07454435,0.080399856,0.08678346,0.094758466,0.10061333,0.10752697,0.25969607,0.18390165,0.24169934])
-    closest = np.argmin(np.abs(E-energy))
-    if E-energy[closest]>0.:
-        frac = (E-energy[closest])/(energy[closest+1]-energy[closest])
-        return res[closest]+frac*(res[closest+1]-res[closest])
-    else:
-        frac = (E-energy[closest-1])/(energy[closest]-energy[closest-1])
-        return res[closest-1]+frac*(res[closest]-res[closest-1])
-def psf(E):
-    energy = np.array([9.91152,17.36871,31.150045,54.59528,96.42895,171.62605,303.14316,539.58026,967.85913,1709.5619,3066.256,5374.1895,9712.058,17151.041,29366.348,52649.074,92947.98,167911.25,298723.0,527422.3,952855.0,1682382.6,2993103.8])
-    psf = np.array([22.122343,17.216175,11.960119,8.108732,5.279108,3.5216076,2.2375877,1.3988715,0.8535155,0.53358656,0.347393,0.23173566,0.17039458,0.12837319,0.112826064,0.10581638,0.10334797,0.10426899,0.10101496,0.09097172,0.08671612,0.07683781,0.073241934])
-    closest = np.argmin(np.abs(E-energy))
-    if E-energy[closest]>0.:
-        frac = (E-energy[closest])/(energy[closest+1]-energy[closest])
-        return psf[closest]+frac*(psf[closest+1]-psf[closest])
-    else:
-        frac = (E-energy[closest-1])/(energy[closest]-energy[closest-1])
-        return psf[closest-1]+frac*(psf[closest]-psf[closest-1])
 #Just a gaussian function, representing the energy dispersion of the detector
 def blur(x,offset,sigma):
     return np.exp(-1.0*(x-offset)**2/(2*sigma**2))/np.sqrt(2*np.pi*sigma**2)
@@ -411,31 +498,19 @@ def get_integral(x,g):
         print("Length of x is " + str(len(x)) + " Length of g is " + str(len(g)))
     return sum(np.diff(x)*0.5*(g[0:len(g)-1]+g[1:len(g)]))
 
-def update_box_spectrum(energy, zeta):
-    box_width = energy*2.0*np.sqrt(1.0-zeta)/(1+np.sqrt(1.0-zeta))
-    box_beginning = energy-box_width
-    #Edit box_spectrum.dat
-    spectrum_file = open('box_spectrum.dat','w')
-    #What's the normalization constant here?
-    #Total flux is E_edge*function value
-    #Function_value = total_flux/E_edge
-    x_fine_grid = np.linspace(0.0, 800000, 10000)
-    n_leading_zeros = int(np.argmin(np.abs(x_fine_grid-box_beginning)))
-    n_trailing_zeros = 10000-int(np.argmin(np.abs(x_fine_grid-energy)))
-    n_box_width = int(10000-n_leading_zeros-n_trailing_zeros)
-    pure_box = np.concatenate([np.zeros((n_leading_zeros)),np.concatenate([1.0+np.zeros((n_box_width)),np.zeros((n_trailing_zeros))])])
-
-    #Sigma here is the absolute energy resolution as a function of energy
-    sigma = e_res(energy)*energy*10000./800000.0
-
-    dispersion = blur(np.linspace(0,6*sigma,6*sigma),3*sigma,sigma)
-    convolved_pure_box = np.convolve(pure_box, dispersion,'same')
-    integrated_box_flux = get_integral(x_fine_grid, convolved_pure_box)
-    for i in range(len(x_fine_grid)):
-        spectrum_file.write(str(x_fine_grid[i])+" " + str(max(convolved_pure_box[i]/integrated_box_flux, 10.**-35))+"\n")
-    spectrum_file.close()
-
-    return box_width, integrated_box_flux
+def update_box_spectrum(energy, zeta, bank=None):
+    #Precomputed templates are used when a bank is given (see template_bank.py)
+    if bank is not None:
+        z, e = bank.locate_energy(energy, zeta)
+        bank.link_spectrum('box_spectrum.dat', bank.edge_indices[e], zeta)
+        return box_width(energy, zeta), float(bank.flux[z, e])
+
+    #Unsmeared box forward-folded through the energy dispersion matrix (see spectra.py)
+    matrix, fold_edges = folding_matrix(energies)
+    spectrum, grid, integrated_box_flux = folded_box_spectra(matrix, fold_edges, fold_edges, energy, zeta)
+    write_spectrum('box_spectrum.dat', grid, spectrum[0, 0])
+
+    return box_width(energy, zeta), integrated_box_flux[0, 0]
 
 def quadratic(x, a, b, c):
     return a*x**2+b*x+c
@@ -444,31 +519,102 @@ num_ebins = 51 #1 more than the number of bins due to the fencepost problem
 energies = 10**np.linspace(np.log10(6000),np.log10(800000),num_ebins)
 ebin_widths = np.diff(energies)
 
-def likelihood_upper_limit3(zeta, sourcemap, poisson=False):
+#Analysis state of an edge scan, built once per worker (see parallel_scan.py): the data
+#and the scan settings. The analysis itself is built per edge in scan_edge
+#With poisson=True, sourcemap holds the fluctuated data
+def scan_setup(zeta, sourcemap, poisson=False, bank=None):
+    print("Loading data...")
+    obs = BinnedObs(srcMaps=sourcemap, expCube='6gev_ltcube.fits', binnedExpMap='6gev_exposure.fits', irfs='P8R2_SOURCE_V6')
+    print("obs loaded")
+    return {'obs':obs, 'zeta':zeta, 'poisson':poisson, 'bank':bank}
+
+#Upper limit, best fit and delta log like of the box with upper edge energies[index], and
+#its correlations with every nuisance parameter at the best fit
+#Returns (box_flux, correlations, (source, parameter) of each correlation)
+def scan_edge(state, index):
     scale_factor = 1e-15
     crit_chi2 = 2.71 #For 95% confidence one-sided upper limit with 1 degree of freedom
+    box_flux = np.zeros(3)
 
-    #Arrays to store results in
+    print("Evaluating box with upper edge " + str(energies[index]) + " MeV in bin " + str(index))
+    #Update the box spectrum
+    box_width, integrated_box_flux = update_box_spectrum(energies[index], state['zeta'], state['bank'])
+
+    #The Science Tools read box_spectrum.dat when the XML is parsed, so the analysis is
+    #built after the spectrum is written, once per edge
+    if state['poisson']:
+        like = AnalyticAnalysis(state['obs'], 'xmlmodel.xml', optimizer='NewMinuit')
+        like.tol=1e-9
+    else:
+        like = AnalyticAnalysis(state['obs'], 'xmlmodel.xml', optimizer='MINUIT')
+    #Warm start from the fit of the previous edge in this process rather than from the
+    #XML values
+    if 'fit' in state:
+        restore(like, state['fit'])
+    print("Fitting...")
+    like.free_all_sources()
+    likeobj = pyLike.Minuit(like.logLike)
+    loglike = like.fit(verbosity=0, optObject=likeobj, covar=False)
+    if state['poisson']:
+        print("Return code: " + str(likeobj.getRetCode()))
+        print("loglike = " + str(loglike))
+        while loglike> 18000.0:
+            loglike = like.fit(verbosity=0,optObject=likeobj, covar=False)
+            print("Return code: " + str(likeobj.getRetCode()))
+            print("loglike = " + str(loglike))
+        like.freeze_all_sources()
+    state['fit'] = snapshot(like)
+    #Correlations of the box with the nuisance parameters, from the same best fit
+    correlations, names = like.correlationsWith('Box_Component', 'Normalization')
+
+    #Output spectrum info
+    box_spectrum = like._srcCnts('Box_Component')
+    window_spectrum = like.getSpectrum()
+    complete_spectrum = like.nobs
+
+    like.thaw(like.par_index('Disk Component','Prefactor'))
+    like.freeze(like.par_index('Box_Component', 'Normalization'))
+    print("Solving for the upper limit...")
+    #-logL profiled over the disk prefactor at a fixed box normalization
+    def profile(x):
+        like.edit_parameter('Box_Component', 'Normalization', x)
+        return like.fit(verbosity=0, covar=False)
+    #Bracket and solve for the best fit and for -logL = min + crit_chi2 instead of scanning
+    limit = profile_upper_limit(profile, 0.0, 10**-11/scale_factor, crit_chi2)
+    print("Profile evaluations: " + str(limit['evaluations']) + " (" + str(limit['message']) + ")")
+
+    #Results
+    box_flux[0] = limit['upper_limit']*scale_factor #Flux upper limit
+    box_flux[1] = limit['best_fit']*scale_factor #Best fit flux
+    box_flux[2] = -0.5*limit['ts'] #Delta log like for best-fit flux
+    print("Best-fit box = " + str(box_flux[1]))
+    if box_flux[1]>0.0:
+        print("Significance = " + str(sigma_given_p(pvalue_given_chi2(-2.0*box_flux[2], 1))) + " sigma")
+    print("Box upper limit = " + str(box_flux[0]))
+
+    for (source_name, parameter_name), correlation in zip(names, correlations):
+        print("Correlation with " + source_name + " " + parameter_name + ": " + str(correlation))
+    return box_flux, correlations, names
+
+#processes: number of worker processes for the edges, all cores if None
+#path: directory to save the limits and correlations in (see profile_store.save_limits)
+#Returns box_flux (num_ebins-1, 3) and correlations (num_ebins, number of nuisance parameters)
+def likelihood_upper_limit3(zeta, sourcemap, poisson=False, bank=None, processes=1, path=None):
+    #Array to store results in
     box_flux = np.zeros((num_ebins-1, 3))
-    correlations = np.zeros((num_ebins, 2))
     #sourcemap = '6gev_srcmap_03.fits'
 
-    #Instantiate the analysis objects
-    print("Loading data...")
-    obs_complete = BinnedObs(srcMaps=sourcemap, expCube='6gev_ltcube.fits', binnedExpMap='6gev_exposure.fits', irfs='P8R2_SOURCE_V6')
-    print("obs loaded")
-    like = AnalyticAnalysis(obs_complete, 'xmlmodel.xml', optimizer='MINUIT')
-
     #For MC study i.e. making Brazil plot bands
+    #The fluctuations are drawn once, here, so every worker fits the same data
     if poisson:
+        print("Loading data...")
+        obs_complete = BinnedObs(srcMaps=sourcemap, expCube='6gev_ltcube.fits', binnedExpMap='6gev_exposure.fits', irfs='P8R2_SOURCE_V6')
+        like = AnalyticAnalysis(obs_complete, 'xmlmodel.xml', optimizer='MINUIT')
         print("Calculating fluctuations...")
         #Poisson fluctuations of the data
         f = fits.open(sourcemap)
         #Given the results of the fit, calculate the model
-        model_data = np.zeros(f[0].shape)
-        for source in like.sourceNames():
-            the_index = f.index_of(source)
-            model_data += like._srcCnts(source)[:, None, None]*f[the_index].data[:-1, :, :]/np.sum(np.sum(f[the_index].data, axis=2), axis=1)[:-1, None, None]
+        model_data = like.getModel()
 
         #Introduce Poisson fluctuations on top of the model
         poisson_data = np.random.poisson(model_data)
@@ -477,96 +623,31 @@ def likelihood_upper_limit3(zeta, sourcemap, poisson=False):
         f[0].data = poisson_data
         f.writeto('box_srcmap_poisson.fits')
         f.close()
-        obs_poisson = BinnedObs(srcMaps='box_srcmap_poisson.fits', expCube='6gev_ltcube.fits', binnedExpMap='6gev_exposure.fits', irfs='P8R2_SOURCE_V6')
+        sourcemap = 'box_srcmap_poisson.fits'
 
     #Loop through upper edge of box
-    for index in range(29,48):
-        print("Evaluating box with upper edge " + str(energies[index]) + " MeV in bin " + str(index))
-        #Update the box spectrum
-        box_width, integrated_box_flux = update_box_spectrum(energies[index], zeta)
-    	like.free_all_sources()
-    	#like.freeze(like.par_index('Box_Component','Normalization'))
-    	likeobj = pyLike.Minuit(like.logLike)
-    	loglike = like.fit(verbosity=0, optObject=likeobj, covar=False)
-
-    	#print('loglike = ' + str(loglike))
-    	#while loglike>15830.0:
-    	#    loglike = like.fit(verbosity=0, optObject=likeobj, covar=False)
-    	#    print('loglike = '+str(loglike))
-    	#like.freeze_all_sources()
-    	#print(dir(like))
-    	#myDict = {}
-            #for source in like.sourceNames():
-    	#    print(like._srcCnts(source))
-    	#    myDict[source] = like._srcCnts(source)
-    	#file = open('fitResults001.pk1','wb')
-    	#pickle.dump(myDict,file)
-    	#file.close()
-    	#input('wait for key')
-
-    	if poisson:
-                like = AnalyticAnalysis(obs_poisson, 'xmlmodel.xml', optimizer='NewMinuit')
-                print("Fitting...")
-                likeobj = pyLike.Minuit(like.logLike)
-                like.free_all_sources()
-                like.tol=1e-9
-                loglike = like.fit(verbosity=0,optObject=likeobj, covar=False)
-                print("Return code: " + str(likeobj.getRetCode()))
-                print("loglike = " + str(loglike))
-                while loglike> 18000.0:
-                    loglike = like.fit(verbosity=0,optObject=likeobj, covar=False)
-                    print("Return code: " + str(likeobj.getRetCode()))
-                    print("loglike = " + str(loglike))
-                like.freeze_all_sources()
-
-        #Output spectrum info
-        box_spectrum = self._srcCnts('Box_Component')
-        window_spectrum = self.getSpectrum()
-        complete_spectrum = self.nobs
-
-        like.thaw(like.par_index('Disk Component','Prefactor'))
-        print("Scanning likelihood...")
-        #Scan the likelihood profile to find best-fit value and upper limit
-        minx = 0.0
-        maxx = 10**-9/scale_factor
-        x_range, l_range = like.scan('Box_Component', 'Normalization', minx, maxx, 200)
-        #maxx = x_range[max(1, np.argmin(np.abs(l_range-(crit_chi2+min(l_range)))))]*2.0
-
-        #Results
-        box_flux[index, 0] = x_range[np.argmin(np.abs(l_range-(crit_chi2+min(l_range))))]*scale_factor #Flux upper limit
-        box_flux[index, 1] = x_range[np.argmin(l_range)]*scale_factor #Best fit flux
-        box_flux[index, 2] = l_range[np.argmin(l_range)]-l_range[0] #Delta log like for best-fit flux
-        print("Best-fit box = " + str(box_flux[index,1]))
-        if box_flux[index,1]>0.0:
-            print("Significance = " + str(sigma_given_p(pvalue_given_chi2(-2.0*box_flux[index,2], 1))) + " sigma")
-        print("Box upper limit = " + str(box_flux[index, 0]))
-
-        print("Calculating correlation matrix...")
-        #Correlations between the sources
-        #like.calculateCovarianceMatrix('Box_Component', 'Normalization', 'Disk Component', 'Prefactor')
-        #like.calculateCorrelationMatrix()
-        #correlations[index, 0] = like.correlation[0,1]
-
-        #like.calculateCovarianceMatrix('Box_Component', 'Normalization', 'Disk Component', 'Index')
-        #like.calculateCorrelationMatrix()
-        #correlations[index, 1] = like.correlation[0,1]
-
-        print("Correlation with GC Prefactor: " + str(correlations[index,0]))
-        print("Correlation with GC Index: " + str(correlations[index,0]))
-
+    indices = range(29,48)
+    results = edge_scan(scan_setup, scan_edge, indices, (zeta, sourcemap, poisson, bank), files=['xmlmodel.xml', 'box_spectrum.dat'], links=[sourcemap, '6gev_ltcube.fits', '6gev_exposure.fits'], processes=processes)
+    names = results[0][2]
+    correlations = np.zeros((num_ebins, len(names)))
+    for index, (edge_flux, edge_correlations, edge_names) in zip(indices, results):
+        box_flux[index] = edge_flux
+        correlations[index] = edge_correlations
+    if path is not None:
+        save_limits(path, zeta, box_flux, correlations, names)
 
     return box_flux, correlations
 
 
 
 def main():
-    #[z99_ul, z99_corr] = likelihood_upper_limit3(0.9999, sourcemap, poisson=True)
+    #[z99_ul, z99_corr] = likelihood_upper_limit3(0.9999, sourcemap, poisson=True, path='limits')
     #file = open('/nfs/farm/g/glast/u/johnsarc/p-wave_DM/6gev/z99.pk1','wb')
     #pickle.dump([z99_ul, z99_corr],file)
     #file.close()
 
     #sourcemap = '6gev_srcmap_03.fits'
-    #[z44_ul, z44_corr] = likelihood_upper_limit3(0.44, sourcemap)
+    #[z44_ul, z44_corr] = likelihood_upper_limit3(0.44, sourcemap, path='limits')
     #file = open('/nfs/farm/g/glast/u/johnsarc/p-wave_DM/6gev/z44.pk1','wb')
     #pickle.dump([z44_ul, z44_corr],file)
     #file.close()
@@ -585,14 +666,10 @@ def main():
 
 
     brazil_dict = consolidate_brazil_lines('brazil_wide_box.pk1')
-    file = open('z44.pk1','rb')
-    [z44_ul, z44_corr_blank] = pickle.load(file)
-    file.close()
-    #Did this twice because you want to use NewMinuit to set limits, and MINUIT for correlations
-    file = open('z44_corr.pk1','rb')
-    [z44_ul_blank, z44_corr] = pickle.load(file)
-    file.close()
-    #correlationPlot(z44_corr, z99_corr)
+    #Limits and correlations come from the same fits (see scan_edge)
+    limits = load_limits('limits')
+    z44_ul = limits[0.44]['box_flux']
+    #correlationPlot('limits')
     #make_ul_plot(z44_ul[:,0],brazil_dict,'UL','brazil_wide_box.pdf')
     #make_ul_plot(z44_ul,brazil_dict,'SIG', 'significance_wide_box.pdf')
     print("z44 significances = " + str(z44_ul[:,2]))
@@ -600,18 +677,13 @@ def main():
     print("at position " + str(energies[np.argmin(z44_ul[:,2])]) + " MeV")
 
     brazil_dict = consolidate_brazil_lines('brazil_narrow_box.pk1')
-    file = open('z99.pk1','rb')
-    [z99_ul, z99_corr_blank] = pickle.load(file)
-    file.close()
-    file = open('z99_corr.pk1','rb')
-    [z99_ul_blank, z99_corr] = pickle.load(file)
-    file.close()
+    z99_ul = limits[0.9999]['box_flux']
     print("z99 significances = " + str(z99_ul[:,2]))
     print("Most signficant result = " + str(sigma_given_p(pvalue_given_chi2(-2.0*min(z99_ul[:,2]),1)))+ " sigma")
     print("at position " + str(energies[np.argmin(z99_ul[:,2])]) + " MeV")
     #make_ul_plot(z99_ul[:,0],brazil_dict,'UL','brazil_narrow_box.pdf')
     #make_ul_plot(z99,brazil_dict,'SIG', 'significance_narrow_box.pdf')
-    correlationPlot(z44_corr, z99_corr)
+    correlationPlot('limits')
     file = open('z_artificial.pk1','rb')
     [z44_artificial_ul, z44_artificial_corr] = pickle.load(file)
     file.close()
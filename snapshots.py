@@ -0,0 +1,51 @@
+#In-memory snapshots of the fit parameters of an analysis object
+#A snapshot holds the value, bounds and free flag of every spectral parameter, keyed by
+#(source, parameter name), so it can be restored into any analysis built from a model with
+#those sources, e.g. the next edge's analysis of a scan, or an analysis with a box added.
+#This replaces writeXml/re-parse round trips for carrying fits from one step to the next,
+#and lets every fit warm-start from a previous solution.
+#Works with BinnedAnalysis (pyLikelihood parameters) and native_analysis.NativeAnalysis.
+
+#(source, parameter name) of every entry of like.params()
+def parameter_keys(like):
+    keys = [None]*len(like.params())
+    names = set(p.parameter.getName() for p in like.params())
+    for source in like.sourceNames():
+        for name in names:
+            try:
+                keys[like.par_index(source, name)] = (source, name)
+            except (KeyError, ValueError, RuntimeError):
+                pass
+    return keys
+
+#{(source, parameter): (value, (min, max), free)} for the parameters of like
+#sources: only the parameters of these sources, all if None
+def snapshot(like, sources=None):
+    state = {}
+    for key, p in zip(parameter_keys(like), like.params()):
+        if key is None or (sources is not None and key[0] not in sources):
+            continue
+        parameter = p.parameter
+        state[key] = (parameter.getValue(), tuple(parameter.getBounds()), parameter.isFree())
+    return state
+
+#Set the parameters of like that appear in state to their snapshot values, bounds and
+#free flags; other parameters are left alone
+#free=False restores values and bounds only (a warm start keeping the current free set)
+def restore(like, state, free=True):
+    for k, (key, p) in enumerate(zip(parameter_keys(like), like.params())):
+        if key not in state:
+            continue
+        value, (lower, upper), is_free = state[key]
+        parameter = p.parameter
+        #The value has to be inside the bounds at every step
+        current = parameter.getValue()
+        parameter.setBounds(min(lower, current), max(upper, current))
+        parameter.setValue(value)
+        parameter.setBounds(lower, upper)
+        if free:
+            if is_free:
+                like.thaw(k)
+            else:
+                like.freeze(k)
+    like.syncSrcParams()
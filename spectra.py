@@ -0,0 +1,71 @@
+#Spectra used by the box search
+#The box is flat in dN/dE between E_edge-width and E_edge. It is binned in true energy
+#and forward-folded through the energy dispersion matrix of irfs.py, the same matrix
+#the native likelihood folds the other sources with.
+import os
+import numpy as np
+
+from irfs import fold
+
+def box_width(edge, zeta):
+    return edge*2.0*np.sqrt(1.0-zeta)/(1.0+np.sqrt(1.0-zeta))
+
+#Write a spectrum in the two-column format read by FileFunction
+#The floor keeps the log-log interpolation in the Science Tools finite. The table is written
+#aside and renamed over filename, so a link to a bank table (TemplateBank.link_spectrum)
+#is replaced rather than written through
+def write_spectrum(filename, x, spectrum, floor=10.**-35):
+    temporary = filename + '.tmp'
+    np.savetxt(temporary, np.column_stack([x, np.maximum(spectrum, floor)]))
+    os.rename(temporary, filename)
+
+#Fraction of the unsmeared box flux in each true-energy bin, shape (n_zeta, n_edge, len(bin_edges)-1)
+#Fold with irfs.edisp_matrix to get the reconstructed-energy template
+#A zeta=1 line puts all of its flux in the bin containing the edge
+def true_binned_box_spectra(bin_edges, edges, zetas):
+    bin_edges = np.asarray(bin_edges, dtype=float)
+    edges = np.atleast_1d(np.asarray(edges, dtype=float))
+    zetas = np.atleast_1d(np.asarray(zetas, dtype=float))
+
+    edge = edges[None, :, None]
+    width = box_width(edge, zetas[:, None, None])
+    line = width<=0.0
+    safe_width = np.where(line, 1.0, width)
+    box_cdf = np.clip((bin_edges-edge+safe_width)/safe_width, 0.0, 1.0)
+    line_cdf = (bin_edges>=edge).astype(float)
+    return np.diff(np.where(line, line_cdf, box_cdf), axis=-1)
+
+#Folded box spectra for every (zeta, edge) pair in one call
+#matrix: dispersion matrix from irfs.edisp_matrix(bin_edges, true_edges)
+#Returns dN/dE at the log centres of bin_edges (the grid), shape (n_zeta, n_edge, len(bin_edges)-1),
+#normalized to unit integral over bin_edges, the grid, and the integrated (height 1) box flux
+#over bin_edges, shape (n_zeta, n_edge), 0 for lines
+def folded_box_spectra(matrix, bin_edges, true_edges, edges, zetas):
+    bin_edges = np.asarray(bin_edges, dtype=float)
+    edges = np.atleast_1d(np.asarray(edges, dtype=float))
+    zetas = np.atleast_1d(np.asarray(zetas, dtype=float))
+
+    folded = fold(matrix, true_binned_box_spectra(true_edges, edges, zetas))
+    contained = np.sum(folded, axis=-1)
+    grid = np.sqrt(bin_edges[:-1]*bin_edges[1:])
+    spectra = folded/np.diff(bin_edges)/contained[..., None]
+    width = box_width(edges[None, :], zetas[:, None])
+    return spectra, grid, np.where(width>0.0, width*contained, 0.0)
+
+#Flux in each analysis bin of the folded box spectra, per unit FileFunction normalization,
+#i.e. relative to the flux folded_box_spectra normalizes to; shape (n_zeta, n_edge, n_bins)
+#matrix: dispersion matrix onto the analysis binning, irfs.edisp_matrix(energies, true_edges)
+#fine_matrix: the matrix the FileFunction spectra are folded with (irfs.folding_matrix)
+def binned_box_spectra(matrix, fine_matrix, true_edges, edges, zetas):
+    true_binned = true_binned_box_spectra(true_edges, edges, zetas)
+    contained = np.sum(fold(fine_matrix, true_binned), axis=-1)
+    return fold(matrix, true_binned)/contained[..., None]
+
+#dN/dE of the unsmeared box normalized to unit total flux, for counts.expected_counts
+#with an edisp matrix. A line has no density in true energy; bin it with true_binned_box_spectra
+def true_box_dnde(E, edge, zeta):
+    width = box_width(edge, zeta)
+    if width<=0.0:
+        raise ValueError("A zeta=1 line has no true-energy dN/dE")
+    E = np.asarray(E, dtype=float)
+    return np.where((E>=edge-width) & (E<=edge), 1.0/width, 0.0)
@@ -0,0 +1,155 @@
+#On-disk bank of precomputed box templates
+#Every (edge, zeta) pair of a scan is computed once and stored as .npy arrays,
+#which scans and MC workers memory-map read-only instead of regenerating spectra.
+#The FileFunction tables are written once too, and box_spectrum.dat is linked to them.
+#Layout of a bank directory:
+#   bank.json    edges, zetas, energy binning and the content hash of the e_res table,
+#                binning and grid, checked against the current ones on load
+#   spectra.npy  (n_zeta, n_edge, len(grid)) folded, normalized dN/dE on grid
+#   grid.npy     energy grid [MeV] the spectra are evaluated on (log bin centres)
+#   binned.npy   (n_zeta, n_edge, num_ebins-1) flux per energy bin for unit flux in spectra.npy
+#   flux.npy     (n_zeta, n_edge) integrated (height 1) box flux in the folded range
+#   tables/      <zeta index>_<edge index>.dat, spectra.npy in the FileFunction format
+import os
+import json
+import hashlib
+import numpy as np
+
+from spectra import folded_box_spectra, binned_box_spectra, write_spectrum
+from counts import binned_counts
+import irfs
+
+#Content hash of everything the templates depend on
+def bank_hash(e_res_hash, edges, zetas, energies, grid):
+    h = hashlib.sha1(e_res_hash.encode('ascii'))
+    for arr in [edges, zetas, energies, grid]:
+        h.update(np.ascontiguousarray(arr, dtype=np.float64).tobytes())
+    return h.hexdigest()
+
+#Hash a bank for these edges, zetas and energies would have with the response's current
+#e_res table; the grid is the one build_template_bank folds on
+def template_hash(response, edge_indices, zetas, energies):
+    energies = np.asarray(energies, dtype=float)
+    true_edges = irfs.true_energy_edges(energies)
+    grid = np.sqrt(true_edges[:-1]*true_edges[1:])
+    return bank_hash(response.e_res_hash(), energies[np.asarray(edge_indices, dtype=int)], zetas, energies, grid)
+
+def _table_name(z, e):
+    return os.path.join('tables', str(z) + '_' + str(e) + '.dat')
+
+#Compute and store the templates for every (edge index, zeta) pair
+#edge_indices: index into energies of each box edge (e.g. range(6,48))
+#response: irfs.InstrumentResponse providing the dispersion (default tables if None)
+#The spectra are folded on the refined binning of irfs.folding_matrix, as update_box_spectrum
+#writes them, and the binned templates on the analysis binning itself
+def build_template_bank(path, edge_indices, zetas, energies, response=None):
+    if response is None:
+        response = irfs.default_response
+    edge_indices = np.asarray(edge_indices, dtype=int)
+    zetas = np.atleast_1d(np.asarray(zetas, dtype=float))
+    edges = np.asarray(energies)[edge_indices]
+
+    true_edges = irfs.true_energy_edges(energies)
+    matrix = response.edisp_matrix(true_edges, true_edges)
+    spectra, grid, flux = folded_box_spectra(matrix, true_edges, true_edges, edges, zetas)
+    binned = binned_box_spectra(response.edisp_matrix(energies, true_edges), matrix, true_edges, edges, zetas)
+
+    if not os.path.isdir(os.path.join(path, 'tables')):
+        os.makedirs(os.path.join(path, 'tables'))
+    for z in range(len(zetas)):
+        for e in range(len(edges)):
+            write_spectrum(os.path.join(path, _table_name(z, e)), grid, spectra[z, e])
+    np.save(os.path.join(path, 'spectra.npy'), spectra)
+    np.save(os.path.join(path, 'grid.npy'), np.asarray(grid, dtype=float))
+    np.save(os.path.join(path, 'binned.npy'), binned)
+    np.save(os.path.join(path, 'flux.npy'), flux)
+
+    meta = {
+        'hash':template_hash(response, edge_indices, zetas, energies),
+        'edge_indices':edge_indices.tolist(),
+        'zetas':zetas.tolist(),
+        'num_ebins':len(energies),
+        'energies':np.asarray(energies, dtype=float).tolist()}
+    file = open(os.path.join(path, 'bank.json'), 'w')
+    json.dump(meta, file)
+    file.close()
+    return TemplateBank(path, energies, response)
+
+#Read-only view of a bank on disk. Arrays are memory-mapped, so many workers
+#can share one copy through the page cache
+#energies: the analysis binning the bank must match (the stored one if None)
+#response: irfs.InstrumentResponse whose e_res table the bank must match (default if None)
+class TemplateBank:
+
+    def __init__(self, path, energies=None, response=None):
+        file = open(os.path.join(path, 'bank.json'), 'r')
+        meta = json.load(file)
+        file.close()
+        if response is None:
+            response = irfs.default_response
+        if energies is None:
+            energies = meta['energies']
+        if len(energies) != meta['num_ebins'] or template_hash(response, meta['edge_indices'], meta['zetas'], energies) != meta['hash']:
+            raise ValueError("Template bank " + str(path) + " was built with a different e_res table, energy binning or grid")
+
+        #Absolute, so links made from a worker's scratch directory resolve
+        self.path = os.path.abspath(path)
+        self.hash = meta['hash']
+        self.edge_indices = np.array(meta['edge_indices'])
+        self.zetas = np.array(meta['zetas'])
+        self.num_ebins = meta['num_ebins']
+        self.energies = np.array(meta['energies'])
+        self.edges = self.energies[self.edge_indices]
+
+        self.grid = np.load(os.path.join(path, 'grid.npy'), mmap_mode='r')
+        self.spectra = np.load(os.path.join(path, 'spectra.npy'), mmap_mode='r')
+        self.binned = np.load(os.path.join(path, 'binned.npy'), mmap_mode='r')
+        self.flux = np.load(os.path.join(path, 'flux.npy'), mmap_mode='r')
+
+        self._edge_lookup = dict((int(k), i) for i, k in enumerate(self.edge_indices))
+
+    #Position of (edge index, zeta) in the stored arrays
+    def locate(self, edge_index, zeta):
+        z = np.nonzero(np.isclose(self.zetas, zeta, rtol=0.0, atol=1e-12))[0]
+        if len(z) == 0 or int(edge_index) not in self._edge_lookup:
+            raise KeyError("No template for edge index " + str(edge_index) + " and zeta " + str(zeta))
+        return z[0], self._edge_lookup[int(edge_index)]
+
+    #Same, but from the edge energy rather than its index
+    def locate_energy(self, energy, zeta):
+        matches = np.nonzero(np.isclose(self.edges, energy))[0]
+        if len(matches) == 0:
+            raise KeyError("No template for edge energy " + str(energy) + " MeV")
+        return self.locate(self.edge_indices[matches[0]], zeta)
+
+    def spectrum(self, edge_index, zeta):
+        z, e = self.locate(edge_index, zeta)
+        return self.spectra[z, e]
+
+    def binned_template(self, edge_index, zeta):
+        z, e = self.locate(edge_index, zeta)
+        return self.binned[z, e]
+
+    def integrated_flux(self, edge_index, zeta):
+        z, e = self.locate(edge_index, zeta)
+        return float(self.flux[z, e])
+
+    #Expected counts per energy bin for unit FileFunction normalization flux
+    #plane_exposure: exposure of the box at the num_ebins energy planes, e.g. the sums of
+    #its srcmap planes, averaged over each bin
+    def binned_counts(self, edge_index, zeta, plane_exposure):
+        return binned_counts(self.binned_template(edge_index, zeta), plane_exposure)
+
+    #Write a stored spectrum for FileFunction without recomputing it
+    def write_spectrum(self, filename, edge_index, zeta, scale=1.0):
+        write_spectrum(filename, self.grid, scale*self.spectrum(edge_index, zeta))
+
+    #Point filename (e.g. box_spectrum.dat) at the stored table instead of writing it
+    #The link is swapped in with a rename, so readers never see a missing file
+    def link_spectrum(self, filename, edge_index, zeta):
+        z, e = self.locate(edge_index, zeta)
+        temporary = filename + '.link'
+        if os.path.lexists(temporary):
+            os.remove(temporary)
+        os.symlink(os.path.join(self.path, _table_name(z, e)), temporary)
+        os.rename(temporary, filename)
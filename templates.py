@@ -0,0 +1,158 @@
+#Native spatial templates, without gtsrcmaps
+#Point sources are dropped onto the ROI grid and convolved with per-energy-bin PSF
+#kernels, all bins at once through the FFT. Gaussian GC disks are built in closed form
+import os
+import hashlib
+import numpy as np
+from scipy.special import erf
+from astropy.io import fits
+from astropy.wcs import WCS
+from astropy.wcs.utils import skycoord_to_pixel, proj_plane_pixel_scales
+from astropy.coordinates import SkyCoord
+
+import irfs
+
+#The psf table holds 68% containment radii. For a 2D gaussian r68 = 1.51 sigma
+r68_to_sigma = 1.0/np.sqrt(-2.0*np.log(1.0-0.68))
+
+#Celestial WCS of a counts map or srcmap (the energy axis is dropped)
+def read_wcs(filename):
+    header = fits.getheader(filename)
+    return WCS(header).celestial
+
+#Pixel size [degrees] of a (square-pixel) WCS
+def pixel_size(wcs):
+    return float(np.mean(proj_plane_pixel_scales(wcs)))
+
+#PSF sigma [degrees] for each energy bin, from the containment radius at the log-center of the bin
+def psf_sigma(bin_edges, response=None):
+    if response is None:
+        response = irfs.default_response
+    bin_edges = np.asarray(bin_edges, dtype=float)
+    return response.psf(np.sqrt(bin_edges[:-1]*bin_edges[1:]))*r68_to_sigma
+
+#Pixel-integrated gaussian PSF kernels, shape (n_bins, 2*half_width+1, 2*half_width+1)
+#The gaussian is separable, so each kernel is an outer product of two 1D pixel integrals.
+#Kernels are normalized to unit sum
+def psf_kernels(bin_edges, pix_size, half_width=None, response=None):
+    sigma = psf_sigma(bin_edges, response)/pix_size
+    if half_width is None:
+        half_width = int(np.ceil(5.0*np.max(sigma)))
+    offsets = np.arange(-half_width, half_width+1)
+    s = np.sqrt(2.0)*sigma[:, None]
+    profile = 0.5*(erf((offsets[None, :]+0.5)/s)-erf((offsets[None, :]-0.5)/s))
+    profile /= np.sum(profile, axis=1)[:, None]
+    return profile[:, :, None]*profile[:, None, :]
+
+#Linear ('same' size) convolution of every energy plane of cube with its kernel
+#cube: (n_bins, ny, nx) or a single (ny, nx) map shared by all bins
+#kernels: (n_bins, ky, kx) with odd ky, kx
+def convolve_psf(cube, kernels):
+    cube = np.asarray(cube, dtype=float)
+    if cube.ndim == 2:
+        cube = np.broadcast_to(cube, (kernels.shape[0],)+cube.shape)
+    ny, nx = cube.shape[-2:]
+    ky, kx = kernels.shape[-2:]
+    shape = (ny+ky-1, nx+kx-1)
+    product = np.fft.rfft2(cube, s=shape, axes=(-2, -1))*np.fft.rfft2(kernels, s=shape, axes=(-2, -1))
+    full = np.fft.irfft2(product, s=shape, axes=(-2, -1))
+    return full[:, ky//2:ky//2+ny, kx//2:kx//2+nx]
+
+#Unit point source at (ra, dec) on the ROI grid, split bilinearly over the four
+#nearest pixels so sub-pixel positions are kept. pad extends the grid by that many
+#pixels on every side (shape is the padded shape)
+def point_source_map(ra, dec, wcs, shape, pad=0):
+    x, y = skycoord_to_pixel(SkyCoord(ra, dec, unit='deg', frame='icrs'), wcs)
+    x = float(x)+pad
+    y = float(y)+pad
+    sky = np.zeros(shape)
+    x0 = int(np.floor(x))
+    y0 = int(np.floor(y))
+    for dx, wx in [(0, 1.0-(x-x0)), (1, x-x0)]:
+        for dy, wy in [(0, 1.0-(y-y0)), (1, y-y0)]:
+            if 0 <= y0+dy < shape[0] and 0 <= x0+dx < shape[1]:
+                sky[y0+dy, x0+dx] += wx*wy
+    return sky
+
+#PSF-convolved template of point sources, shape (n_bins, ny, nx)
+#ra, dec may be scalars or arrays (the sources are summed, weighted by weights).
+#Each plane holds the fraction of the source photons landing in each pixel, so flux
+#falling outside the ROI is not renormalized away, and sources just outside the ROI
+#still spill into it
+def point_source_template(ra, dec, wcs, shape, bin_edges, weights=None, response=None, kernels=None):
+    ra = np.atleast_1d(ra)
+    dec = np.atleast_1d(dec)
+    if weights is None:
+        weights = np.ones(len(ra))
+    if kernels is None:
+        kernels = psf_kernels(bin_edges, pixel_size(wcs), response=response)
+    pad = kernels.shape[-1]//2
+    padded_shape = (shape[0]+2*pad, shape[1]+2*pad)
+    sky = np.zeros(padded_shape)
+    for r, d, w in zip(ra, dec, weights):
+        sky += w*point_source_map(r, d, wcs, padded_shape, pad)
+    return convolve_psf(sky, kernels)[:, pad:pad+shape[0], pad:pad+shape[1]]
+
+#Radii [degrees] of the RadialProfile files read by the Disk Component
+radial_grid = 10**np.linspace(-3.0, np.log10(180.0), 200)
+
+#Gaussian radial profiles for a list of widths, shape (n_sigma, len(r))
+def radial_profiles(r, sigmas):
+    sigmas = np.atleast_1d(np.asarray(sigmas, dtype=float))[:, None]
+    return np.exp(-1.0*r[None, :]**2/(2.0*sigmas**2))/np.sqrt(2.0*np.pi*sigmas**2)
+
+#Two-column RadialProfile file (radius [degrees], value)
+def write_radial_profile(filename, r, profile):
+    np.savetxt(filename, np.column_stack([r, profile]))
+
+_disk_cache = {}
+
+#Content hash of everything a disk template depends on besides its width
+def disk_key(ra, dec, wcs, shape, bin_edges, response=None):
+    h = hashlib.sha1(repr((float(ra), float(dec), tuple(int(n) for n in shape))).encode('ascii'))
+    h.update(wcs.to_header_string().encode('ascii'))
+    for arr in [bin_edges, psf_sigma(bin_edges, response)]:
+        h.update(np.ascontiguousarray(arr, dtype=np.float64).tobytes())
+    return h.hexdigest()
+
+#PSF-convolved templates of gaussian disks centered on (ra, dec), shape (n_sigma, n_bins, ny, nx)
+#A gaussian convolved with the gaussian PSF is a gaussian of width sqrt(sigma^2+sigma_psf^2),
+#so every (width, energy bin) pair is a separable pixel integral with no convolution at all.
+#Templates are cached by width and disk_key in memory and, if cache_dir is given, as
+#disk_<sigma>_<disk_key>.npy files there, so one cache_dir can serve several ROIs and binnings
+def disk_templates(sigmas, ra, dec, wcs, shape, bin_edges, response=None, cache_dir=None):
+    sigmas = np.atleast_1d(np.asarray(sigmas, dtype=float))
+    bin_edges = np.asarray(bin_edges, dtype=float)
+    key_base = disk_key(ra, dec, wcs, shape, bin_edges, response)
+
+    missing = []
+    for sigma in sigmas:
+        key = (key_base, float(sigma))
+        if key in _disk_cache:
+            continue
+        filename = None
+        if cache_dir is not None:
+            filename = os.path.join(cache_dir, 'disk_'+repr(float(sigma))+'_'+key_base+'.npy')
+        if filename is not None and os.path.exists(filename):
+            _disk_cache[key] = np.load(filename)
+        else:
+            missing.append(sigma)
+
+    if len(missing)>0:
+        x, y = skycoord_to_pixel(SkyCoord(ra, dec, unit='deg', frame='icrs'), wcs)
+        pix = pixel_size(wcs)
+        width = np.sqrt(np.asarray(missing)[:, None]**2+psf_sigma(bin_edges, response)[None, :]**2)/pix
+        s = np.sqrt(2.0)*width[:, :, None]
+        xs = np.arange(shape[1])-float(x)
+        ys = np.arange(shape[0])-float(y)
+        profile_x = 0.5*(erf((xs+0.5)/s)-erf((xs-0.5)/s))
+        profile_y = 0.5*(erf((ys+0.5)/s)-erf((ys-0.5)/s))
+        new_templates = profile_y[:, :, :, None]*profile_x[:, :, None, :]
+        for sigma, template in zip(missing, new_templates):
+            _disk_cache[(key_base, float(sigma))] = template
+            if cache_dir is not None:
+                if not os.path.isdir(cache_dir):
+                    os.makedirs(cache_dir)
+                np.save(os.path.join(cache_dir, 'disk_'+repr(float(sigma))+'_'+key_base+'.npy'), template)
+
+    return np.array([_disk_cache[(key_base, float(sigma))] for sigma in sigmas])
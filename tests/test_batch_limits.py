@@ -0,0 +1,78 @@
+#Batch limits (analysis.likelihood_upper_limits) against the per-zeta edge scan
+#(analysis.scan_edge) on a small synthetic srcmap: a box and a disk on 20x20 pixels,
+#with Poisson data drawn from a disk-only model
+import numpy as np
+import pytest
+from astropy.io import fits
+
+import analysis as an
+
+zeta = 0.44
+index = 30
+
+xml = '''<?xml version="1.0" ?>
+<source_library title="source library">
+  <source name="Box_Component" type="PointSource">
+    <spectrum apply_edisp="false" file="box_spectrum.dat" type="FileFunction">
+      <parameter free="0" max="1e+15" min="0" name="Normalization" scale="1e-15" value="0" />
+    </spectrum>
+  </source>
+  <source name="Disk Component" type="DiffuseSource">
+    <spectrum type="PowerLaw">
+      <parameter free="1" max="1e+15" min="0" name="Prefactor" scale="1e-11" value="%s" />
+      <parameter free="1" max="0" min="-6" name="Index" scale="1" value="%s" />
+      <parameter free="0" max="500000" min="30" name="Scale" scale="1" value="1000" />
+    </spectrum>
+  </source>
+</source_library>
+'''
+
+@pytest.fixture
+def srcmap(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    energies = an.energies
+    y, x = np.mgrid[:20, :20]
+    widths = 2.0*(energies/energies[0])**-0.3
+    box = np.exp(-((x-10.2)**2+(y-9.7)**2)[None]/(2.0*widths[:, None, None]**2))
+    widths = 4.0*(energies/energies[0])**-0.1
+    disk = np.exp(-((x-10.0)**2+(y-10.0)**2)[None]/(2.0*widths[:, None, None]**2))
+    box *= 3e10/np.sum(box, axis=(1, 2))[:, None, None]
+    disk *= 3e10/np.sum(disk, axis=(1, 2))[:, None, None]
+    ebounds = fits.BinTableHDU.from_columns([fits.Column('CHANNEL', 'I', array=np.arange(len(energies)-1)),
+                                             fits.Column('E_MIN', 'E', array=energies[:-1]*1000),
+                                             fits.Column('E_MAX', 'E', array=energies[1:]*1000)], name='EBOUNDS')
+    hdus = fits.HDUList([fits.PrimaryHDU(np.zeros((len(energies)-1, 20, 20))), fits.BinTableHDU(name='GTI'), ebounds,
+                         fits.ImageHDU(box, name='Box_Component'), fits.ImageHDU(disk, name='Disk Component')])
+    hdus.writeto('srcmap.fits')
+
+    an.update_box_spectrum(energies[index], zeta)
+    open('xmlmodel.xml', 'w').write(xml % (400.0, -2.3))
+    like = an.AnalyticAnalysis(an.BinnedObs(srcMaps='srcmap.fits'), 'xmlmodel.xml')
+    hdus[0].data = np.random.RandomState(1).poisson(like.getModel()).astype(float)
+    hdus.writeto('srcmap.fits', overwrite=True)
+    #Fits start away from the truth
+    open('xmlmodel.xml', 'w').write(xml % (300.0, -2.0))
+    return 'srcmap.fits'
+
+#The box counts folded from the spectrum match the box of an analysis built on it
+def test_box_counts(srcmap):
+    an.update_box_spectrum(an.energies[index], zeta)
+    like = an.AnalyticAnalysis(an.BinnedObs(srcMaps=srcmap), 'xmlmodel.xml')
+    like.edit_parameter('Box_Component', 'Normalization', 1.0)
+    planes = np.asarray(an.open_cube(srcmap).cube('Box_Component'), dtype=float)
+    counts = 1e-15*an.box_counts(index, zeta, np.sum(planes.reshape(len(planes), -1), axis=1))
+    expected = like._srcCnts('Box_Component')
+    assert np.sum(counts) == pytest.approx(np.sum(expected), rel=1e-2)
+    assert np.max(np.abs(counts-expected)) < 0.05*np.max(expected)
+
+def test_batch_matches_scan_edge(srcmap):
+    scan_flux, scan_correlations, names = an.scan_edge(an.scan_setup(zeta, srcmap), index)
+    #Another edge first, so a box left over from it would show
+    limits = an.likelihood_upper_limits([zeta], srcmap, indices=[index-10, index], fixed_background=False)
+    box_flux, correlations = limits[zeta]
+    np.testing.assert_allclose(box_flux[index], scan_flux, rtol=1e-3)
+    np.testing.assert_allclose(correlations[index], scan_correlations, atol=1e-3)
+
+    #The fixed background approximation profiles fewer parameters, so its limit is tighter
+    box_flux, correlations = an.likelihood_upper_limits([zeta], srcmap, indices=[index-10, index])[zeta]
+    assert 0.5*scan_flux[0] < box_flux[index][0] <= scan_flux[0]*(1.0+1e-3)